@@ -3,13 +3,14 @@
     No real surprises here. Blocks that were active previously don't always stay around.
 """
 import csv
-import psycopg
 
 from collections import namedtuple, defaultdict
 from psycopg.rows import namedtuple_row
 
+from db_pool import Database
+
 active_blocks = dict()
-with psycopg.connect('dbname=cuny_curriculum') as conn:
+with Database(pool_size=1) as database, database.connection() as conn:
   with conn.cursor(row_factory=namedtuple_row) as cursor:
     cursor.execute("""
     select institution, requirement_id, block_type, block_value, period_stop
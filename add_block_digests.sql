@@ -0,0 +1,14 @@
+-- Add (and backfill) the digest columns the ingester uses for change detection. The expressions
+-- must match text_digest_sql and metadata_digest_sql in block_index.py.
+alter table requirement_blocks add column if not exists text_digest text default null;
+alter table requirement_blocks add column if not exists metadata_digest text default null;
+
+update requirement_blocks
+   set text_digest = md5(requirement_text),
+       metadata_digest = md5(concat_ws(chr(31), coalesce(block_type, ''),
+                                                coalesce(block_value, ''),
+                                                coalesce(major1, ''),
+                                                coalesce(period_start, ''),
+                                                coalesce(period_stop, '')))
+ where text_digest is null
+    or metadata_digest is null;
@@ -0,0 +1,204 @@
+#! /usr/local/bin/python3
+"""Content-addressable, compressed store for the daily extracts kept in the archives directory.
+
+Almost all block texts are the same from one day’s dgw_dap_req_block extract to the next, so
+rather than keeping a full copy of each day’s file, the store keeps each distinct requirement_text
+once, gzip-compressed, as an object named by the sha256 digest of its bytes. Each day’s file is
+then a manifest: for each record, the bytes that come before its requirement_text (the metadata
+fields), the digest of the text, and the bytes that follow it. Files without a big text column (the
+active requirements extract) are stored as a single object each.
+
+Manifests reproduce the original file byte-for-byte; the size and sha256 digest of the whole file
+are checked when it is restored.
+
+  archive_store.py add archives/dgw_dap_req_block_2026-10-16.csv
+  archive_store.py restore dgw_dap_req_block_2026-10-16.csv -o /tmp/dgw_dap_req_block.csv
+  archive_store.py list
+"""
+
+import gzip
+import hashlib
+import json
+import mmap
+import os
+import re
+import sys
+import tempfile
+
+from argparse import ArgumentParser
+from pathlib import Path
+
+from extract_reader import ExtractReader
+
+# The column stored once per distinct value, for each kind of extract. Other kinds of extract are
+# stored whole.
+text_columns = {'dgw_dap_req_block': 'requirement_text'}
+delimiters = {'dgw_ir_active_requirements': '|'}
+
+
+# extract_kind()
+# -------------------------------------------------------------------------------------------------
+def extract_kind(extract_name: str) -> str:
+  """The kind of an extract is its (lower-case) stem, without the date the archives give it."""
+  return re.sub(r'_\d{4}-\d{2}-\d{2}$', '', Path(extract_name).stem.lower())
+
+
+def _segment(data) -> str:
+  """Decode bytes for a manifest, exactly reversibly."""
+  return bytes(data).decode('utf-8', 'surrogateescape')
+
+
+class ArchiveStore:
+  """The objects and manifests under a store directory."""
+
+  def __init__(self, store_dir: Path):
+    """Create the store’s directories, if need be."""
+    self.objects_dir = Path(store_dir, 'objects')
+    self.manifests_dir = Path(store_dir, 'manifests')
+    self.objects_dir.mkdir(parents=True, exist_ok=True)
+    self.manifests_dir.mkdir(parents=True, exist_ok=True)
+
+  def _object_path(self, digest: str) -> Path:
+    """Objects are spread over subdirectories named by the first two hex digits of the digest."""
+    return Path(self.objects_dir, digest[0:2], f'{digest}.gz')
+
+  def _manifest_path(self, extract_name: str) -> Path:
+    """The manifest of an extract is named for it."""
+    return Path(self.manifests_dir, f'{extract_name}.json.gz')
+
+  def _write_atomically(self, path: Path, content: bytes) -> None:
+    """Write a file by renaming a temporary one, so a partial file never has the real name."""
+    path.parent.mkdir(exist_ok=True)
+    fd, temp_name = tempfile.mkstemp(dir=path.parent, prefix='.tmp')
+    with os.fdopen(fd, 'wb') as temp_file:
+      temp_file.write(content)
+    os.replace(temp_name, path)
+
+  def put(self, data: bytes) -> str:
+    """Store an object, unless it is already there; return its digest."""
+    digest = hashlib.sha256(data).hexdigest()
+    if not (object_path := self._object_path(digest)).exists():
+      self._write_atomically(object_path, gzip.compress(data))
+    return digest
+
+  def get(self, digest: str) -> bytes:
+    """Return the contents of an object."""
+    return gzip.decompress(self._object_path(digest).read_bytes())
+
+  def names(self) -> list:
+    """Return the names of the extracts in the store."""
+    return sorted(path.name.removesuffix('.json.gz') for path in self.manifests_dir.glob('*.gz'))
+
+  def __contains__(self, extract_name: str) -> bool:
+    """Is the extract in the store?"""
+    return self._manifest_path(extract_name).exists()
+
+  def add(self, extract: Path) -> None:
+    """Add an extract file to the store, under its file name."""
+    kind = extract_kind(extract.name)
+    text_column = text_columns.get(kind)
+    header = {'name': extract.name, 'size': extract.stat().st_size, 'text_column': text_column}
+    entries = []
+    if header['size'] == 0:
+      header['sha256'] = hashlib.sha256().hexdigest()
+    else:
+      with extract.open('rb') as extract_file, mmap.mmap(extract_file.fileno(), 0,
+                                                         access=mmap.ACCESS_READ) as data:
+        header['sha256'] = hashlib.sha256(data).hexdigest()
+        if text_column is None:
+          entries.append(['', self.put(bytes(data)), ''])
+        else:
+          reader = ExtractReader(extract, delimiter=delimiters.get(kind, ','))
+          pos = 0
+          for row in reader:
+            if (span := row._span(text_column)) is None:
+              # A malformed field, decoded by the reader: keep the whole record in the manifest.
+              entries.append([_segment(data[pos:row._position]), None, ''])
+            else:
+              start, end = span
+              entries.append([_segment(data[pos:start]), self.put(data[start:end]),
+                              _segment(data[end:row._position])])
+            pos = row._position
+          if pos < header['size']:
+            # Blank lines at the end of the file
+            entries.append([_segment(data[pos:]), None, ''])
+
+    lines = [json.dumps(header)] + [json.dumps(entry) for entry in entries]
+    self._write_atomically(self._manifest_path(extract.name),
+                           gzip.compress('\n'.join(lines).encode('utf-8')))
+
+  def restore(self, extract_name: str, out_file) -> int:
+    """Write the original bytes of an extract to a binary file; return the number of bytes.
+
+    Raises ValueError if the result doesn’t match the size and digest of the original.
+    """
+    with gzip.open(self._manifest_path(extract_name), 'rt', encoding='utf-8') as manifest:
+      header = json.loads(next(manifest))
+      digest = hashlib.sha256()
+      size = 0
+      for line in manifest:
+        before, object_digest, after = json.loads(line)
+        for chunk in (before.encode('utf-8', 'surrogateescape'),
+                      b'' if object_digest is None else self.get(object_digest),
+                      after.encode('utf-8', 'surrogateescape')):
+          out_file.write(chunk)
+          digest.update(chunk)
+          size += len(chunk)
+
+    if size != header['size'] or digest.hexdigest() != header['sha256']:
+      raise ValueError(f'{extract_name}: restored file does not match the original')
+    return size
+
+
+# prune_archives()
+# -------------------------------------------------------------------------------------------------
+def prune_archives(store: ArchiveStore, archives_dir: Path, keep: int) -> list:
+  """Delete all but the newest keep plain copies of each kind of extract in archives_dir.
+
+  Only copies that are in the store get deleted. Returns the list of files deleted.
+  """
+  by_kind = dict()
+  for archive in sorted(archives_dir.glob('*.csv')):
+    by_kind.setdefault(extract_kind(archive.name), []).append(archive)
+  deleted = []
+  for archives in by_kind.values():
+    for archive in archives[:-keep] if keep > 0 else archives:
+      if archive.name in store:
+        archive.unlink()
+        deleted.append(archive)
+  return deleted
+
+
+if __name__ == '__main__':
+  """Add extracts to the store, or restore or list them."""
+  argument_parser = ArgumentParser('Content-addressable archive of extracts')
+  argument_parser.add_argument('--store', type=Path, default=Path('archives/store'))
+  subparsers = argument_parser.add_subparsers(dest='command', required=True)
+  add_parser = subparsers.add_parser('add', help='add extract file(s) to the store')
+  add_parser.add_argument('extracts', nargs='+', type=Path)
+  restore_parser = subparsers.add_parser('restore', help='reconstruct an extract file')
+  restore_parser.add_argument('name')
+  restore_parser.add_argument('-o', '--output', type=Path,
+                              help='file to write (default: stdout)')
+  subparsers.add_parser('list', help='list the extracts in the store')
+  args = argument_parser.parse_args()
+
+  store = ArchiveStore(args.store)
+  if args.command == 'add':
+    for extract in args.extracts:
+      store.add(extract)
+      print(f'Added {extract.name}')
+  elif args.command == 'restore':
+    if args.name not in store:
+      sys.exit(f'{args.name} is not in {args.store}')
+    try:
+      if args.output is None:
+        store.restore(args.name, sys.stdout.buffer)
+      else:
+        with args.output.open('wb') as output_file:
+          store.restore(args.name, output_file)
+    except ValueError as value_error:
+      sys.exit(f'{value_error}')
+  else:
+    for name in store.names():
+      print(name)
@@ -0,0 +1,119 @@
+"""Commit requirement_blocks writes in batches rather than once per block.
+
+Each block’s write runs inside a savepoint, so a block that fails is rolled back by itself without
+losing the rest of the batch. The batch is committed when it reaches a given number of blocks or a
+given number of bytes of block text, whichever comes first. Log messages are held until the batch
+they belong to is committed, so the log tells exactly what got committed. Likewise, a checkpoint,
+if there is one, is recorded as part of each batch (see checkpoint.py).
+
+The caller tells the committer when it is done with each row, by calling advance(), and that is
+when a full batch gets committed. That way, the checkpoint never falls behind what is committed.
+"""
+
+import psycopg
+
+
+class BatchCommitter:
+  """Batch commits of a connection, holding log messages until their batch is committed."""
+
+  def __init__(self, conn, log_file, max_rows: int = 500, max_bytes: int = 16 * 1024 * 1024,
+               checkpoint=None):
+    """Set the batch limits."""
+    self.conn = conn
+    self.log_file = log_file
+    self.checkpoint = checkpoint
+    self.max_rows = max_rows
+    self.max_bytes = max_bytes
+    self.num_rows = 0
+    self.num_bytes = 0
+    self.num_failed = 0
+    self.pending = []
+
+  def execute(self, cursor, block: str, query: str, params, messages: list,
+              num_bytes: int = 0) -> bool:
+    """Execute one block’s write in a savepoint; return False if it had to be rolled back.
+
+    The write is expected to affect exactly one row. The messages are logged when the batch is
+    committed; if the write fails, the block (institution and requirement_id) and the reason are
+    logged instead.
+    """
+    cursor.execute('savepoint block_write')
+    try:
+      cursor.execute(query, params)
+      assert cursor.rowcount == 1, f'{cursor.rowcount} rows\n{cursor.query}'
+    except psycopg.Error as err:
+      cursor.execute('rollback to savepoint block_write')
+      self._failed(block, err)
+      return False
+    cursor.execute('release savepoint block_write')
+
+    self._written(messages, num_bytes)
+    return True
+
+  def advance(self, position: int = None, num_inserted: int = 0, num_updated: int = 0) -> None:
+    """Done with a row: update the checkpoint, and commit if the batch is full."""
+    if self.checkpoint is not None:
+      self.checkpoint.advance(position, num_inserted, num_updated, self.num_failed)
+    if self.num_rows >= self.max_rows or self.num_bytes >= self.max_bytes:
+      self.commit()
+
+  def commit(self) -> None:
+    """Commit the current batch, with the checkpoint, and log its messages."""
+    if self.checkpoint is not None:
+      self.conn.execute(*self.checkpoint.statement())
+    self.conn.commit()
+    self._log_pending()
+
+  def _failed(self, block: str, err: Exception) -> None:
+    """Note a block whose write was rolled back."""
+    self.pending.append(f'Failed    {block}: {err}'.rstrip())
+    self.num_failed += 1
+
+  def _written(self, messages: list, num_bytes: int) -> None:
+    """Add a written block to the batch."""
+    self.pending += messages
+    self.num_rows += 1
+    self.num_bytes += num_bytes
+
+  def _log_pending(self) -> None:
+    """Log the messages of a just-committed batch and start a new one."""
+    for message in self.pending:
+      print(message, file=self.log_file)
+    self.log_file.flush()
+    self.pending = []
+    self.num_rows = self.num_bytes = 0
+
+
+class AsyncBatchCommitter(BatchCommitter):
+  """The same thing as BatchCommitter, for an AsyncConnection."""
+
+  async def execute(self, cursor, block: str, query: str, params, messages: list,
+                    num_bytes: int = 0) -> bool:
+    """Execute one block’s write in a savepoint; return False if it had to be rolled back."""
+    await cursor.execute('savepoint block_write')
+    try:
+      await cursor.execute(query, params)
+      assert cursor.rowcount == 1, f'{cursor.rowcount} rows\n{cursor.query}'
+    except psycopg.Error as err:
+      await cursor.execute('rollback to savepoint block_write')
+      self._failed(block, err)
+      return False
+    await cursor.execute('release savepoint block_write')
+
+    self._written(messages, num_bytes)
+    return True
+
+  async def advance(self, position: int = None, num_inserted: int = 0,
+                    num_updated: int = 0) -> None:
+    """Done with a row: update the checkpoint, and commit if the batch is full."""
+    if self.checkpoint is not None:
+      self.checkpoint.advance(position, num_inserted, num_updated, self.num_failed)
+    if self.num_rows >= self.max_rows or self.num_bytes >= self.max_bytes:
+      await self.commit()
+
+  async def commit(self) -> None:
+    """Commit the current batch, with the checkpoint, and log its messages."""
+    if self.checkpoint is not None:
+      await self.conn.execute(*self.checkpoint.statement())
+    await self.conn.commit()
+    self._log_pending()
@@ -0,0 +1,67 @@
+"""Measure the space saved by archive_store.py, and how fast it reconstructs extracts.
+
+The extracts given on the command line (default: all the dgw_dap_req_block extracts in archives/)
+are added to a scratch store. Reports the total size of the plain files against the size of the
+store, and the time to add and to reconstruct each file. Every reconstruction is compared with the
+original, byte for byte; any mismatch makes the run exit with a non-zero status.
+
+Run it from the project directory: python -m benchmarks.archive_store [extract ...]
+"""
+
+import io
+import sys
+import tempfile
+import time
+
+from argparse import ArgumentParser
+from pathlib import Path
+
+from archive_store import ArchiveStore
+
+
+# tree_size()
+# -------------------------------------------------------------------------------------------------
+def tree_size(directory: Path) -> int:
+  """Return the total size of the files under a directory."""
+  return sum(path.stat().st_size for path in directory.rglob('*') if path.is_file())
+
+
+if __name__ == '__main__':
+  argparser = ArgumentParser('Measure the archive store')
+  argparser.add_argument('extracts', nargs='*', type=Path,
+                         default=sorted(Path('archives').glob('dgw_dap_req_block*.csv')))
+  args = argparser.parse_args()
+  if not args.extracts:
+    sys.exit('No extracts found')
+
+  num_mismatches = 0
+  with tempfile.TemporaryDirectory() as store_dir:
+    store = ArchiveStore(Path(store_dir))
+    plain_size = 0
+    for extract in args.extracts:
+      size = extract.stat().st_size
+      plain_size += size
+
+      start = time.perf_counter()
+      store.add(extract)
+      add_time = time.perf_counter() - start
+
+      start = time.perf_counter()
+      restored = io.BytesIO()
+      store.restore(extract.name, restored)
+      restore_time = time.perf_counter() - start
+
+      if restored.getvalue() != extract.read_bytes():
+        num_mismatches += 1
+        print(f'{extract.name}: MISMATCH')
+      print(f'{extract.name}: {size / 1e6:8.1f} MB  add {add_time:6.2f} sec  '
+            f'restore {restore_time:6.2f} sec  {size / restore_time / 1e6:8.1f} MB/sec')
+
+    store_size = tree_size(Path(store_dir))
+    num_objects = sum(1 for path in store.objects_dir.rglob('*.gz'))
+
+  print(f'{len(args.extracts):,} extract(s): {plain_size / 1e6:,.1f} MB plain, '
+        f'{store_size / 1e6:,.1f} MB stored ({num_objects:,} objects); '
+        f'{100 * (1 - store_size / max(plain_size, 1)):.1f}% saved')
+
+  sys.exit(1 if num_mismatches else 0)
@@ -0,0 +1,123 @@
+"""Time the bounded-cost history diff against the difflib.context_diff() it replaced.
+
+The pairs of texts compared are the blocks whose text changed between consecutive archived
+dgw_dap_req_block extracts given on the command line (default: all of them in archives/). With
+--synthetic, each of the longest blocks is also paired with a copy that has every other line
+changed, which is the kind of restructuring that makes difflib slow. The slowest pairs for difflib
+are reported along with the new diff’s time for the same pairs. Each new diff is checked by
+applying it to the previous text; any that doesn’t reproduce the new text makes the run exit with
+a non-zero status.
+
+Run it from the project directory: python -m benchmarks.history_diff [extract ...]
+"""
+
+import difflib
+import sys
+import time
+
+from argparse import ArgumentParser
+from pathlib import Path
+
+from block_transforms import diff_texts, normalize_text
+from extract_reader import ExtractReader
+from line_diff import matching_blocks
+
+
+# changed_pairs()
+# -------------------------------------------------------------------------------------------------
+def changed_pairs(extracts: list) -> list:
+  """Return (key, previous text, new text) for blocks that changed between consecutive extracts."""
+  pairs = []
+  previous = None
+  for extract in extracts:
+    current = {(row.institution, row.requirement_id): normalize_text(row.requirement_text)
+               for row in ExtractReader(extract)}
+    if previous is not None:
+      pairs += [(f'{key[0]} {key[1]}', previous[key], text) for key, text in current.items()
+                if key in previous and previous[key] != text]
+    previous = current
+  return pairs, previous or dict()
+
+
+# synthetic_pairs()
+# -------------------------------------------------------------------------------------------------
+def synthetic_pairs(blocks: dict, num_blocks: int) -> list:
+  """Pair each of the longest blocks with a copy that has every other line changed."""
+  longest = sorted(blocks.items(), key=lambda item: len(item[1]), reverse=True)[:num_blocks]
+  pairs = []
+  for key, text in longest:
+    lines = text.split('\n')
+    changed = [f'{line} # changed' if index % 2 else line for index, line in enumerate(lines)]
+    pairs.append((f'{key[0]} {key[1]} (synthetic)', text, '\n'.join(changed)))
+  return pairs
+
+
+# applies()
+# -------------------------------------------------------------------------------------------------
+def applies(prev_text: str, requirement_text: str, max_edits: int, max_seconds: float) -> bool:
+  """Check that the matching blocks of the new diff, if any, turn the previous text into the new."""
+  a = prev_text.split('\n')
+  b = requirement_text.split('\n')
+  if (blocks := matching_blocks(a, b, max_edits, max_seconds)) is None:
+    return True
+  result = []
+  j = 0
+  for ai, bj, size in blocks:
+    if a[ai:ai + size] != b[bj:bj + size]:
+      return False
+    result += b[j:bj] + a[ai:ai + size]
+    j = bj + size
+  return result == b
+
+
+# timed()
+# -------------------------------------------------------------------------------------------------
+def timed(func, *args) -> float:
+  """Return how long func(*args) takes."""
+  start = time.perf_counter()
+  func(*args)
+  return time.perf_counter() - start
+
+
+def legacy_diff(prev_text: str, requirement_text: str) -> list:
+  """The history diff as it was."""
+  return list(difflib.context_diff([f'{line}\n' for line in prev_text.split('\n')],
+                                   [f'{line}\n' for line in requirement_text.split('\n')],
+                                   fromfile='previous', tofile='changed', n=0))
+
+
+if __name__ == '__main__':
+  argparser = ArgumentParser('Time the history diff')
+  argparser.add_argument('extracts', nargs='*', type=Path,
+                         default=sorted(Path('archives').glob('dgw_dap_req_block*.csv')))
+  argparser.add_argument('-s', '--synthetic', type=int, default=0, metavar='N',
+                         help='also diff the N longest blocks against altered copies')
+  argparser.add_argument('-w', '--worst', type=int, default=10,
+                         help='number of slowest pairs to list')
+  argparser.add_argument('--max_edits', type=int, default=500)
+  argparser.add_argument('--max_seconds', type=float, default=1.0)
+  args = argparser.parse_args()
+
+  pairs, latest_blocks = changed_pairs(args.extracts)
+  pairs += synthetic_pairs(latest_blocks, args.synthetic)
+  if not pairs:
+    sys.exit('No changed blocks found')
+
+  results = []
+  num_failures = 0
+  for key, prev_text, requirement_text in pairs:
+    legacy_time = timed(legacy_diff, prev_text, requirement_text)
+    new_time = timed(diff_texts, (prev_text, requirement_text), args.max_edits, args.max_seconds)
+    changes_str, _ = diff_texts((prev_text, requirement_text), args.max_edits, args.max_seconds)
+    if not applies(prev_text, requirement_text, args.max_edits, args.max_seconds):
+      num_failures += 1
+      print(f'{key}: DIFF DOES NOT APPLY')
+    results.append((legacy_time, new_time, key, changes_str))
+
+  print(f'{len(pairs):,} changed blocks: difflib {sum(r[0] for r in results):8.3f} sec  '
+        f'bounded {sum(r[1] for r in results):8.3f} sec')
+  print(f'\nSlowest {args.worst} for difflib:')
+  for legacy_time, new_time, key, changes_str in sorted(results, reverse=True)[:args.worst]:
+    print(f'  {key:32} difflib {legacy_time:8.3f}  bounded {new_time:8.3f}  {changes_str}')
+
+  sys.exit(1 if num_failures else 0)
@@ -0,0 +1,221 @@
+"""Micro-benchmarks for the ingestion hot paths, run offline against synthetic extracts.
+
+The cases are reading the dap_req_block extract (what csv_generator() iterates over), reading it
+with csv.reader as csv_generator() once did, for comparison, decruft(), to_html(), the history
+diff, and mk_term_info.py’s aggregation of the active requirements file.
+None of them needs a database. Each case is timed with timeit, and the best of --repeat runs is
+reported along with its throughput.
+
+Results are compared with a baseline saved as JSON, benchmarks/hot_paths_baseline.json unless
+--compare gives another. A case that takes more than --max_slowdown times its baseline time makes
+the run exit with a non-zero status, so it can be used as a regression check. Cases are only
+compared with a baseline made with the same --num_blocks, --seed, and --sample, and timings are
+only comparable on the same machine: --save writes a new baseline (the machine is recorded in it).
+
+The extracts are generated by synthetic_extracts.py, with the given size and seed, unless existing
+ones are given with --extracts_dir.
+
+Run it from the project directory:
+  python -m benchmarks.hot_paths
+  python -m benchmarks.hot_paths --save before.json
+  python -m benchmarks.hot_paths --compare before.json -c decruft diff
+  python -m benchmarks.hot_paths --save benchmarks/hot_paths_baseline.json
+"""
+
+import csv
+import json
+import platform
+import random
+import sys
+import tempfile
+import timeit
+
+from argparse import ArgumentParser
+from collections import namedtuple
+from pathlib import Path
+
+from benchmarks.synthetic_extracts import generate_extracts
+from extract_reader import ExtractReader
+
+default_baseline = Path(__file__).parent / 'hot_paths_baseline.json'
+
+# The fields the ingester reads from each row
+used_fields = ['institution', 'requirement_id', 'block_type', 'block_value', 'title',
+               'period_start', 'period_stop', 'major1', 'parse_date', 'requirement_text',
+               'irdw_load_date']
+
+
+# Cases
+# -------------------------------------------------------------------------------------------------
+# Each case takes the paths of the extracts and the command-line args, and returns the function to
+# time, the number of items it handles, and what the items are. Imports are done by the cases, so
+# one whose module can’t be imported here doesn’t keep the others from running.
+
+def read_case(req_block: Path, active: Path, args) -> tuple:
+  """Reading the extract, decoding the fields the ingester uses.
+
+  csv_generator() is a thin wrapper around ExtractReader that needs the ingester’s args, so the
+  reader is timed directly.
+  """
+  num_rows = sum(1 for _ in ExtractReader(req_block))
+
+  def read():
+    for row in ExtractReader(req_block):
+      for field in used_fields:
+        getattr(row, field)
+  return read, num_rows, 'rows'
+
+
+def csv_read_case(req_block: Path, active: Path, args) -> tuple:
+  """The baseline for the read case: csv.reader rows as namedtuples, with the same fields used."""
+  num_rows = sum(1 for _ in ExtractReader(req_block))
+
+  def read():
+    with req_block.open(newline='') as req_block_file:
+      reader = csv.reader(req_block_file)
+      Row = namedtuple('Row', [col.lower().replace(' ', '_') for col in next(reader)])
+      for line in reader:
+        row = Row._make(line)
+        for field in used_fields:
+          getattr(row, field)
+  return read, num_rows, 'rows'
+
+
+def decruft_case(req_block: Path, active: Path, args) -> tuple:
+  """decruft() over the raw text of every block."""
+  from block_transforms import decruft
+  texts = [row.requirement_text for row in ExtractReader(req_block)]
+
+  def run():
+    for text in texts:
+      decruft(text)
+  return run, len(texts), 'blocks'
+
+
+def to_html_case(req_block: Path, active: Path, args) -> tuple:
+  """to_html() for a sample of the blocks: it runs the dgw_preprocessor filter, which is slow."""
+  from block_transforms import normalize_text
+  from scribe_to_html import to_html
+  blocks = [(row.institution, row.requirement_id, normalize_text(row.requirement_text))
+            for row in ExtractReader(req_block)]
+  blocks = random.Random(args.seed).sample(blocks, min(args.sample, len(blocks)))
+
+  def run():
+    for block in blocks:
+      to_html(*block)
+  return run, len(blocks), 'blocks'
+
+
+def diff_case(req_block: Path, active: Path, args) -> tuple:
+  """The history diff between each of a sample of blocks and a copy with a few lines changed."""
+  from block_transforms import diff_texts, normalize_text
+  rng = random.Random(args.seed)
+  texts = [normalize_text(row.requirement_text) for row in ExtractReader(req_block)]
+  pairs = []
+  for text in rng.sample(texts, min(args.sample, len(texts))):
+    lines = text.split('\n')
+    for _ in range(max(1, len(lines) // 20)):
+      lines[rng.randrange(len(lines))] = '  # changed'
+    pairs.append((text, '\n'.join(lines)))
+
+  def run():
+    for pair in pairs:
+      diff_texts(pair)
+  return run, len(pairs), 'pairs'
+
+
+def term_info_case(req_block: Path, active: Path, args) -> tuple:
+  """mk_term_info.py’s conversion of the active requirements file to term_info lists."""
+  from mk_term_info import active_term_info
+  with active.open() as active_file:
+    num_rows = sum(1 for _ in active_file) - 1
+  return (lambda: active_term_info(active)), num_rows, 'rows'
+
+
+cases = {'read': read_case, 'csv_read': csv_read_case, 'decruft': decruft_case,
+         'to_html': to_html_case, 'diff': diff_case, 'term_info': term_info_case}
+
+
+# run_cases()
+# -------------------------------------------------------------------------------------------------
+def run_cases(names: list, req_block: Path, active: Path, args) -> dict:
+  """Time the named cases; return {name: {seconds, items, unit}}, omitting skipped cases."""
+  results = dict()
+  for name in names:
+    try:
+      func, num_items, unit = cases[name](req_block, active, args)
+    except ImportError as import_error:
+      print(f'{name:>10}: skipped ({import_error})')
+      continue
+    seconds = min(timeit.repeat(func, number=1, repeat=args.repeat))
+    results[name] = {'seconds': seconds, 'items': num_items, 'unit': unit}
+  return results
+
+
+# compare()
+# -------------------------------------------------------------------------------------------------
+def compare(results: dict, baseline: dict, max_slowdown: float) -> list:
+  """Return the names of the cases that took more than max_slowdown times their baseline time.
+
+  Cases run with other settings than the baseline’s, or not in it, aren’t compared.
+  """
+  return [name for name, result in results.items()
+          if name in baseline and result['items'] == baseline[name]['items']
+          and result['seconds'] > max_slowdown * baseline[name]['seconds']]
+
+
+if __name__ == '__main__':
+  argparser = ArgumentParser('Micro-benchmarks for the ingestion hot paths')
+  argparser.add_argument('-c', '--cases', nargs='+', choices=cases.keys(), default=list(cases))
+  argparser.add_argument('-n', '--num_blocks', type=int, default=5000,
+                         help='size of the synthetic extract')
+  argparser.add_argument('--seed', type=int, default=1)
+  argparser.add_argument('-s', '--sample', type=int, default=500,
+                         help='number of blocks for the to_html and diff cases')
+  argparser.add_argument('-r', '--repeat', type=int, default=5)
+  argparser.add_argument('--extracts_dir', type=Path,
+                         help='use the extracts in this directory instead of generating them')
+  argparser.add_argument('--save', type=Path, help='write the results to this JSON file')
+  argparser.add_argument('--compare', type=Path, default=default_baseline,
+                         help='compare with results saved earlier (default: '
+                              f'benchmarks/{default_baseline.name})')
+  argparser.add_argument('--max_slowdown', type=float, default=1.5,
+                         help='fail if a case takes more than this times its baseline time '
+                              '(default: 1.5)')
+  args = argparser.parse_args()
+  settings = {'num_blocks': args.num_blocks, 'seed': args.seed, 'sample': args.sample,
+              'extracts_dir': str(args.extracts_dir) if args.extracts_dir else None}
+
+  with tempfile.TemporaryDirectory() as temp_dir:
+    if args.extracts_dir:
+      req_block = Path(args.extracts_dir, 'dgw_dap_req_block.csv')
+      active = Path(args.extracts_dir, 'dgw_ir_active_requirements.csv')
+    else:
+      req_block, active = generate_extracts(Path(temp_dir), args.num_blocks, args.seed)
+    results = run_cases(args.cases, req_block, active, args)
+
+  baseline = dict()
+  if args.compare.is_file():
+    saved = json.loads(args.compare.read_text())
+    if saved['settings'] == settings:
+      baseline = saved['results']
+      if saved['machine'] != platform.node():
+        print(f'Comparing with {args.compare.name}, saved on {saved["machine"]}')
+    else:
+      print(f'Not comparing with {args.compare.name}: saved with {saved["settings"]}')
+  regressions = compare(results, baseline, args.max_slowdown)
+  for name, result in results.items():
+    seconds, num_items, unit = result['seconds'], result['items'], result['unit']
+    line = (f'{name:>10}: {seconds:8.4f} sec  {num_items / seconds:12,.0f} {unit}/sec '
+            f'({num_items:,} {unit})')
+    if name in baseline:
+      line += f'  {baseline[name]["seconds"] / seconds:5.2f}x the saved speed'
+    if name in regressions:
+      line += f'  SLOWER than {args.max_slowdown}x the saved time'
+    print(line)
+
+  if args.save:
+    args.save.write_text(json.dumps({'settings': settings, 'machine': platform.node(),
+                                     'python': platform.python_version(), 'results': results},
+                                    indent=2) + '\n')
+  sys.exit(0 if results and not regressions else 1)
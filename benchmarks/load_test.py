@@ -0,0 +1,333 @@
+"""End-to-end load test of a night’s ingestion, against a throwaway local PostgreSQL cluster.
+
+A temporary cluster is created with initdb and started on a Unix socket in a temporary directory;
+requirement_blocks.sql is loaded into its cuny_curriculum database, which is then seeded with a
+synthetic prior-day snapshot (see synthetic_extracts.py). For each change rate, the database is
+reset to that snapshot, the next day’s extracts, with that fraction of the blocks changed, are put
+in a temporary home directory’s downloads/, and the stages are run one after another, as separate
+processes:
+
+  ingest_requirement_blocks.py --ingest_only
+  mk_html.py
+  mk_term_info.py
+
+The scripts connect with dbname=cuny_curriculum as usual; PGHOST, PGPORT, and PGUSER point them at
+the temporary cluster, and HOME at the temporary home directory, so the real database and project
+directories are never touched. --ingest_only keeps the ingester from running the other stages
+itself, and from emailing its report.
+
+For each stage, the wall time, CPU time, rows/sec, WAL bytes generated, and peak RSS are reported.
+
+A few blocks (--repeats) appear a second time at the end of the next day’s extract, with another
+change to their text; if any of them isn’t left with the text of its last row, or with the diff
+for that change in the history store, the run exits with a non-zero status. Give --ingest_args
+'--bulk' (etc.) to check the other ingestion modes.
+
+Run it from the project directory, as a user who can run initdb (not root):
+  python -m benchmarks.load_test -n 20000
+  python -m benchmarks.load_test --rates 0.05 --ingest_args '--workers 4' --json results.json
+"""
+
+import datetime
+import json
+import os
+import psycopg
+import random
+import shlex
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+
+from argparse import ArgumentParser
+from contextlib import closing
+from pathlib import Path
+
+from benchmarks.synthetic_extracts import (active_rows, default_mix, next_day_rows, req_block_rows,
+                                           schema_columns, write_extracts)
+from block_index import metadata_digest
+from block_transforms import normalize_blocks, normalize_text
+from extract_reader import ExtractReader
+from history_store import default_path as default_history_path, open_store, timeline
+from staging_load import staging_cols
+
+project_dir = Path(__file__).resolve().parent.parent
+seed_db = 'cuny_curriculum_seed'
+
+
+# pg_bindir()
+# -------------------------------------------------------------------------------------------------
+def pg_bindir() -> Path:
+  """Where initdb and pg_ctl are: on the PATH, or else where pg_config says."""
+  if initdb := shutil.which('initdb'):
+    return Path(initdb).parent
+  result = subprocess.run(['pg_config', '--bindir'], capture_output=True, text=True, check=True)
+  return Path(result.stdout.strip())
+
+
+class Cluster:
+  """A temporary Postgres cluster, listening only on a Unix socket in its directory."""
+
+  def __init__(self, cluster_dir: Path, bindir: Path, port: int):
+    """Create and start the cluster."""
+    self.data_dir = Path(cluster_dir, 'data')
+    self.socket_dir = Path(cluster_dir, 'socket')
+    self.socket_dir.mkdir(parents=True)
+    self.bindir = bindir
+    self.port = port
+    self.log = Path(cluster_dir, 'postgres.log')
+    subprocess.run([bindir / 'initdb', '-D', self.data_dir, '-U', 'postgres', '-A', 'trust',
+                    '-E', 'UTF8', '--no-instructions'], check=True, capture_output=True)
+    options = f"-k {self.socket_dir} -p {port} -c listen_addresses=''"
+    subprocess.run([bindir / 'pg_ctl', '-D', self.data_dir, '-o', options, '-l', self.log, '-w',
+                    'start'], check=True, capture_output=True)
+
+  def env(self) -> dict:
+    """Environment variables that make libpq clients connect to this cluster."""
+    return {'PGHOST': str(self.socket_dir), 'PGPORT': str(self.port), 'PGUSER': 'postgres'}
+
+  def conninfo(self, dbname: str) -> str:
+    """Connection string for a database of the cluster."""
+    return f'host={self.socket_dir} port={self.port} user=postgres dbname={dbname}'
+
+  def psql(self, dbname: str, sql: str) -> None:
+    """Run SQL commands with psql, stopping at the first error."""
+    subprocess.run([self.bindir / 'psql', '-X', '-q', '-v', 'ON_ERROR_STOP=1', '-d',
+                    self.conninfo(dbname)], input=sql, text=True, check=True)
+
+  def stop(self) -> None:
+    """Shut the cluster down."""
+    subprocess.run([self.bindir / 'pg_ctl', '-D', self.data_dir, '-m', 'fast', '-w', 'stop'],
+                   check=True, capture_output=True)
+
+
+# create_schema()
+# -------------------------------------------------------------------------------------------------
+def create_schema(cluster: Cluster, dbname: str) -> None:
+  """Create the database and the tables the ingestion scripts use."""
+  cluster.psql('postgres', f'create database {dbname}')
+  cluster.psql(dbname, Path(project_dir, 'requirement_blocks.sql').read_text())
+  cluster.psql(dbname, Path(project_dir, 'add_block_digests.sql').read_text())
+  cluster.psql(dbname, """
+  create table updates (table_name text primary key, update_date date, file_name text);
+  insert into updates values ('requirement_blocks', null, null);
+  """)
+
+
+# seed_blocks()
+# -------------------------------------------------------------------------------------------------
+def seed_blocks(conninfo: str, extract: Path) -> int:
+  """Load a prior-day extract into requirement_blocks, as the ingester would have left it.
+
+  The texts are normalized and digested the way the ingester does it, and every block is given
+  requirement_html, as mk_html.py would have. Returns the number of blocks.
+  """
+  rows = list(ExtractReader(extract))
+  normalized = normalize_blocks([(row.requirement_text, row.title) for row in rows])
+  cols = staging_cols + ['requirement_html']
+  with psycopg.connect(conninfo) as conn:
+    with conn.cursor() as cursor:
+      with cursor.copy(f'copy requirement_blocks ({", ".join(cols)}) from stdin') as copy:
+        for row, (requirement_text, title, text_digest) in zip(rows, normalized):
+          values = {col: getattr(row, col, None) or None for col in staging_cols}
+          values.update(requirement_text=requirement_text, title=title, text_digest=text_digest,
+                        metadata_digest=metadata_digest(row),
+                        requirement_html='<details>seeded</details>')
+          copy.write_row([values[col] for col in cols])
+    conn.execute('analyze requirement_blocks')
+  return len(rows)
+
+
+# check_repeats()
+# -------------------------------------------------------------------------------------------------
+def check_repeats(conninfo: str, rows: list) -> list:
+  """Return the repeated blocks whose requirement_text isn’t that of their last row in rows."""
+  last_texts = dict()
+  num_rows = dict()
+  for row in rows:
+    key = (row['INSTITUTION'], row['REQUIREMENT_ID'])
+    last_texts[key] = normalize_text(row['REQUIREMENT_TEXT'])
+    num_rows[key] = num_rows.get(key, 0) + 1
+  mismatches = []
+  with psycopg.connect(conninfo) as conn:
+    for key, count in num_rows.items():
+      if count > 1:
+        requirement_text, = conn.execute('select requirement_text from requirement_blocks '
+                                         'where institution = %s and requirement_id = %s',
+                                         key).fetchone()
+        if requirement_text != last_texts[key]:
+          mismatches.append(key)
+  return mismatches
+
+
+# check_repeat_history()
+# -------------------------------------------------------------------------------------------------
+def check_repeat_history(history_path: Path, rows: list, load_date: datetime.date) -> list:
+  """Return the repeated blocks whose history for load_date isn’t their last row’s change.
+
+  The last row of a repeated block adds its text’s third line, so that line is added or changed in
+  the diff the history store should have kept.
+  """
+  seen = set()
+  added_lines = dict()
+  for row in rows:
+    key = (row['INSTITUTION'], row['REQUIREMENT_ID'])
+    if key in seen:
+      added_lines[key] = normalize_text(row['REQUIREMENT_TEXT']).split('\n')[2]
+    seen.add(key)
+  mismatches = []
+  with closing(open_store(history_path)) as conn:
+    for key, added_line in added_lines.items():
+      diffs = [diff for parse_date, _, _, diff in timeline(conn, *key)
+               if parse_date == load_date.isoformat()]
+      if len(diffs) != 1 or not ({f'+ {added_line}\n', f'! {added_line}\n'}
+                                 & set(diffs[0].splitlines(keepends=True))):
+        mismatches.append(key)
+  return mismatches
+
+
+# wal_lsn()
+# -------------------------------------------------------------------------------------------------
+def wal_lsn(conninfo: str) -> str:
+  """The cluster’s current WAL insert location."""
+  with psycopg.connect(conninfo) as conn:
+    return conn.execute('select pg_current_wal_insert_lsn()::text').fetchone()[0]
+
+
+def wal_bytes(conninfo: str, start_lsn: str) -> int:
+  """The number of WAL bytes written since start_lsn."""
+  with psycopg.connect(conninfo) as conn:
+    return int(conn.execute('select pg_wal_lsn_diff(pg_current_wal_insert_lsn(), %s)',
+                            (start_lsn, )).fetchone()[0])
+
+
+# run_stage()
+# -------------------------------------------------------------------------------------------------
+def run_stage(command: list, cwd: Path, env: dict, conninfo: str, num_rows: int,
+              output: Path) -> dict:
+  """Run one stage as a child process; return its measurements.
+
+  Peak RSS is that of the stage process or any of its own children (e.g., worker processes).
+  """
+  start_lsn = wal_lsn(conninfo)
+  start = time.perf_counter()
+  with output.open('w') as output_file:
+    process = subprocess.Popen(command, cwd=cwd, env=env, stdout=output_file,
+                               stderr=subprocess.STDOUT)
+    _, status, usage = os.wait4(process.pid, 0)
+    process.returncode = os.waitstatus_to_exitcode(status)
+  wall = time.perf_counter() - start
+  if process.returncode != 0:
+    sys.exit(f'{Path(command[1]).name} failed ({process.returncode}):\n{output.read_text()}')
+  return {'wall_seconds': wall,
+          'cpu_seconds': usage.ru_utime + usage.ru_stime,
+          'rows': num_rows,
+          'rows_per_second': num_rows / wall,
+          'wal_bytes': wal_bytes(conninfo, start_lsn),
+          'peak_rss_mb': usage.ru_maxrss / 1024}
+
+
+# load_test()
+# -------------------------------------------------------------------------------------------------
+def load_test(cluster: Cluster, work_dir: Path, blocks: list, rate: float, load_date: datetime.date,
+              rng: random.Random, ingest_args: list, num_repeats: int) -> dict:
+  """Run the stages on the next day’s extracts, with the given fraction of the blocks changed.
+
+  The database is reset to the seed snapshot first. Returns the measurements of each stage. The
+  run exits with a non-zero status if a block repeated in the extract doesn’t end up with the text
+  of its last row.
+  """
+  with psycopg.connect(cluster.conninfo('postgres'), autocommit=True) as conn:
+    conn.execute('drop database if exists cuny_curriculum')
+    conn.execute(f'create database cuny_curriculum template {seed_db}')
+
+  # A fresh home directory, with the next day’s extracts in downloads/
+  home_dir = Path(work_dir, f'home_{rate}')
+  shutil.rmtree(home_dir, ignore_errors=True)
+  ingest_dir = Path(home_dir, 'Projects/ingest_requirement_blocks')
+  for subdir in ['downloads', 'archives', 'latest_queries', 'Logs']:
+    Path(ingest_dir, subdir).mkdir(parents=True)
+  next_day = next_day_rows(rng, blocks, rate, load_date, num_repeats)
+  actives = active_rows(rng, next_day, load_date)
+  write_extracts(Path(ingest_dir, 'downloads'), next_day, actives, schema_columns())
+
+  env = dict(os.environ, HOME=str(home_dir), **cluster.env())
+  conninfo = cluster.conninfo('cuny_curriculum')
+  results = dict()
+  results['ingest'] = run_stage([sys.executable, str(Path(project_dir,
+                                                         'ingest_requirement_blocks.py')),
+                                 '--ingest_only', *ingest_args],
+                                ingest_dir, env, conninfo, len(next_day),
+                                Path(work_dir, f'ingest_{rate}.out'))
+  if mismatches := check_repeats(conninfo, next_day):
+    sys.exit(f'Repeated blocks without their last row’s text: '
+             f'{", ".join(" ".join(key) for key in mismatches)}')
+  if mismatches := check_repeat_history(Path(ingest_dir, default_history_path), next_day,
+                                        load_date):
+    sys.exit(f'Repeated blocks without their last row’s change in the history store: '
+             f'{", ".join(" ".join(key) for key in mismatches)}')
+  with psycopg.connect(conninfo) as conn:
+    num_missing, = conn.execute('select count(*) from requirement_blocks '
+                                'where requirement_html is null').fetchone()
+  results['mk_html'] = run_stage([sys.executable, str(Path(project_dir, 'mk_html.py'))],
+                                 ingest_dir, env, conninfo, num_missing,
+                                 Path(work_dir, f'mk_html_{rate}.out'))
+  results['mk_term_info'] = run_stage([sys.executable, str(Path(project_dir, 'mk_term_info.py'))],
+                                      ingest_dir, env, conninfo, len(actives),
+                                      Path(work_dir, f'mk_term_info_{rate}.out'))
+  return results
+
+
+if __name__ == '__main__':
+  argparser = ArgumentParser('End-to-end ingestion load test on a temporary Postgres cluster')
+  argparser.add_argument('-n', '--num_blocks', type=int, default=20000)
+  argparser.add_argument('--rates', type=float, nargs='+', default=[0.001, 0.05, 1.0],
+                         help='fractions of the blocks changed in the next day’s extract')
+  argparser.add_argument('--seed', type=int, default=1)
+  argparser.add_argument('--port', type=int, default=54329)
+  argparser.add_argument('--pg_bin', type=Path, help='directory of initdb and pg_ctl')
+  argparser.add_argument('--ingest_args', type=shlex.split, default=[],
+                         help='more options for ingest_requirement_blocks.py, as one string')
+  argparser.add_argument('--repeats', type=int, default=5,
+                         help='blocks that appear twice in the next day’s extract')
+  argparser.add_argument('--json', type=Path, help='also write the results to this file')
+  argparser.add_argument('--keep', action='store_true',
+                         help='keep the work directory, with the stage outputs and logs')
+  args = argparser.parse_args()
+
+  work_dir = Path(tempfile.mkdtemp(prefix='load_test_'))
+  rng = random.Random(args.seed)
+  today = datetime.date.today()
+  all_results = dict()
+  cluster = Cluster(Path(work_dir, 'cluster'), args.pg_bin or pg_bindir(), args.port)
+  try:
+    # The prior-day snapshot, kept as a template database to reset to for each rate.
+    create_schema(cluster, seed_db)
+    blocks = req_block_rows(rng, args.num_blocks, default_mix, today - datetime.timedelta(days=1))
+    seed_dir = Path(work_dir, 'seed')
+    prior_extract, _ = write_extracts(seed_dir, blocks, [], schema_columns())
+    num_seeded = seed_blocks(cluster.conninfo(seed_db), prior_extract)
+    cluster.psql('postgres', 'checkpoint')
+    print(f'Seeded {num_seeded:,} blocks')
+
+    for rate in args.rates:
+      results = load_test(cluster, work_dir, blocks, rate, today, rng, args.ingest_args,
+                          args.repeats)
+      all_results[str(rate)] = results
+      print(f'\n{rate:.1%} changed')
+      print(f'  {"stage":<14}{"wall s":>9}{"cpu s":>9}{"rows":>10}{"rows/s":>11}{"WAL MB":>9}'
+            f'{"RSS MB":>9}')
+      for stage, result in results.items():
+        print(f'  {stage:<14}{result["wall_seconds"]:9.2f}{result["cpu_seconds"]:9.2f}'
+              f'{result["rows"]:10,}{result["rows_per_second"]:11,.0f}'
+              f'{result["wal_bytes"] / 1e6:9.1f}{result["peak_rss_mb"]:9.1f}')
+  finally:
+    cluster.stop()
+    if args.keep:
+      print(f'\nWork directory: {work_dir}')
+    else:
+      shutil.rmtree(work_dir)
+
+  if args.json:
+    args.json.write_text(json.dumps(all_results, indent=2))
@@ -0,0 +1,80 @@
+"""Check block_transforms.normalize_text() against the rstrip/decruft chain it replaced; time both.
+
+The corpus is the requirement_text of every block in the archived dgw_dap_req_block extracts given
+on the command line (default: all of them in archives/). Any block the two normalizers disagree
+on is reported, and the run exits with a non-zero status.
+
+Run it from the project directory: python -m benchmarks.normalizer [extract ...]
+"""
+
+import re
+import sys
+import time
+
+from argparse import ArgumentParser
+from pathlib import Path
+
+from block_transforms import normalize_text
+from extract_reader import ExtractReader
+
+# The normalizer as it was: csv_generator’s rstrip, then decruft().
+trans_dict = dict()
+for c in range(14, 31):
+  trans_dict[c] = None
+cruft_table = str.maketrans(trans_dict)
+
+
+def legacy_decruft(block):
+  """Remove chars in the range 0x0e through 0x1e and return the block otherwise unchanged."""
+  return_block = block.translate(cruft_table)
+  return_block = return_block.replace('\t', ' ').replace("'", '’')
+  return_block = re.sub(r'[Ee][Nn][Dd]\.(.|\n)*', 'END.\n', return_block)
+  return return_block
+
+
+def legacy_normalize_text(requirement_text):
+  """Trim trailing whitespace from the lines of a block’s text, then decruft it."""
+  return legacy_decruft('\n'.join([scribe_line.rstrip()
+                                   for scribe_line in requirement_text.split('\n')]))
+
+
+# time_normalizer()
+# -------------------------------------------------------------------------------------------------
+def time_normalizer(normalizer, texts: list, repeat: int) -> float:
+  """Return the best of repeat times to normalize all the texts."""
+  best = float('inf')
+  for _ in range(repeat):
+    start = time.perf_counter()
+    for text in texts:
+      normalizer(text)
+    best = min(best, time.perf_counter() - start)
+  return best
+
+
+if __name__ == '__main__':
+  argparser = ArgumentParser('Check and time the Scribe text normalizer')
+  argparser.add_argument('extracts', nargs='*', type=Path,
+                         default=sorted(Path('archives').glob('dgw_dap_req_block*')))
+  argparser.add_argument('-r', '--repeat', type=int, default=3)
+  args = argparser.parse_args()
+
+  texts = []
+  num_mismatches = 0
+  for extract in args.extracts:
+    for row in ExtractReader(extract):
+      requirement_text = row.requirement_text
+      texts.append(requirement_text)
+      if normalize_text(requirement_text) != legacy_normalize_text(requirement_text):
+        num_mismatches += 1
+        print(f'{extract.name} {row.institution} {row.requirement_id}: MISMATCH')
+  if not texts:
+    sys.exit('No blocks found')
+
+  num_chars = sum(len(text) for text in texts)
+  print(f'{len(texts):,} blocks, {num_chars:,} chars from {len(args.extracts)} extract(s); '
+        f'{num_mismatches:,} mismatches')
+  for name, normalizer in [('legacy', legacy_normalize_text), ('fused', normalize_text)]:
+    elapsed = time_normalizer(normalizer, texts, args.repeat)
+    print(f'{name:>8}: {elapsed:8.3f} sec  {num_chars / elapsed / 1e6:8.1f} M chars/sec')
+
+  sys.exit(1 if num_mismatches else 0)
@@ -0,0 +1,267 @@
+"""Generate synthetic dgw_dap_req_block.csv and dgw_ir_active_requirements.csv extracts.
+
+The dap_req_block columns are the ones listed in dap_req_block.schema.csv, in that order. Block
+texts are Scribe-like, with line counts drawn from a log-normal distribution (a few very long
+CLOBs, many short ones), and some of them have the things real extracts have that the ingester has
+to deal with: text following END., control characters, tabs, primes, and trailing whitespace.
+Blocks are spread over the institutions in proportion to the weights of the institution mix. The
+active requirements file lists some of the blocks, with enrollments for a few recent terms.
+
+The same seed gives the same files, so runs of the benchmarks can be compared.
+
+Run it from the project directory:
+  python -m benchmarks.synthetic_extracts -n 50000 -o /tmp/synthetic
+  python -m benchmarks.synthetic_extracts --mix QNS01=3,LEH01=1 --trailer_rate 0.2
+"""
+
+import csv
+import datetime
+import math
+import random
+import sys
+
+from argparse import ArgumentParser
+from pathlib import Path
+
+# Default institution mix: the DegreeWorks colleges, the senior colleges weighted more heavily.
+default_mix = {'BAR01': 4, 'BCC01': 2, 'BKL01': 4, 'BMC01': 3, 'CSI01': 3, 'CTY01': 4, 'HOS01': 1,
+               'HTR01': 4, 'JJC01': 3, 'KCC01': 2, 'LAG01': 2, 'LEH01': 3, 'MEC01': 2, 'NCC01': 1,
+               'NYT01': 3, 'QCC01': 2, 'QNS01': 4, 'SLU01': 1, 'SPS01': 2, 'YRK01': 2}
+
+block_types = ['MAJOR', 'MAJOR', 'MINOR', 'CONC', 'DEGREE', 'OTHER', 'LIBL', 'SCHOOL']
+subjects = ['ACCT', 'ANTH', 'ARTH', 'BIOL', 'CHEM', 'CSCI', 'ECON', 'ENGL', 'HIST', 'MATH', 'PHIL',
+            'PHYS', 'PSYC', 'SOC', 'SPAN']
+
+# Scribe-like body lines; each block is mostly drawn from these.
+line_templates = [
+  '  {n} Credits in {subject} {number}@ (With DWCredits>=3)',
+  '  1 Class in {subject} {number}',
+  '  {n} Classes in {subject} {number}, {subject} {number2}',
+  '  BeginSub',
+  '  EndSub',
+  '    Label "{subject} {number} requirement";',
+  '  RuleTag Category=Core',
+  '  MinGrade 2.0',
+  '  MinRes {n} Credits',
+  '  # Updated for the {year} catalog',
+  '  Remark "Students who entered before {year} should see their advisor.";',
+  '  If (ConcCode = "{subject}") then',
+]
+trailer_lines = ['', '# Previous version', 'BEGIN', '  1 Class in {subject} {number}', 'END.']
+
+
+# schema_columns()
+# -------------------------------------------------------------------------------------------------
+def schema_columns(schema: Path = Path('dap_req_block.schema.csv')) -> list:
+  """Return the dap_req_block column names, in order, from the schema file."""
+  with schema.open(newline='') as schema_file:
+    return [row['Field'] for row in csv.DictReader(schema_file)]
+
+
+# parse_mix()
+# -------------------------------------------------------------------------------------------------
+def parse_mix(mix: str) -> dict:
+  """Convert INST=weight,... to a dict."""
+  weights = dict()
+  for item in mix.split(','):
+    institution, _, weight = item.partition('=')
+    weights[institution.strip().upper()] = float(weight or 1)
+  return weights
+
+
+def _fill(rng: random.Random, template: str) -> str:
+  """Fill in a line template with random values."""
+  return template.format(n=rng.randint(1, 60), subject=rng.choice(subjects),
+                         number=rng.randint(100, 499), number2=rng.randint(100, 499),
+                         year=rng.randint(2012, 2026))
+
+
+# scribe_text()
+# -------------------------------------------------------------------------------------------------
+def scribe_text(rng: random.Random, num_lines: int, trailer: bool, cruft: bool) -> str:
+  """Generate the requirement_text of a block with (about) num_lines lines."""
+  lines = ['# Scribe block', 'BEGIN']
+  lines += [_fill(rng, rng.choice(line_templates)) for _ in range(max(num_lines - 3, 0))]
+  if rng.random() < 0.1:
+    # Trailing whitespace, tabs, and primes, which normalize_text() deals with
+    lines = [f'{line}  ' if rng.random() < 0.2 else line.replace('  ', '\t', 1)
+             for line in lines]
+    lines.append("  Remark \"Student's choice\";")
+  if cruft:
+    index = rng.randrange(len(lines))
+    position = rng.randint(0, len(lines[index]))
+    lines[index] = lines[index][:position] + chr(rng.randint(14, 30)) + lines[index][position:]
+  lines.append(rng.choice(['END.', 'End.', 'END.  ']))
+  if trailer:
+    lines += [_fill(rng, line) for line in trailer_lines] * rng.randint(1, 5)
+  return '\n'.join(lines)
+
+
+# req_block_rows()
+# -------------------------------------------------------------------------------------------------
+def req_block_rows(rng: random.Random, num_blocks: int, mix: dict, load_date: datetime.date,
+                   mean_lines: float = 60, sigma: float = 1.0, max_lines: int = 5000,
+                   trailer_rate: float = 0.05, cruft_rate: float = 0.02) -> list:
+  """Return num_blocks dicts of dap_req_block column values, for the institutions in mix.
+
+  The number of lines in a block’s text is log-normal, with median mean_lines, capped at
+  max_lines.
+  """
+  institutions = list(mix.keys())
+  weights = list(mix.values())
+  next_id = {institution: 1 for institution in institutions}
+  rows = []
+  for institution in rng.choices(institutions, weights, k=num_blocks):
+    requirement_id = f'RA{next_id[institution]:06}'
+    next_id[institution] += 1
+    block_type = rng.choice(block_types)
+    subject = rng.choice(subjects)
+    degree = rng.choice(['BA', 'BS', 'AA', 'AS'])
+    block_value = f'{subject}-{degree}' if block_type in {'MAJOR', 'CONC'} else f'{subject}-MIN'
+    first_year = rng.randint(2012, 2026)
+    parse_date = load_date - datetime.timedelta(days=int(rng.expovariate(1 / 400)))
+    num_lines = min(max_lines, max(3, int(rng.lognormvariate(math.log(mean_lines), sigma))))
+    text = scribe_text(rng, num_lines, rng.random() < trailer_rate, rng.random() < cruft_rate)
+    rows.append({
+      'REQUIREMENT_ID': requirement_id,
+      'BLOCK_TYPE': block_type,
+      'BLOCK_VALUE': block_value,
+      'TITLE': f'{block_type.title()} in {subject}',
+      'PERIOD_START': f'{first_year}-{first_year + 1}U',
+      'PERIOD_STOP': '99999999' if rng.random() < 0.8 else f'{first_year + 4}-{first_year + 5}U',
+      'SCHOOL': 'U',
+      'DEGREE': degree,
+      'COLLEGE': institution[0:2],
+      'MAJOR1': block_value if block_type == 'MAJOR' else '',
+      'PARSE_DATE': parse_date.isoformat(),
+      'LOCK_VERSION': str(rng.randint(1, 20)),
+      'REQUIREMENT_TEXT': text,
+      'CREATE_DATE': parse_date.isoformat(),
+      'MODIFY_DATE': parse_date.isoformat(),
+      'INSTITUTION': institution,
+      'IRDW_LOAD_DATE': load_date.isoformat(),
+    })
+  return rows
+
+
+# next_day_rows()
+# -------------------------------------------------------------------------------------------------
+def next_day_rows(rng: random.Random, blocks: list, change_rate: float,
+                  load_date: datetime.date, num_repeats: int = 0) -> list:
+  """Return the blocks as they might be in the next day’s extract, with load_date as its date.
+
+  A change_rate fraction of the blocks are changed, and their parse_date set to load_date. Most of
+  the changes are to a few lines of the text; one in ten changes just the metadata (period_stop).
+  Another row for each of num_repeats blocks, with a line added to its text, goes at the end.
+  """
+  next_day = []
+  for block in blocks:
+    block = dict(block, IRDW_LOAD_DATE=load_date.isoformat())
+    if rng.random() < change_rate:
+      block['PARSE_DATE'] = load_date.isoformat()
+      if rng.random() < 0.1:
+        block['PERIOD_STOP'] = '99999999' if block['PERIOD_STOP'] != '99999999' else '2029-2030U'
+      else:
+        lines = block['REQUIREMENT_TEXT'].split('\n')
+        # Leave the first and last couple of lines alone.
+        for _ in range(max(1, len(lines) // 20)):
+          if len(lines) > 4:
+            lines[rng.randrange(2, len(lines) - 2)] = _fill(rng, rng.choice(line_templates))
+        block['REQUIREMENT_TEXT'] = '\n'.join(lines)
+    next_day.append(block)
+  for block in rng.sample(next_day, min(num_repeats, len(next_day))):
+    lines = block['REQUIREMENT_TEXT'].split('\n')
+    lines.insert(2, _fill(rng, rng.choice(line_templates)))
+    next_day.append(dict(block, PARSE_DATE=load_date.isoformat(),
+                         REQUIREMENT_TEXT='\n'.join(lines)))
+  return next_day
+
+
+# active_rows()
+# -------------------------------------------------------------------------------------------------
+def active_rows(rng: random.Random, blocks: list, load_date: datetime.date,
+                active_rate: float = 0.6, num_terms: int = 6) -> list:
+  """Return dgw_ir_active_requirements rows for a fraction of the blocks.
+
+  Each active block gets enrollments for some of the last num_terms terms (CUNY term codes: 1,
+  two-digit year, 2/6/9 for spring/summer/fall). A few rows are for non-RA pseudo-requirements,
+  which mk_term_info.py ignores.
+  """
+  terms = [f'1{year % 100:02}{month}' for year in range(load_date.year - 3, load_date.year + 1)
+           for month in (2, 6, 9)][-num_terms:]
+  rows = []
+  for block in blocks:
+    if rng.random() < active_rate:
+      for term in rng.sample(terms, rng.randint(1, len(terms))):
+        rows.append((block['INSTITUTION'], block['REQUIREMENT_ID'], term,
+                     str(int(rng.paretovariate(1.2))), load_date.isoformat()))
+  for institution in sorted({block['INSTITUTION'] for block in blocks}):
+    rows.append((institution, 'STUINFO', terms[-1], '1', load_date.isoformat()))
+  return rows
+
+
+# write_extracts()
+# -------------------------------------------------------------------------------------------------
+def write_extracts(output_dir: Path, blocks: list, actives: list, columns: list) -> tuple:
+  """Write the two extracts; return their paths."""
+  output_dir.mkdir(parents=True, exist_ok=True)
+  req_block_path = Path(output_dir, 'dgw_dap_req_block.csv')
+  with req_block_path.open('w', newline='') as req_block_file:
+    writer = csv.DictWriter(req_block_file, fieldnames=columns, restval='')
+    writer.writeheader()
+    writer.writerows(blocks)
+  active_path = Path(output_dir, 'dgw_ir_active_requirements.csv')
+  with active_path.open('w', newline='') as active_file:
+    writer = csv.writer(active_file, delimiter='|')
+    writer.writerow(['INSTITUTION', 'DAP_REQ_ID', 'DAP_ACTIVE_TERM', 'DISTINCT_STUDENTS',
+                     'IRDW_LOAD_DATE'])
+    writer.writerows(actives)
+  return req_block_path, active_path
+
+
+# generate_extracts()
+# -------------------------------------------------------------------------------------------------
+def generate_extracts(output_dir: Path, num_blocks: int, seed: int = 1,
+                      load_date: datetime.date = None, mix: dict = None, active_rate: float = 0.6,
+                      schema: Path = Path('dap_req_block.schema.csv'), **options) -> tuple:
+  """Generate and write both extracts; return their paths.
+
+  The options are those of req_block_rows().
+  """
+  rng = random.Random(seed)
+  load_date = load_date or datetime.date.today()
+  blocks = req_block_rows(rng, num_blocks, mix or default_mix, load_date, **options)
+  actives = active_rows(rng, blocks, load_date, active_rate)
+  return write_extracts(output_dir, blocks, actives, schema_columns(schema))
+
+
+if __name__ == '__main__':
+  argparser = ArgumentParser('Generate synthetic extracts')
+  argparser.add_argument('-o', '--output_dir', type=Path, default=Path('synthetic'))
+  argparser.add_argument('-n', '--num_blocks', type=int, default=10000)
+  argparser.add_argument('--seed', type=int, default=1)
+  argparser.add_argument('--date', type=datetime.date.fromisoformat, default=datetime.date.today(),
+                         help='irdw_load_date of the extracts')
+  argparser.add_argument('--mix', type=parse_mix,
+                         help='institution weights, as INST=weight,... (default: all colleges)')
+  argparser.add_argument('--mean_lines', type=float, default=60,
+                         help='median number of lines in a block')
+  argparser.add_argument('--sigma', type=float, default=1.0,
+                         help='spread of the log-normal distribution of block lengths')
+  argparser.add_argument('--max_lines', type=int, default=5000)
+  argparser.add_argument('--trailer_rate', type=float, default=0.05,
+                         help='fraction of blocks with text after END.')
+  argparser.add_argument('--cruft_rate', type=float, default=0.02,
+                         help='fraction of blocks with a control character')
+  argparser.add_argument('--active_rate', type=float, default=0.6,
+                         help='fraction of blocks in the active requirements file')
+  argparser.add_argument('--schema', type=Path, default=Path('dap_req_block.schema.csv'))
+  args = argparser.parse_args()
+
+  if not args.schema.is_file():
+    sys.exit(f'{args.schema} not found: run this from the project directory')
+  for path in generate_extracts(args.output_dir, args.num_blocks, args.seed, args.date, args.mix,
+                                args.active_rate, args.schema, mean_lines=args.mean_lines,
+                                sigma=args.sigma, max_lines=args.max_lines,
+                                trailer_rate=args.trailer_rate, cruft_rate=args.cruft_rate):
+    print(f'{path}: {path.stat().st_size / 1e6:,.1f} MB')
@@ -0,0 +1,105 @@
+"""In-memory index of the requirement_blocks table, used for change detection during ingestion.
+
+Rather than querying the database once per row of the dap_req_block extract, the key columns of
+every block are streamed once, at the start of the run, into a dict keyed by (institution,
+requirement_id). Blocks are represented by the text_digest and metadata_digest columns that the
+ingester maintains, so no CLOBs cross the wire unless a block has actually changed.
+"""
+
+import hashlib
+
+from collections import namedtuple
+
+# The metadata fields whose changes trigger an update (and get logged).
+metadata_fields = ['block_type', 'block_value', 'major1', 'period_start', 'period_stop']
+
+# Separates metadata values when computing their digest. Must match metadata_digest_sql.
+_separator = chr(0x1f)
+
+# SQL expressions for computing the digests of blocks that don’t have them yet; they produce the
+# same values as text_digest() and metadata_digest().
+text_digest_sql = 'md5(requirement_text)'
+metadata_digest_sql = ('md5(concat_ws(chr(31), '
+                       + ', '.join(f"coalesce({field}, '')" for field in metadata_fields)
+                       + '))')
+
+IndexEntry = namedtuple('IndexEntry', 'parse_date text_digest metadata_digest')
+
+
+# text_digest()
+# -------------------------------------------------------------------------------------------------
+def text_digest(requirement_text: str) -> str:
+  """Return the fingerprint of a block’s (decrufted) text; the same value as Postgres md5()."""
+  return hashlib.md5(requirement_text.encode('utf-8')).hexdigest()
+
+
+# table_metadata_digest_sql()
+# -------------------------------------------------------------------------------------------------
+def table_metadata_digest_sql(table: str) -> str:
+  """metadata_digest_sql with the fields qualified by a table name or alias, for joins."""
+  return ('md5(concat_ws(chr(31), '
+          + ', '.join(f"coalesce({table}.{field}, '')" for field in metadata_fields)
+          + '))')
+
+
+# metadata_digest()
+# -------------------------------------------------------------------------------------------------
+def metadata_digest(row) -> str:
+  """Return the fingerprint of the tracked metadata fields of a row."""
+  values = [getattr(row, field) or '' for field in metadata_fields]
+  return text_digest(_separator.join(values))
+
+
+# prefetch_index()
+# -------------------------------------------------------------------------------------------------
+def prefetch_index(conn, institution: str = None) -> dict:
+  """Stream the digests of all requirement_blocks into a dict keyed by (inst, req_id).
+
+  Uses a server-side cursor so the result set is fetched in chunks instead of all at once. Digests
+  missing from the table (rows not yet touched by the ingester) are computed by the server. If an
+  institution is given, only its blocks are indexed.
+  """
+  where_clause = '' if institution is None else 'where institution = %s'
+  block_index = dict()
+  with conn.cursor(name='block_index') as cursor:
+    cursor.itersize = 10000
+    cursor.execute(f"""
+    select institution, requirement_id, parse_date,
+           coalesce(text_digest, {text_digest_sql}),
+           coalesce(metadata_digest, {metadata_digest_sql})
+      from requirement_blocks
+      {where_clause}
+    """, [] if institution is None else [institution])
+    for block_institution, requirement_id, *values in cursor:
+      block_index[(block_institution, requirement_id)] = IndexEntry._make(values)
+
+  return block_index
+
+
+# fetch_previous()
+# -------------------------------------------------------------------------------------------------
+def fetch_previous(cursor, institution: str, requirement_id: str, with_text: bool = False):
+  """Get the stored metadata, and optionally the text, of a block whose digest(s) changed.
+
+  The text is needed only for generating the history diff when a block’s text changed.
+  """
+  cursor.execute(_previous_query(with_text), (institution, requirement_id))
+  return cursor.fetchone()
+
+
+async def fetch_previous_async(cursor, institution: str, requirement_id: str,
+                               with_text: bool = False):
+  """The same thing as fetch_previous(), for a cursor of an AsyncConnection."""
+  await cursor.execute(_previous_query(with_text), (institution, requirement_id))
+  return await cursor.fetchone()
+
+
+def _previous_query(with_text: bool) -> str:
+  """The query used by fetch_previous()."""
+  text_col = ', requirement_text' if with_text else ''
+  return f"""
+  select {', '.join(metadata_fields)}{text_col}
+    from requirement_blocks
+   where institution = %s
+     and requirement_id = %s
+  """
@@ -0,0 +1,148 @@
+"""The CPU-bound, per-block transformations done during ingestion.
+
+These are pure functions of their arguments, so they can be run in worker processes: the ingester
+hands them chunks of blocks through a ProcessPoolExecutor (see chunk_map()) and gets the
+results back in order, while it does all the database work itself on a single connection.
+"""
+
+import re
+
+from collections import deque
+from itertools import islice
+
+from block_index import text_digest
+from line_diff import context_diff, matching_blocks, opcodes, replaced_middle
+
+# Deal with incoming data-encoding issues: drop chars 0x0e through 0x1e, replace tabs with spaces,
+# and primes with u2019, all in one translate() pass.
+trans_dict = dict()
+for c in range(14, 31):
+  trans_dict[c] = None
+trans_dict[ord('\t')] = ' '
+trans_dict[ord("'")] = '’'
+scribe_table = str.maketrans(trans_dict)
+
+# The first END. of a block, as it will be once the chars dropped by scribe_table are gone. Finding
+# it before translating means the text following it never has to be processed at all.
+end_re = re.compile(r'e[\x0e-\x1e]*n[\x0e-\x1e]*d[\x0e-\x1e]*\.', re.I | re.A)
+
+
+# decruft()
+# -------------------------------------------------------------------------------------------------
+def decruft(block):
+  """Remove chars in the range 0x0e through 0x1e and return the block otherwise unchanged.
+
+  This is the same thing strip_file does, which has to be run before this program for xml files. But
+  for csv files where strip_files wasn’t run, this makes the text cleaner, avoiding possible
+  parsing problems.
+
+  Tabs become spaces and primes become u2019. All text following END. (which needs/wants never to
+  be seen, and which messes up parsing anyway) is dropped. (The preprocessor does this again. No
+  harm done.)
+  """
+  if match := end_re.search(block):
+    return block[:match.start()].translate(scribe_table) + 'END.\n'
+  return block.translate(scribe_table)
+
+
+# normalize_text()
+# -------------------------------------------------------------------------------------------------
+def normalize_text(requirement_text: str) -> str:
+  """Trim trailing whitespace from the lines of a block’s Scribe text, and decruft it.
+
+  Trailing whitespace was messing up checking for changes to the blocks at one point. The result
+  is the same as decruft() of the trimmed text, but the text is truncated at END. first, and then
+  trimmed and translated with one pass each over what’s left.
+  """
+  if match := end_re.search(requirement_text):
+    # The line END. is on is cut short before it, so it doesn’t get trimmed.
+    *lines, last_line = requirement_text[:match.start()].split('\n')
+    lines = [scribe_line.rstrip() for scribe_line in lines] + [last_line]
+    return '\n'.join(lines).translate(scribe_table) + 'END.\n'
+
+  lines = [scribe_line.rstrip() for scribe_line in requirement_text.split('\n')]
+  return '\n'.join(lines).translate(scribe_table)
+
+
+# normalize_blocks()
+# -------------------------------------------------------------------------------------------------
+def normalize_blocks(blocks: list) -> list:
+  """Normalize a chunk of (requirement_text, title) pairs.
+
+  Returns a list of (requirement_text, title, text_digest) tuples.
+  """
+  normalized = []
+  for requirement_text, title in blocks:
+    requirement_text = normalize_text(requirement_text)
+    normalized.append((requirement_text, decruft(title), text_digest(requirement_text)))
+
+  return normalized
+
+
+# chunk_map()
+# -------------------------------------------------------------------------------------------------
+def chunk_map(func, chunks, executor=None, window: int = 2, extract=None):
+  """Generate (chunk, result) pairs for an iterable of chunks, in order.
+
+  The result is func(chunk), or func(extract(chunk)) if extract is given, which lets the caller
+  send the workers just the (picklable) values they need. With an executor, func runs in its worker
+  processes with up to window chunks in flight at once, so memory use stays bounded.
+  """
+  if executor is None:
+    for chunk in chunks:
+      yield chunk, func(extract(chunk) if extract else chunk)
+    return
+
+  chunks = iter(chunks)
+  in_flight = deque()
+  while True:
+    while len(in_flight) < window and (chunk := next(chunks, None)) is not None:
+      in_flight.append((chunk, executor.submit(func, extract(chunk) if extract else chunk)))
+    if not in_flight:
+      return
+    chunk, future = in_flight.popleft()
+    yield chunk, future.result()
+
+
+# normalized_chunks()
+# -------------------------------------------------------------------------------------------------
+def normalized_chunks(rows, executor=None, window: int = 2, chunk_size: int = 500):
+  """Generate (rows, normalized) pairs for successive chunks of the rows, in order.
+
+  The normalized list gives normalize_blocks() output for each row in the chunk.
+  """
+  rows = iter(rows)
+  chunks = iter(lambda: list(islice(rows, chunk_size)), [])
+  yield from chunk_map(normalize_blocks, chunks, executor, window,
+                       extract=lambda chunk: [(row.requirement_text, row.title) for row in chunk])
+
+
+# diff_texts()
+# -------------------------------------------------------------------------------------------------
+def diff_texts(texts: tuple, max_edits: int = 500, max_seconds: float = 1.0) -> tuple:
+  """Compare the (previous, new) texts of a block; return a change summary and the diff lines.
+
+  The diff is a context diff without context lines, done by line_diff.py within the given budget.
+  Over budget, the lines between the ones the texts start and end with in common are all shown as
+  replaced, and the summary says how many lines that is.
+  """
+  prev_text, requirement_text = texts
+  db_lines = [f'{line}\n' for line in prev_text.split('\n')]
+  new_lines = [f'{line}\n' for line in requirement_text.split('\n')]
+  prev_len = len(db_lines)
+  new_len = len(new_lines)
+  if prev_len < new_len:
+    changes_str = f'{new_len - prev_len} lines longer.'
+  elif (new_len < prev_len):
+    changes_str = f'{prev_len - new_len} lines shorter.'
+  else:
+    changes_str = f'{prev_len:,} lines.'
+
+  if (blocks := matching_blocks(db_lines, new_lines, max_edits, max_seconds)) is None:
+    blocks = replaced_middle(db_lines, new_lines)
+    num_replaced = prev_len - sum(size for _, _, size in blocks)
+    changes_str += f' Replaced {num_replaced:,} of {prev_len:,} lines (too many changes to diff).'
+  diff_lines = context_diff(db_lines, new_lines, opcodes(blocks), fromfile='previous',
+                            tofile='changed', n=0)
+
+  return changes_str, diff_lines
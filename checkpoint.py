@@ -0,0 +1,135 @@
+"""Durable checkpoints for ingestion runs, so that an interrupted run can be resumed.
+
+A checkpoint is a row of the ingest_checkpoints table giving the identity (md5 digest) of the
+extract being ingested, the byte offset just past the last row that has been handled, and the
+insert/update/failure counts up to there. The batch committer records it in the same transaction
+as each batch of writes (see batch_commit.py), so it always matches what the database actually
+has. Rows before the offset can be skipped by a resumed run; resuming from an earlier offset would
+do no harm either, as rows that were already ingested compare as unchanged.
+
+An extract counts as completed only if no block failed to be written: only then does the database
+fully reflect it, so that --delta can use it as the baseline for the next one.
+"""
+
+import hashlib
+import mmap
+
+from pathlib import Path
+
+_checkpoint_columns = ['extract_name', 'extract_digest', 'irdw_load_date', 'position',
+                       'num_inserted', 'num_updated', 'num_failed', 'completed']
+
+
+# extract_digest()
+# -------------------------------------------------------------------------------------------------
+def extract_digest(extract: Path) -> str:
+  """Return the md5 digest of an extract file’s contents."""
+  with extract.open('rb') as extract_file:
+    if extract.stat().st_size == 0:
+      return hashlib.md5().hexdigest()
+    with mmap.mmap(extract_file.fileno(), 0, access=mmap.ACCESS_READ) as data:
+      return hashlib.md5(data).hexdigest()
+
+
+# create_checkpoint_table()
+# -------------------------------------------------------------------------------------------------
+def create_checkpoint_table(cursor) -> None:
+  """Create the ingest_checkpoints table if it doesn’t exist yet."""
+  cursor.execute("""
+  create table if not exists ingest_checkpoints (
+    extract_name text primary key,
+    extract_digest text not null,
+    irdw_load_date date,
+    position bigint not null,
+    num_inserted integer not null,
+    num_updated integer not null,
+    num_failed integer not null default 0,
+    completed boolean not null,
+    checkpoint_time timestamptz default now())
+  """)
+  # Tables created before failures were counted
+  cursor.execute('alter table ingest_checkpoints add column if not exists num_failed integer '
+                 'not null default 0')
+
+
+# completed_digest()
+# -------------------------------------------------------------------------------------------------
+def completed_digest(cursor, extract_name: str) -> str:
+  """Return the digest of the last extract of this name to be ingested in full, if any.
+
+  In full means every row was handled and no block failed to be written.
+  """
+  cursor.execute("""
+  select extract_digest
+    from ingest_checkpoints
+   where extract_name = %s
+     and completed
+  """, (extract_name, ))
+  row = cursor.fetchone()
+  return None if row is None else row[0]
+
+
+class Checkpoint:
+  """The checkpoint of an ingestion run for one extract."""
+
+  def __init__(self, extract: Path):
+    """Identify the extract; the checkpoint starts at its beginning."""
+    self.extract_name = extract.name
+    self.extract_digest = extract_digest(extract)
+    self.irdw_load_date = None
+    self.position = 0
+    self.num_inserted = self.num_updated = self.num_failed = 0
+    self.completed = False
+    # The counts of the run(s) being resumed.
+    self.base_inserted = self.base_updated = self.base_failed = 0
+
+  def restore(self, conn) -> bool:
+    """Pick up where an earlier run on the same extract left off; return True if there was one."""
+    with conn.cursor() as cursor:
+      create_checkpoint_table(cursor)
+      cursor.execute(f"""
+      select {', '.join(_checkpoint_columns[2:])}
+        from ingest_checkpoints
+       where extract_name = %s
+         and extract_digest = %s
+      """, (self.extract_name, self.extract_digest))
+      row = cursor.fetchone()
+    conn.commit()
+    if row is None:
+      return False
+
+    (self.irdw_load_date, self.position, self.base_inserted, self.base_updated, self.base_failed,
+     self.completed) = row
+    self.num_inserted, self.num_updated = self.base_inserted, self.base_updated
+    self.num_failed = self.base_failed
+    return True
+
+  def advance(self, position: int, num_inserted: int, num_updated: int,
+              num_failed: int = 0) -> None:
+    """Note that the rows up to position have been handled, with these counts for this run."""
+    self.position = position
+    self.num_inserted = self.base_inserted + num_inserted
+    self.num_updated = self.base_updated + num_updated
+    self.num_failed = self.base_failed + num_failed
+
+  def statement(self) -> tuple:
+    """Return the (query, params) that record the checkpoint, for execution by the committer."""
+    vals = ', '.join(['%s'] * len(_checkpoint_columns))
+    set_args = ', '.join(f'{col} = excluded.{col}' for col in _checkpoint_columns[1:])
+    query = f"""
+    insert into ingest_checkpoints ({', '.join(_checkpoint_columns)}, checkpoint_time)
+    values ({vals}, now())
+    on conflict (extract_name) do update set {set_args}, checkpoint_time = now()
+    """
+    return query, (self.extract_name, self.extract_digest, self.irdw_load_date, self.position,
+                   self.num_inserted, self.num_updated, self.num_failed, self.completed)
+
+  def complete(self, conn, position: int, num_inserted: int, num_updated: int,
+               num_failed: int = 0) -> None:
+    """Record that all of the extract has been handled, as part of conn’s current transaction.
+
+    It is completed only if no block failed to be written, in this run or one it resumes.
+    """
+    self.advance(position, num_inserted, num_updated, num_failed)
+    self.completed = self.num_failed == 0
+    conn.execute(*self.statement())
@@ -0,0 +1,112 @@
+"""Connections to the cuny_curriculum database, from a pool shared by the stages of a run.
+
+The ingester opens the pool as soon as it starts, so the connections are being made while the
+extracts are being archived, rather than when each stage gets going. Ingestion, the shards of a
+sharded ingestion, mk_html, term_info, and the report all take their connections from it:
+
+  database = database_from_args(args)
+  with database.connection() as conn:
+    ...
+
+As with psycopg.connect(), a connection is committed at the end of the with block, or rolled back
+if there was an exception, before it goes back to the pool.
+
+The connection options are the same for every connection:
+  --dsn                the libpq connection string (default dbname=cuny_curriculum; PGHOST, etc.
+                       apply as usual)
+  --pool_size          the number of connections kept open
+  --statement_timeout  cancel statements that take longer than this (a PostgreSQL interval, such
+                       as 500ms or 10min; default none)
+  --prepare_threshold  prepare a query on the server once a connection has run it this many times
+                       (psycopg’s prepare_threshold; 0 prepares every query, and none never does)
+
+Prepared statements belong to their connection, so a pooled connection keeps the ones made by an
+earlier stage. A connection also keeps its temporary tables: ones that are not dropped on commit
+have to be created with “if not exists”.
+
+The asyncio pipeline gets its connections from an AsyncConnectionPool with the same options, made
+in its own event loop by async_pool().
+"""
+
+from psycopg_pool import AsyncConnectionPool, ConnectionPool
+
+default_dsn = 'dbname=cuny_curriculum'
+
+
+class Database:
+  """A pool of connections to the database, opened when first used."""
+
+  def __init__(self, dsn: str = default_dsn, pool_size: int = 2, statement_timeout: str = None,
+               prepare_threshold: int = 5):
+    """Nothing is connected until open() or the first connection()."""
+    self.dsn = dsn
+    self.pool_size = pool_size
+    self.statement_timeout = statement_timeout
+    self.prepare_threshold = prepare_threshold
+    self._pool = None
+
+  def connect_kwargs(self) -> dict:
+    """The options passed to psycopg for each connection."""
+    kwargs = {'prepare_threshold': self.prepare_threshold}
+    if self.statement_timeout:
+      kwargs['options'] = f'-c statement_timeout={self.statement_timeout}'
+    return kwargs
+
+  def open(self) -> None:
+    """Open the pool; its connections are made in the background."""
+    if self._pool is None:
+      self._pool = ConnectionPool(self.dsn, min_size=self.pool_size, max_size=self.pool_size,
+                                  kwargs=self.connect_kwargs(), open=True)
+
+  @property
+  def pool(self) -> ConnectionPool:
+    """The pool itself, for code that takes connections from it directly."""
+    self.open()
+    return self._pool
+
+  def connection(self):
+    """A connection from the pool, for a with block."""
+    return self.pool.connection()
+
+  def async_pool(self, size: int) -> AsyncConnectionPool:
+    """A pool of size AsyncConnections with the same options, to be opened with async with."""
+    return AsyncConnectionPool(self.dsn, min_size=size, max_size=size,
+                               kwargs=self.connect_kwargs(), open=False)
+
+  def close(self) -> None:
+    """Close the pool and its connections."""
+    if self._pool is not None:
+      self._pool.close()
+      self._pool = None
+
+  def __enter__(self):
+    """Use the database as a context manager that closes the pool."""
+    return self
+
+  def __exit__(self, *exc_info):
+    """Close the pool."""
+    self.close()
+
+
+# add_database_arguments()
+# -------------------------------------------------------------------------------------------------
+def add_database_arguments(parser, pool_size: int = 2) -> None:
+  """Add the connection options to a script’s ArgumentParser."""
+  parser.add_argument('--dsn', default=default_dsn,
+                      help=f'libpq connection string (default: {default_dsn})')
+  parser.add_argument('--pool_size', type=int, default=pool_size,
+                      help=f'database connections to keep open (default: {pool_size})')
+  parser.add_argument('--statement_timeout', metavar='INTERVAL',
+                      help='cancel statements that take longer than this, e.g. 10min')
+  parser.add_argument('--prepare_threshold', type=lambda arg: None if arg == 'none' else int(arg),
+                      default=5,
+                      help='prepare queries run this many times on a connection (default: 5; '
+                           '"none" to never prepare)')
+
+
+# database_from_args()
+# -------------------------------------------------------------------------------------------------
+def database_from_args(args, min_pool_size: int = 1) -> Database:
+  """The Database the command line asks for, with at least min_pool_size connections."""
+  return Database(args.dsn, max(args.pool_size, min_pool_size), args.statement_timeout,
+                  args.prepare_threshold)
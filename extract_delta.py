@@ -0,0 +1,83 @@
+#! /usr/local/bin/python3
+"""Find the blocks that differ between two dap_req_block extracts, without using the database.
+
+On a typical night only a few hundred of the tens of thousands of blocks change. Given the
+previous extract (from the archives directory) and the current one, both files are scanned in
+parallel and each block is fingerprinted; only blocks that were added or changed need to go through
+the ingester’s database logic. The irdw_load_date column is left out of the fingerprints, as it
+changes every day.
+
+The delta is only as good as the previous extract: it has to be the one that was last ingested in
+full. The ingester makes sure of that by matching it against the digest of its completed checkpoint
+(see checkpoint.py).
+"""
+
+from argparse import ArgumentParser
+from collections import namedtuple
+from concurrent.futures import ProcessPoolExecutor
+from pathlib import Path
+
+from checkpoint import extract_digest
+from extract_reader import ExtractReader
+
+# Columns that don’t count as changes
+_excluded_columns = ('irdw_load_date', )
+
+ExtractDelta = namedtuple('ExtractDelta', 'added changed removed')
+
+
+# block_fingerprints()
+# -------------------------------------------------------------------------------------------------
+def block_fingerprints(file, delimiter: str = ',', quotechar: str = '"') -> dict:
+  """Return a dict of fingerprints for the blocks of an extract, keyed by (inst, req_id)."""
+  return {(row.institution, row.requirement_id): row._fingerprint(_excluded_columns)
+          for row in ExtractReader(file, delimiter=delimiter, quotechar=quotechar)}
+
+
+# extract_delta()
+# -------------------------------------------------------------------------------------------------
+def extract_delta(previous, current, delimiter: str = ',', quotechar: str = '"') -> ExtractDelta:
+  """Compare two extracts, fingerprinting them in parallel; return the delta as sets of keys."""
+  with ProcessPoolExecutor(2) as executor:
+    previous_future = executor.submit(block_fingerprints, previous, delimiter, quotechar)
+    current_future = executor.submit(block_fingerprints, current, delimiter, quotechar)
+    previous_blocks = previous_future.result()
+    current_blocks = current_future.result()
+
+  added = current_blocks.keys() - previous_blocks.keys()
+  removed = previous_blocks.keys() - current_blocks.keys()
+  changed = {key for key in current_blocks.keys() & previous_blocks.keys()
+             if current_blocks[key] != previous_blocks[key]}
+  return ExtractDelta(added, changed, removed)
+
+
+# find_baseline()
+# -------------------------------------------------------------------------------------------------
+def find_baseline(archives_dir: Path, digest: str, max_tries: int = 3) -> Path:
+  """Find the archived dap_req_block extract with the given digest, or return None.
+
+  Only the most-recent few archives are checked, newest first: the one wanted is normally the
+  previous night’s.
+  """
+  archives = sorted(archives_dir.glob('dgw_dap_req_block_*.csv'), reverse=True)
+  for archive in archives[:max_tries]:
+    if extract_digest(archive) == digest:
+      return archive
+  return None
+
+
+if __name__ == '__main__':
+  """Show the delta between two extracts."""
+  argument_parser = ArgumentParser('Compare two dap_req_block extracts')
+  argument_parser.add_argument('previous')
+  argument_parser.add_argument('current')
+  argument_parser.add_argument('-v', '--verbose', action='store_true',
+                               help='list the keys, not just the counts')
+  args = argument_parser.parse_args()
+
+  delta = extract_delta(Path(args.previous), Path(args.current))
+  for kind, keys in delta._asdict().items():
+    print(f'{len(keys):6,} {kind}')
+    if args.verbose:
+      for institution, requirement_id in sorted(keys):
+        print(f'  {institution} {requirement_id}')
@@ -0,0 +1,214 @@
+"""Memory-mapped reader for OAREDA’s CSV extracts, dgw_dap_req_block.csv in particular.
+
+The file is mapped into memory and scanned for record and field boundaries. Once the header has
+given the number of columns, each record is matched by a single regular expression, so the scan is
+done by the re module rather than a field at a time in Python; records the expression doesn’t fit
+(text after a closing quote, or the wrong number of fields) are scanned field by field instead.
+Each record is handed back as a RowView, which holds just the offsets of its fields: a field is
+decoded only if (and when) its value is actually used, straight from the mapped file, so the large
+requirement_text CLOBs are never copied before being decoded. See the Used? column of
+dap_req_block.schema.csv for which fields those are.
+"""
+
+import hashlib
+import mmap
+import re
+
+from pathlib import Path
+
+
+class RowView:
+  """A record of the extract, whose fields are decoded on demand.
+
+  Fields are attributes, named by the (lower-cased) column headings, as for the namedtuple rows
+  csv_generator used to produce. The byte offset of the record following this one is _position.
+  ExtractReader hands back rows of a subclass made by _row_class(), where the fields are
+  properties: looking them up through __getattr__ costs a failed attribute lookup each time.
+  """
+
+  __slots__ = ('_data', '_fields', '_columns', '_position')
+
+  def __init__(self, data, fields: list, columns: dict, position: int = None):
+    """Remember where the fields are; columns maps names to field indexes."""
+    self._data = data
+    self._fields = fields
+    self._columns = columns
+    self._position = position
+
+  def __getattr__(self, name):
+    """Decode and return the named field."""
+    try:
+      field = self._fields[self._columns[name]]
+    except KeyError:
+      raise AttributeError(name) from None
+    return _decode(self._data, field)
+
+  def _asdict(self) -> dict:
+    """Decode all the fields."""
+    return {name: _decode(self._data, self._fields[index])
+            for name, index in self._columns.items()}
+
+  def _span(self, name: str) -> tuple:
+    """Return the (start, end) byte offsets of a field’s raw text, or None for an odd field."""
+    field = self._fields[self._columns[name]]
+    return None if isinstance(field, str) else field[0:2]
+
+  def _fingerprint(self, exclude=()) -> str:
+    """Return the md5 digest of the record’s raw (undecoded) fields, except the excluded ones."""
+    digest = hashlib.md5()
+    for name, index in self._columns.items():
+      if name not in exclude:
+        field = self._fields[index]
+        digest.update(field.encode('utf-8') if isinstance(field, str)
+                      else self._data[field[0]:field[1]])
+        digest.update(b'\x1f')
+    return digest.hexdigest()
+
+
+# _row_class()
+# -------------------------------------------------------------------------------------------------
+def _row_class(columns: dict) -> type:
+  """A subclass of RowView with a property for each column."""
+
+  def field_property(index: int) -> property:
+    """The property that decodes the field at index."""
+    return property(lambda row: _decode(row._data, row._fields[index]))
+
+  attributes = {name: field_property(index) for name, index in columns.items()
+                if name.isidentifier() and not name.startswith('_')}
+  return type('RowView', (RowView, ), {'__slots__': (), **attributes})
+
+
+# _decode()
+# -------------------------------------------------------------------------------------------------
+def _decode(data, field) -> str:
+  """Decode a field, given as (start, end, quote) or, in odd cases, as the already-decoded str.
+
+  If quote is not None, it’s a quoted field, whose doubled quotechars (if any) need undoubling.
+  """
+  if isinstance(field, str):
+    return field
+  start, end, quote = field
+  value = str(data[start:end], encoding='utf-8')
+  return value if quote is None else value.replace(quote + quote, quote)
+
+
+class ExtractReader:
+  """Iterate over the records of a CSV file as RowViews.
+
+  The first record gives the column names. The byte offset of the next record is available as the
+  position attribute, and the file’s size as size, for progress reporting. If start is given, it
+  is the offset of the first record to be generated, as given by the _position of an earlier
+  RowView.
+  """
+
+  def __init__(self, file, delimiter: str = ',', quotechar: str = '"', start: int = 0):
+    """Map the file into memory."""
+    self.path = Path(file)
+    self.size = self.path.stat().st_size
+    self.position = 0
+    self.start = start
+    self.delimiter = delimiter.encode('utf-8')
+    self.quotechar = quotechar.encode('utf-8')
+    # The text of an unquoted field runs up to the next delimiter or end of line.
+    self._unquoted = re.compile(rb'[^' + re.escape(self.delimiter) + rb'\r\n]*')
+    self._quote = quotechar
+    if self.size == 0:
+      self._map = b''
+    else:
+      # The mapping stays valid after the file is closed, for as long as RowViews refer to it.
+      with self.path.open('rb') as extract_file:
+        self._map = mmap.mmap(extract_file.fileno(), 0, access=mmap.ACCESS_READ)
+    # Fields are sliced from a memoryview of the mapping, which doesn’t copy them.
+    self._data = memoryview(self._map)
+    self.columns = None
+    self._record = None
+
+  def _record_pattern(self, num_fields: int):
+    """The regular expression for a whole well-formed record of num_fields fields.
+
+    Each field is either quoted, with group 2i + 1 its text between the quotes, or unquoted, with
+    group 2i + 2 its text.
+    """
+    delimiter = re.escape(self.delimiter)
+    quote = re.escape(self.quotechar)
+    field = (rb'(?:' + quote + rb'([^' + quote + rb']*(?:' + quote + quote + rb'[^' + quote
+             + rb']*)*)' + quote + rb'|(?!' + quote + rb')([^' + delimiter + rb'\r\n]*))')
+    return re.compile(delimiter.join([field] * num_fields) + rb'(?:\r\n|\n|\r|\Z)')
+
+  def _fields(self, pos: int) -> tuple:
+    """Scan the record starting at pos; return its list of fields and the next record’s offset."""
+    data = self._data
+    size = self.size
+    delimiter = self.delimiter
+    quotechar = self.quotechar
+    fields = []
+    while True:
+      if data[pos:pos + 1] == quotechar:
+        # Quoted field: find the closing quote, skipping over doubled quotes.
+        start = pos + 1
+        doubled = None
+        scan = start
+        while True:
+          end = self._map.find(quotechar, scan)
+          if end < 0:
+            raise ValueError(f'{self.path.name}: unterminated quoted field at byte {pos:,}')
+          if data[end + 1:end + 2] == quotechar:
+            doubled = quotechar.decode('utf-8')
+            scan = end + 2
+          else:
+            break
+        pos = end + 1
+        trailing = self._unquoted.match(data, pos).end()
+        if trailing > pos:
+          # Text after the closing quote: the csv module keeps it, so do the same.
+          fields.append(_decode(data, (start, end, doubled))
+                        + _decode(data, (pos, trailing, None)))
+          pos = trailing
+        else:
+          fields.append((start, end, doubled))
+      else:
+        end = self._unquoted.match(data, pos).end()
+        fields.append((pos, end, None))
+        pos = end
+
+      # What follows the field: delimiter, end of line, or end of file.
+      if pos >= size:
+        return fields, pos
+      if data[pos:pos + 1] == delimiter:
+        pos += 1
+        continue
+      if data[pos:pos + 2] == b'\r\n':
+        return fields, pos + 2
+      return fields, pos + 1
+
+  def __iter__(self):
+    """Generate the records following the header as RowViews."""
+    data = self._data
+    pos = 0
+    while pos < self.size:
+      if data[pos:pos + 1] in (b'\r', b'\n'):
+        # Skip blank line
+        pos += 2 if data[pos:pos + 2] == b'\r\n' else 1
+        continue
+      if self._record is not None and (match := self._record.match(data, pos)):
+        quote = self._quote
+        spans = match.regs
+        fields = [(quoted[0], quoted[1], quote) if quoted[0] >= 0 else (*unquoted, None)
+                  for quoted, unquoted in zip(spans[1::2], spans[2::2])]
+        pos = match.end()
+      else:
+        fields, pos = self._fields(pos)
+      self.position = pos
+      if self.columns is None:
+        self.columns = {_decode(data, field).lower().replace(' ', '_'): index
+                        for index, field in enumerate(fields)}
+        self._record = self._record_pattern(len(fields))
+        row_class = _row_class(self.columns)
+        # Skip to the starting record, if it’s past the header
+        pos = max(pos, self.start)
+        continue
+      if len(fields) != len(self.columns):
+        raise ValueError(f'{self.path.name}: {len(fields)} fields instead of '
+                         f'{len(self.columns)} before byte {pos:,}')
+      yield row_class(data, fields, self.columns, pos)
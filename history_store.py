@@ -0,0 +1,177 @@
+#! /usr/local/bin/python3
+"""Append-only store of the changes to requirement blocks’ Scribe texts.
+
+This replaces the history directory’s one file per changed block: each diff is a row of an SQLite
+database, history/history.db by default, indexed by (institution, requirement_id, parse_date), with
+the diff zlib-compressed.
+
+The ingester doesn’t write to the database itself: a HistoryWriter takes the diffs, from any
+thread, and a background thread inserts them in batches, so history writes stay out of the way of
+the ingestion loop. As with the history files, a block changed twice on the same parse date keeps
+only the later of the two diffs.
+
+  history_store.py QNS01 RA000123         The change timeline of a block
+  history_store.py -d QNS01 RA000123      ... with the diffs
+  history_store.py --import history/      Load history files written before the store existed
+"""
+
+import queue
+import sqlite3
+import sys
+import threading
+import zlib
+
+from argparse import ArgumentParser
+from pathlib import Path
+
+default_path = Path('history', 'history.db')
+
+
+# open_store()
+# -------------------------------------------------------------------------------------------------
+def open_store(path: Path = default_path) -> sqlite3.Connection:
+  """Connect to the history database, creating it if need be."""
+  path.parent.mkdir(parents=True, exist_ok=True)
+  conn = sqlite3.connect(path)
+  conn.execute("""
+  create table if not exists block_history (
+    institution text not null,
+    requirement_id text not null,
+    parse_date text not null,
+    days_ago integer,
+    changes text,
+    diff blob not null,
+    primary key (institution, requirement_id, parse_date))
+  """)
+  return conn
+
+
+def _insert(conn: sqlite3.Connection, records: list) -> None:
+  """Insert history records, replacing any already there for the same block and date, and commit."""
+  conn.executemany("""
+  insert into block_history (institution, requirement_id, parse_date, days_ago, changes, diff)
+  values (?, ?, ?, ?, ?, ?)
+  on conflict (institution, requirement_id, parse_date)
+  do update set days_ago = excluded.days_ago, changes = excluded.changes, diff = excluded.diff
+  """, records)
+  conn.commit()
+
+
+class HistoryWriter:
+  """Write history records to the store in batches, from a background thread."""
+
+  def __init__(self, path: Path = default_path, batch_size: int = 500):
+    """Start the writer thread."""
+    self.path = path
+    self.batch_size = batch_size
+    self._queue = queue.Queue()
+    self._error = None
+    self._thread = threading.Thread(target=self._run, name='history_writer', daemon=True)
+    self._thread.start()
+
+  def write(self, institution: str, requirement_id: str, parse_date, days_ago: int,
+            diff_lines: list, changes: str = None) -> None:
+    """Queue the diff of a block whose text changed."""
+    diff = zlib.compress(''.join(diff_lines).encode('utf-8'))
+    self._queue.put((institution, requirement_id, str(parse_date), days_ago, changes, diff))
+
+  def _run(self) -> None:
+    """Insert queued records until close() sends None."""
+    try:
+      conn = open_store(self.path)
+      done = False
+      while not done:
+        # Wait for one record, then take whatever else is waiting, up to the batch size.
+        records = []
+        record = self._queue.get()
+        while record is not None:
+          records.append(record)
+          if len(records) >= self.batch_size:
+            break
+          try:
+            record = self._queue.get_nowait()
+          except queue.Empty:
+            break
+        done = record is None
+        if records:
+          _insert(conn, records)
+      conn.close()
+    except Exception as error:
+      self._error = error
+
+  def __enter__(self):
+    """Use the writer as a context manager that closes it."""
+    return self
+
+  def __exit__(self, *exc_info):
+    """Close the writer."""
+    self.close()
+
+  def close(self) -> None:
+    """Wait for the queued records to be written; raise whatever went wrong writing them."""
+    self._queue.put(None)
+    self._thread.join()
+    if self._error is not None:
+      raise self._error
+
+
+# import_files()
+# -------------------------------------------------------------------------------------------------
+def import_files(conn: sqlite3.Connection, history_dir: Path) -> int:
+  """Add the history directory’s files, named {inst}_{reqid}_{parse_date}_{days_ago}, to the
+  store.
+
+  Returns the number of files found.
+  """
+  records = []
+  for history_file in history_dir.glob('*_*_*_*'):
+    institution, requirement_id, parse_date, days_ago = history_file.name.split('_')
+    diff = zlib.compress(history_file.read_bytes())
+    records.append((institution, requirement_id, parse_date, int(days_ago), None, diff))
+  _insert(conn, records)
+  return len(records)
+
+
+# timeline()
+# -------------------------------------------------------------------------------------------------
+def timeline(conn: sqlite3.Connection, institution: str, requirement_id: str) -> list:
+  """Return the (parse_date, days_ago, changes, diff) history of a block, oldest first."""
+  cursor = conn.execute("""
+  select parse_date, days_ago, changes, diff
+    from block_history
+   where institution = ?
+     and requirement_id = ?
+   order by parse_date
+  """, (institution, requirement_id))
+  return [(parse_date, days_ago, changes, zlib.decompress(diff).decode('utf-8'))
+          for parse_date, days_ago, changes, diff in cursor]
+
+
+if __name__ == '__main__':
+  """Show a block’s change timeline, or import old history files."""
+  argument_parser = ArgumentParser('Requirement block change history')
+  argument_parser.add_argument('institution', nargs='?')
+  argument_parser.add_argument('requirement_id', nargs='?')
+  argument_parser.add_argument('-d', '--diffs', action='store_true', help='show the diffs too')
+  argument_parser.add_argument('--db', type=Path, default=default_path)
+  argument_parser.add_argument('--import', dest='import_dir', type=Path,
+                               help='add the files in this directory to the store')
+  args = argument_parser.parse_args()
+
+  with open_store(args.db) as conn:
+    if args.import_dir:
+      num_files = import_files(conn, args.import_dir)
+      print(f'{num_files:,} history files imported')
+
+    if args.institution and args.requirement_id:
+      institution = f'{args.institution.upper()[0:3]}01'
+      requirement_id = f"RA{int(args.requirement_id.upper().strip('RA')):06}"
+      if not (history := timeline(conn, institution, requirement_id)):
+        sys.exit(f'No history for {institution} {requirement_id}')
+      for parse_date, days_ago, changes, diff in history:
+        days = '' if days_ago is None else f' ({days_ago} days after the previous version)'
+        print(f'{institution} {requirement_id} {parse_date}{days} {changes or ""}'.rstrip())
+        if args.diffs:
+          print(diff)
+    elif not args.import_dir:
+      argument_parser.print_usage()
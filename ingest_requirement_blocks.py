@@ -10,22 +10,49 @@ Preconditions
 Check the downloads directory. If it doesn’t have both dap_req_block and active_requirements CSVs,
 there is nothing to do. (If there is just one, alert sysop.)
   Archive both, and use them to replace whatever is in the latest_queries directory.
+  Once the report has been sent, archived extracts are also added to a content-addressable
+  store, archives/store, that keeps each distinct block text just once (see archive_store.py).
+  That reads each extract in full, so it is kept off the critical path; any extract an earlier run
+  didn’t get to is added then too, up to --store_backfill of them per run, newest first. Then only
+  the newest --keep_archives (7) plain copies of each extract that are in the store are kept in
+  archives/, unless --keep_all_archives; --delta needs the previous one.
 
 Ingest the dgw_dap_req block.csv file
   If a row is new, an entire new row is added to requirement_blocks.
   Otherwise, the dap_req_block row is checked for metadata and/or requirement_text changes; log
-  changes to the history directory.
+  text changes to the history store, history/history.db (see history_store.py).
   For each new block and each block where the requirement_text field changed:
     Set the dgw_parse_tree, dgw_seconds, dgw_timestamp, and requirement_html values to Null.
     Re-/parsing can take a long time to run, so doing that is deferred to a separate job.
       It may be better to include that in this job ... but not implemented yet.
+  With --bulk, the rows are COPYed into an unlogged staging table and the inserts and updates are
+  done set-wise (see staging_load.py); requirement_html is then left for mk_html.py to generate.
+  With --workers N, normalizing the text, rendering HTML, and diffing changed blocks are done in N
+  worker processes (see block_transforms.py); the database work stays on one connection, in order.
+  With --shards N, the rows are partitioned by institution and up to N institutions are ingested
+  concurrently, each on its own connection from the pool. All rows are checked against the
+  irdw_load_date before any shard starts.
+  With --pipeline, reading the extract, transforming the blocks, and the database work run as
+  stages of an asyncio pipeline with bounded queues between them, using AsyncConnections.
+  Progress is checkpointed with each batch commit. If a run is interrupted, --resume skips the rows
+  already handled (and the moving of the downloads, which has already been done).
+  With --delta, the extract is first compared with the last fully-ingested one in the archives
+  directory (see extract_delta.py), and only blocks that were added or changed are ingested.
+  The stages of the run take their database connections from a pool that is opened before the
+  extracts are archived (see db_pool.py); --dsn, --pool_size, --statement_timeout, and
+  --prepare_threshold configure it.
+  The wall and CPU time of each stage of the run, and of the hot operations within them, are
+  written next to the log as JSON (see stage_timing.py); --timing prints a summary of them too.
+  With --profile, each stage is also profiled (see profiling.py).
+  With --ingest_only, the run ends here, without the steps below, the email report, or adding to
+  the archive store, as when benchmarks/load_test.py runs and measures the steps one at a time.
+
+Generate any missing requirement_html fields in the requirement_blocks table, using mk_html.py’s
+generate_html() on the ingester’s own connection. (No matching rows expected.)
 
 Ingest the dgw_id_active_requirements.csv file
-  Invoke mk_term_info.py to replace (or initialize) the term_info dict for all current blocks.
-  Log the latest active term for missing blocks.
-
-Invoke mk_html.py to generate any missing requirement_html fields in the requirement_blocks table.
-(No matching rows expected.)
+  Use mk_term_info.py’s update_term_info() to replace (or initialize) the term_info dict for all
+  current blocks. Log the latest active term for missing blocks.
 
 ---------------------------------------------------------------------------------------------------
 It took some doing to get the dap_req_block files to transfer to the development system
@@ -65,92 +92,673 @@ Other Notes:
 """
 
 import argparse
-import csv
+import asyncio
 import datetime
-import difflib
-import json
+import io
 import os
-import psycopg
 import re
 import shutil
 import sys
 import time
 
-from collections import namedtuple
+from collections import defaultdict, namedtuple
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor, as_completed
+from contextlib import nullcontext
+from functools import partial
 from html2text import html2text
+from itertools import chain, islice
 from pathlib import Path
 from psycopg.rows import namedtuple_row
-from psycopg.types.json import Json
 from sendemail import send_email
-from subprocess import run
-
-from scribe_to_html import to_html
 
-# Deal with large CLOBS
-csv.field_size_limit(sys.maxsize)
-
-# Deal with incoming data-encoding issues
-trans_dict = dict()
-for c in range(14, 31):
-  trans_dict[c] = None
-cruft_table = str.maketrans(trans_dict)
+from archive_store import ArchiveStore, prune_archives
+from batch_commit import AsyncBatchCommitter, BatchCommitter
+from checkpoint import Checkpoint, completed_digest, create_checkpoint_table
+from block_index import (IndexEntry, fetch_previous, fetch_previous_async, metadata_digest,
+                         metadata_fields, prefetch_index)
+from block_transforms import diff_texts, normalize_blocks, normalized_chunks
+from db_pool import add_database_arguments, database_from_args
+from extract_delta import extract_delta, find_baseline
+from extract_reader import ExtractReader
+from history_store import HistoryWriter
+from mk_html import generate_html
+from mk_term_info import active_term_info, update_term_info
+from profiling import add_profile_arguments, profiler_from_args
+from scribe_to_html import cached_to_html_many
+from stage_timing import timings
+from staging_load import (copy_rows, create_staging_table, drop_duplicates, merge_staged,
+                          staged_changes, staging_cols)
 
 
 class Action:
-  """Container for insert/update bools."""
+  """What to do with one block of the extract, along with the values needed for doing it."""
 
-  def __init__(self):
-    """Initialize bools."""
+  def __init__(self, new_row, requirement_text: str, title: str, text_digest: str):
+    """Initialize insert/update bools, and the block’s normalized values."""
     self.do_insert = False
     self.do_update = False
+    self.text_is_changed = False
+    self.metadata_is_changed = False
+    self.new_row = new_row
+    self.requirement_text = requirement_text
+    self.title = title
+    self.text_digest = text_digest
+    self.metadata_digest = metadata_digest(new_row)
+    # When did the institution last parse the block?
+    self.parse_date = datetime.date.fromisoformat(new_row.parse_date)
+    self.prev_parse_date = None
+    self.prev_text = None
+    self.requirement_html = None
+    self.changes_str = ''
+    self.messages = []
 
 
-# decruft()
+# csv_generator()
 # -------------------------------------------------------------------------------------------------
-def decruft(block):
-  """Remove chars in the range 0x0e through 0x1f and return the block otherwise unchanged.
+def csv_generator(file, progress: bool = False, start: int = 0):
+  """Generate rows from a csv export of OIRA’s DAP_REQ_BLOCK table.
 
-  This is the same thing strip_file does, which has to be run before this program for xml files. But
-  for csv files where strip_files wasn’t run, this makes the text cleaner, avoiding possible parsing
-  problems.
+  The rows are RowViews over a memory map of the file (see extract_reader.py), so only the fields
+  actually used get decoded. If progress is requested, it’s displayed as the percentage of the
+  file’s bytes read so far, so there is no need to count the rows beforehand. The rows start at
+  byte offset start, if it’s given, as when resuming from a checkpoint.
   """
-  return_block = block.translate(cruft_table)
+  reader = ExtractReader(file, delimiter=args.delimiter, quotechar=args.quotechar, start=start)
+  file_size = max(reader.size, 1)
+  try:
+    for row_num, row in enumerate(reader, 1):
+      if progress:
+        print(f'\r{row_num:,} rows {100 * reader.position / file_size:5.1f}%', end='')
+      # The Scribe text gets normalized later, possibly in a worker process.
+      yield row
+  except ValueError as value_error:
+    sys.exit(f'{value_error}')
+
+
+# These are dap_req_block columns with OAREDA additions, plus requirement_html that gets added
+# here, but not dgw_parse_tree and dgw_seconds, which will be set by the parser.
+db_cols = ['institution', 'requirement_id', 'block_type', 'block_value', 'title', 'period_start',
+           'period_stop', 'school', 'degree', 'college', 'major1', 'major2', 'concentration',
+           'minor', 'liberal_learning', 'specialization', 'program', 'parse_status', 'parse_date',
+           'parse_who', 'parse_what', 'lock_version', 'requirement_text', 'requirement_html',
+           'irdw_load_date', 'text_digest', 'metadata_digest']
+
+DB_Record = namedtuple('DB_Record', db_cols)
+
+
+# parse_load_date()
+# -------------------------------------------------------------------------------------------------
+def parse_load_date(irdw_load_date: str) -> datetime.date:
+  """Convert the irdw_load_date of a dap_req_block row to a date."""
+  load_date = irdw_load_date[0:10]
+  # Desired date format: YYYY-MM-DD
+  if re.match(r'^\d{4}-\d{2}-\d{2}$', load_date):
+    return datetime.date.fromisoformat(load_date)
+  # Alternate format: DD-MMM-YY
+  if re.match(r'\d{2}-[a-z]{3}-\d{2}', load_date, re.I):
+    return datetime.datetime.strptime(load_date, '%d-%b-%y').date()
+  sys.exit(f'Unrecognized load date format: {load_date}')
+
+
+# check_load_dates()
+# -------------------------------------------------------------------------------------------------
+def check_load_dates(rows, irdw_load_date: datetime.date):
+  """Integrity check: pass the rows through, but exit if one has a different irdw load date."""
+  for row in rows:
+    if (load_date := parse_load_date(row.irdw_load_date)) != irdw_load_date:
+      sys.exit(f'dap_req_block irdw_load_date ({load_date}) is not “{irdw_load_date}”'
+               f' for {row.institution} {row.requirement_id}')
+    yield row
 
-  # Replace tabs with spaces, and primes with u2018.
-  return_block = return_block.replace('\t', ' ').replace("'", '’')
 
-  # Remove all text following END. that needs/wants never to be seen, and which messes up parsing
-  # anyway. (The preprocessor does this again. No harm done.)
-  return_block = re.sub(r'[Ee][Nn][Dd]\.(.|\n)*', 'END.\n', return_block)
+# write_history()
+# -------------------------------------------------------------------------------------------------
+def write_history(institution: str, requirement_id: str, parse_date: datetime.date,
+                  prev_parse_date: datetime.date, diff_lines: list,
+                  changes_str: str = None) -> None:
+  """Queue the diff for a block whose text changed for the history store (see history_store.py)."""
+  history_writer.write(institution, requirement_id, parse_date,
+                       (parse_date - prev_parse_date).days, diff_lines, changes_str)
 
-  return return_block
 
+# distinct_runs()
+# -------------------------------------------------------------------------------------------------
+def distinct_runs(actions: list) -> list:
+  """Split a chunk’s actions into runs, in order, in none of which a block appears twice.
 
-# csv_generator()
+  A block that appears twice in an extract has to be compared with what the first appearance wrote,
+  not with what was in the database before, so the runs are handled one after the other.
+  """
+  runs = [[]]
+  keys = set()
+  for action in actions:
+    key = (action.new_row.institution, action.new_row.requirement_id)
+    if key in keys:
+      runs.append([])
+      keys = set()
+    runs[-1].append(action)
+    keys.add(key)
+  return runs
+
+
+# classify_action()
+# -------------------------------------------------------------------------------------------------
+def classify_action(action: Action, db_row) -> bool:
+  """Compare a block with its entry in the block index, if any.
+
+  Returns True if the block changed, in which case its previous values have to be fetched from the
+  db and given to compare_previous().
+  """
+  if db_row is None:
+    action.do_insert = True
+    return False
+
+  action.prev_parse_date = db_row.parse_date
+  action.text_is_changed = db_row.text_digest != action.text_digest
+  action.metadata_is_changed = db_row.metadata_digest != action.metadata_digest
+  return action.text_is_changed or action.metadata_is_changed
+
+
+# compare_previous()
+# -------------------------------------------------------------------------------------------------
+def compare_previous(action: Action, prev_row) -> None:
+  """Decide whether a changed block needs updating, given its previous values from the db."""
+  new_row = action.new_row
+  if action.text_is_changed:
+    action.do_update = True
+    action.prev_text = prev_row.requirement_text or ''
+
+  # Check for changes to key metadata fields: log any changes and trigger block update
+  if action.metadata_is_changed:
+    for item in metadata_fields:
+      old_value = getattr(prev_row, item)
+      new_value = getattr(new_row, item)
+      if old_value != new_value:
+        action.do_update = True
+        action.messages.append(f'{new_row.institution} {new_row.requirement_id} {item}: '
+                               f'{old_value} ==> {new_value}')
+
+
+# render_html()
+# -------------------------------------------------------------------------------------------------
+def render_html(actions: list, map_fn=map) -> None:
+  """Render the HTML version of the text, but only for new blocks and ones whose text changed."""
+  to_render = [action for action in actions if action.do_insert or action.text_is_changed]
+  with timings.timed('html_render'):
+    htmls = cached_to_html_many([(action.new_row.institution, action.new_row.requirement_id,
+                                  action.requirement_text, action.text_digest)
+                                 for action in to_render], map_fn)
+  for action, requirement_html in zip(to_render, htmls):
+    action.requirement_html = requirement_html
+
+
+# budgeted_diff_texts()
+# -------------------------------------------------------------------------------------------------
+def budgeted_diff_texts():
+  """diff_texts() with the per-block budget given on the command line; picklable for workers."""
+  return partial(diff_texts, max_edits=args.diff_edits, max_seconds=args.diff_seconds)
+
+
+# record_history()
+# -------------------------------------------------------------------------------------------------
+def record_history(actions: list, map_fn=map) -> None:
+  """Record history of changes to the Scribe blocks themselves."""
+  to_diff = [action for action in actions if action.text_is_changed]
+  with timings.timed('diff'):
+    diffs = list(map_fn(budgeted_diff_texts(),
+                        [(action.prev_text, action.requirement_text) for action in to_diff]))
+  for action, (changes_str, diff_lines) in zip(to_diff, diffs):
+    action.changes_str = changes_str
+    write_history(action.new_row.institution, action.new_row.requirement_id,
+                  action.parse_date, action.prev_parse_date, diff_lines, changes_str)
+
+
+# write_statement()
+# -------------------------------------------------------------------------------------------------
+def write_statement(action: Action, irdw_load_date: datetime.date) -> tuple:
+  """Return the (query, params) to insert or update a block, or None if it’s unchanged.
+
+  The message that logs the write is added to the action’s messages.
+  """
+  new_row = action.new_row
+  if action.do_insert:
+    db_record = DB_Record._make([new_row.institution,
+                                 new_row.requirement_id,
+                                 new_row.block_type,
+                                 new_row.block_value,
+                                 action.title,
+                                 new_row.period_start,
+                                 new_row.period_stop,
+                                 new_row.school,
+                                 new_row.degree,
+                                 new_row.college,
+                                 new_row.major1,
+                                 new_row.major2,
+                                 new_row.concentration,
+                                 new_row.minor,
+                                 new_row.liberal_learning,
+                                 new_row.specialization,
+                                 new_row.program,
+                                 new_row.parse_status,
+                                 action.parse_date,
+                                 new_row.parse_who,
+                                 new_row.parse_what,
+                                 new_row.lock_version,
+                                 action.requirement_text,
+                                 action.requirement_html,
+                                 irdw_load_date,
+                                 action.text_digest,
+                                 action.metadata_digest
+                                 ])
+
+    vals = ', '.join(['%s'] * len(db_cols))
+    query = f'insert into requirement_blocks ({",".join(db_cols)}) values ({vals})'
+    action.messages.append(f'Inserted  {new_row.institution} {new_row.requirement_id} '
+                           f'{new_row.block_type} {new_row.block_value} '
+                           f'{new_row.period_stop}.')
+    return query, db_record
+
+  if action.do_update:
+    # Things that might have changed
+    update_dict = {'block_type': new_row.block_type,
+                   'block_value': new_row.block_value,
+                   'title': action.title,
+                   'period_start': new_row.period_start,
+                   'period_stop': new_row.period_stop,
+                   'parse_status': new_row.parse_status,
+                   'parse_date': action.parse_date,
+                   'parse_who': new_row.parse_who,
+                   'parse_what': new_row.parse_what,
+                   'lock_version': new_row.lock_version,
+                   'requirement_text': action.requirement_text,
+                   'irdw_load_date': irdw_load_date,
+                   'text_digest': action.text_digest,
+                   'metadata_digest': action.metadata_digest,
+                   }
+    if action.text_is_changed:
+      # The block will have to be re-parsed. (HTML and parse info are left alone otherwise.)
+      update_dict.update({'requirement_html': action.requirement_html,
+                          'dgw_parse_tree': None,
+                          'dgw_parse_date': None,
+                          'dgw_seconds': None})
+    set_args = ','.join([f'{key}=%s' for key in update_dict.keys()])
+    query = f"""
+    update requirement_blocks set {set_args}
+     where institution = %s and requirement_id = %s
+    """
+    params = [v for v in update_dict.values()] + [new_row.institution, new_row.requirement_id]
+    action.messages.append(f'Updated   {new_row.institution} {new_row.requirement_id} '
+                           f'{action.changes_str}.')
+    return query, params
+
+  return None
+
+
+# ingest_serial()
+# -------------------------------------------------------------------------------------------------
+def ingest_serial(conn, rows, irdw_load_date: datetime.date, log_file, executor=None,
+                  institution: str = None, checkpoint=None) -> tuple:
+  """Insert or update requirement_blocks one block at a time; return the counts.
+
+  Change detection is done against an in-memory index of the existing blocks (just those of the
+  institution, if one is given); the database is accessed per block only for inserts, updates, and
+  the previous values of changed blocks.
+
+  Rows are handled a chunk at a time: normalizing the texts, rendering HTML, and diffing changed
+  texts are done for the whole chunk, in worker processes if an executor is given. The database
+  work stays on the one connection, in row order. If a checkpoint is given, it is advanced past
+  each row as it is handled, and recorded with each batch commit.
+
+  The counts are (num_inserted, num_updated, num_failed), where the failed blocks are those whose
+  writes were rolled back.
+  """
+  num_inserted = num_updated = 0
+  map_fn = map if executor is None else executor.map
+
+  batch = BatchCommitter(conn, log_file, max_rows=args.batch_rows, max_bytes=args.batch_bytes,
+                         checkpoint=checkpoint)
+  with timings.timed('index_prefetch'):
+    block_index = prefetch_index(conn, institution)
+  if args.progress:
+    which = '' if institution is None else f'{institution} '
+    print(f'Indexed {len(block_index):,} existing {which}blocks')
+
+  with conn.cursor(row_factory=namedtuple_row) as cursor:
+    chunks = normalized_chunks(rows, executor, window=2 * max(args.workers, 1))
+    for chunk, normalized in timings.timed_iter('normalize', chunks):
+      actions = [Action(new_row, requirement_text, title, new_text_digest)
+                 for new_row, (requirement_text, title, new_text_digest) in zip(chunk, normalized)]
+      for run in distinct_runs(actions):
+
+        """ Determine the action to take for each block in the run.
+              If this is a new block, do insert
+              If this is an existing block and it has changed, do update (Check both
+              requirement_text and key metadata for changes)
+        """
+        for action in run:
+          new_row = action.new_row
+          # Check for changes in the data and metadata items that we use. Log messages are held by
+          # the batch committer until the block’s write has been committed.
+          db_row = block_index.get((new_row.institution, new_row.requirement_id))
+          if classify_action(action, db_row):
+            # Only now is it necessary to get the previous values from the db.
+            with timings.timed('db_lookup'):
+              prev_row = fetch_previous(cursor, new_row.institution, new_row.requirement_id,
+                                        with_text=action.text_is_changed)
+            compare_previous(action, prev_row)
+
+        render_html(run, map_fn)
+        record_history(run, map_fn)
+
+        # Insert or update the requirement_blocks as the case may be
+        for action in run:
+          new_row = action.new_row
+          block = f'{new_row.institution} {new_row.requirement_id}'
+          with timings.timed('db_write'):
+            if (statement := write_statement(action, irdw_load_date)) is None:
+              if args.log_unchanged:
+                batch.pending.append(f'No change {block} {new_row.block_type} '
+                                     f'{new_row.block_value}.')
+
+            elif batch.execute(cursor, block, *statement, action.messages,
+                               len(action.requirement_text.encode('utf-8'))):
+              if action.do_insert:
+                num_inserted += 1
+              else:
+                num_updated += 1
+              block_index[(new_row.institution, new_row.requirement_id)] = IndexEntry(
+                  action.parse_date, action.text_digest, action.metadata_digest)
+
+            batch.advance(new_row._position, num_inserted, num_updated)
+
+  with timings.timed('db_write'):
+    batch.commit()
+  if batch.num_failed:
+    s = '' if batch.num_failed == 1 else 's'
+    print(f'\n{batch.num_failed:,} block{s} failed to insert/update: see {log_file.name}')
+
+  return num_inserted, num_updated, batch.num_failed
+
+
+# ingest_sharded()
 # -------------------------------------------------------------------------------------------------
-def csv_generator(file):
-  """Generate rows from a csv export of OIRA’s DAP_REQ_BLOCK table."""
-  cols = None
-  with open(file, newline='') as query_file:
-    reader = csv.reader(query_file,
-                        delimiter=args.delimiter,
-                        quotechar=args.quotechar)
-    for line in reader:
-      if cols is None:
-        cols = [col.lower().replace(' ', '_') for col in line]
-        Row = namedtuple('Row', cols)
+def ingest_sharded(pool, rows, irdw_load_date: datetime.date, log_file, executor=None,
+                   shard_counts: dict = None) -> tuple:
+  """Partition the rows by institution and ingest the shards concurrently; return the counts.
+
+  Blocks from different institutions never interact, so each shard is handled by ingest_serial() in
+  its own thread, on its own connection from the pool. The shards log to separate buffers, each of
+  which is appended to log_file as soon as its shard is done. A shard’s buffer gets only the
+  messages of batches it has committed, so it is written even if the shard fails: once all the
+  shards are done, the first failure is re-raised. If shard_counts is given, it gets the
+  (num_inserted, num_updated) counts for each institution that finished. Returns the same counts
+  as ingest_serial(), for all the shards.
+  """
+  # The rows are light-weight views of the extract, so holding all of them at once is no burden.
+  # Reading them all also completes the irdw_load_date check before any shard starts.
+  shards = defaultdict(list)
+  for row in rows:
+    shards[row.institution].append(row)
+  institutions = sorted(shards.keys())
+
+  shard_logs = dict()
+  for institution in institutions:
+    shard_logs[institution] = io.StringIO()
+    shard_logs[institution].name = log_file.name
+
+  def ingest_shard(institution):
+    """Ingest one institution’s blocks; return its counts."""
+    with pool.connection() as conn:
+      return ingest_serial(conn, shards[institution], irdw_load_date, shard_logs[institution],
+                           executor, institution=institution)
+
+  num_inserted = num_updated = num_failed = 0
+  failure = None
+  with ThreadPoolExecutor(args.shards) as threads:
+    futures = {threads.submit(ingest_shard, institution): institution
+               for institution in institutions}
+    for future in as_completed(futures):
+      institution = futures[future]
+      log_file.write(shard_logs[institution].getvalue())
+      log_file.flush()
+      try:
+        counts = future.result()
+      except Exception as err:
+        failure = failure or err
+        continue
+      num_inserted += counts[0]
+      num_updated += counts[1]
+      num_failed += counts[2]
+      if shard_counts is not None:
+        shard_counts[institution] = counts[0:2]
+
+  if failure is not None:
+    raise failure
+  return num_inserted, num_updated, num_failed
+
+
+# ingest_async()
+# -------------------------------------------------------------------------------------------------
+async def ingest_async(conn, rows, irdw_load_date: datetime.date, log_file, executor=None,
+                       checkpoint=None) -> tuple:
+  """Insert or update requirement_blocks through a pipeline of asyncio tasks; return the counts.
+
+  The counts are the same as ingest_serial()’s.
+
+  The stages, connected by bounded queues of chunks of rows, are:
+    read:      take the next chunk of rows from the extract
+    normalize: normalize the texts, check them against the block index, and render the HTML of new
+               and changed blocks
+    detect:    fetch the previous values of changed blocks, note what changed, and write history
+    write:     insert and update blocks, committing in batches
+  So parsing the extract overlaps with waiting for the database, and a slow stage holds the others
+  back rather than letting chunks pile up in memory. The CPU-bound work runs in threads (or in the
+  executor’s worker processes), leaving the event loop free for the database I/O. The previous
+  values are fetched over a second connection, so they don’t have to wait for the writes.
+
+  The block index is prefetched over conn, the ordinary connection used for the other paths. The
+  writer handles the rows in order, so checkpointing works the same as for ingest_serial(), and
+  updates the index as it goes. A block that appears again while its earlier row may still be on
+  its way to the writer waits until the writer has caught up and committed, so that, as with
+  ingest_serial(), it is compared with what the earlier row wrote.
+  """
+  num_inserted = num_updated = num_failed = 0
+  map_fn = map if executor is None else executor.map
+  loop = asyncio.get_running_loop()
+
+  with timings.timed('index_prefetch'):
+    block_index = prefetch_index(conn)
+  # The pipeline has its own connections: don’t leave this one idle in a transaction meanwhile.
+  conn.commit()
+  if args.progress:
+    print(f'Indexed {len(block_index):,} existing blocks')
+
+  normalize_queue = asyncio.Queue(args.queue_size)
+  detect_queue = asyncio.Queue(args.queue_size)
+  write_queue = asyncio.Queue(args.queue_size)
+  # The blocks sent on to be written since the writer last caught up
+  recent_keys = set()
+
+  async def read():
+    """Queue chunks of rows; None marks the end of the extract."""
+    chunks = iter(lambda: list(islice(rows, 500)), [])
+    while (chunk := await asyncio.to_thread(next, chunks, None)) is not None:
+      await normalize_queue.put(chunk)
+    await normalize_queue.put(None)
+
+  async def normalize():
+    """Turn chunks of rows into lists of actions, noting which need their previous values."""
+    while (chunk := await normalize_queue.get()) is not None:
+      with timings.timed('normalize'):
+        normalized = await loop.run_in_executor(executor, normalize_blocks,
+                                                [(row.requirement_text, row.title)
+                                                 for row in chunk])
+      actions = [Action(new_row, requirement_text, title, new_text_digest)
+                 for new_row, (requirement_text, title, new_text_digest) in zip(chunk, normalized)]
+      for run in distinct_runs(actions):
+        keys = [(action.new_row.institution, action.new_row.requirement_id) for action in run]
+        if not recent_keys.isdisjoint(keys):
+          # An Event in the queues asks the writer to commit and set it once it gets there.
+          caught_up = asyncio.Event()
+          await detect_queue.put(caught_up)
+          await caught_up.wait()
+          recent_keys.clear()
+        recent_keys.update(keys)
+        changed = [action for action, key in zip(run, keys)
+                   if classify_action(action, block_index.get(key))]
+        await asyncio.to_thread(render_html, run, map_fn)
+        await detect_queue.put((run, changed))
+    await detect_queue.put(None)
+
+  async def detect(read_conn):
+    """Compare changed blocks with their previous values."""
+    async with read_conn.cursor(row_factory=namedtuple_row) as cursor:
+      while (item := await detect_queue.get()) is not None:
+        if isinstance(item, asyncio.Event):
+          await write_queue.put(item)
+          continue
+        actions, changed = item
+        for action in changed:
+          with timings.timed('db_lookup'):
+            prev_row = await fetch_previous_async(cursor, action.new_row.institution,
+                                                  action.new_row.requirement_id,
+                                                  with_text=action.text_is_changed)
+          compare_previous(action, prev_row)
+        await asyncio.to_thread(record_history, actions, map_fn)
+        await write_queue.put(actions)
+    await write_queue.put(None)
+
+  async def write(write_conn):
+    """Insert or update the requirement_blocks as the case may be."""
+    nonlocal num_inserted, num_updated, num_failed
+    batch = AsyncBatchCommitter(write_conn, log_file, max_rows=args.batch_rows,
+                                max_bytes=args.batch_bytes, checkpoint=checkpoint)
+    async with write_conn.cursor() as cursor:
+      while (actions := await write_queue.get()) is not None:
+        if isinstance(actions, asyncio.Event):
+          with timings.timed('db_write'):
+            await batch.commit()
+          actions.set()
+          continue
+        for action in actions:
+          new_row = action.new_row
+          block = f'{new_row.institution} {new_row.requirement_id}'
+          with timings.timed('db_write'):
+            if (statement := write_statement(action, irdw_load_date)) is None:
+              if args.log_unchanged:
+                batch.pending.append(f'No change {block} {new_row.block_type} '
+                                     f'{new_row.block_value}.')
+
+            elif await batch.execute(cursor, block, *statement, action.messages,
+                                     len(action.requirement_text.encode('utf-8'))):
+              if action.do_insert:
+                num_inserted += 1
+              else:
+                num_updated += 1
+              block_index[(new_row.institution, new_row.requirement_id)] = IndexEntry(
+                  action.parse_date, action.text_digest, action.metadata_digest)
+
+            await batch.advance(new_row._position, num_inserted, num_updated)
+
+    with timings.timed('db_write'):
+      await batch.commit()
+    num_failed = batch.num_failed
+    if num_failed:
+      s = '' if num_failed == 1 else 's'
+      print(f'\n{num_failed:,} block{s} failed to insert/update: see {log_file.name}')
+
+  async with (database.async_pool(2) as async_pool,
+              async_pool.connection() as read_conn,
+              async_pool.connection() as write_conn):
+    await read_conn.set_autocommit(True)
+    stages = [asyncio.create_task(stage)
+              for stage in (read(), normalize(), detect(read_conn), write(write_conn))]
+    try:
+      await asyncio.gather(*stages)
+    except BaseException:
+      # A stage that fails would leave the others waiting on their queues forever.
+      for stage in stages:
+        stage.cancel()
+      raise
+
+  return num_inserted, num_updated, num_failed
+
+
+# ingest_bulk()
+# -------------------------------------------------------------------------------------------------
+def ingest_bulk(conn, rows, irdw_load_date: datetime.date, log_file, executor=None) -> tuple:
+  """Insert or update requirement_blocks set-wise from a staging table; return the counts.
+
+  The normalized rows are COPYed into the staging table, where only the last row for each block is
+  kept; the blocks that changed are queried for the change log and history, then a single upsert
+  does the inserts and updates. The counts are the same as ingest_serial()’s, except that a
+  repeated block counts once, and the upsert succeeds or fails as a whole, so num_failed is 0.
+  """
+  num_inserted = num_updated = num_failed = 0
+  map_fn = map if executor is None else executor.map
+
+  def staging_records():
+    """Normalize the rows for the staging table."""
+    chunks = normalized_chunks(rows, executor, window=2 * max(args.workers, 1))
+    for chunk, normalized in timings.timed_iter('normalize', chunks):
+      for new_row, (requirement_text, title, new_text_digest) in zip(chunk, normalized):
+        staging_row = new_row._asdict()
+        staging_row.update({'title': title,
+                            'parse_date': datetime.date.fromisoformat(new_row.parse_date),
+                            'requirement_text': requirement_text,
+                            'irdw_load_date': irdw_load_date,
+                            'text_digest': new_text_digest,
+                            'metadata_digest': metadata_digest(new_row)})
+        yield [staging_row[col] for col in staging_cols]
+
+  with conn.cursor(row_factory=namedtuple_row) as cursor:
+    with timings.timed('db_write'):
+      create_staging_table(cursor)
+      num_staged = copy_rows(cursor, staging_records())
+      duplicates = drop_duplicates(cursor)
+    if args.progress:
+      print(f'\nStaged {num_staged:,} rows')
+    for duplicate in duplicates:
+      print(f'Duplicate {duplicate.institution} {duplicate.requirement_id}: row '
+            f'{duplicate.staging_position:,} dropped for a later one.', file=log_file)
+    if duplicates:
+      s = '' if len(duplicates) == 1 else 's'
+      print(f'\n{len(duplicates):,} duplicate row{s} dropped: see {log_file.name}')
+
+    # Log metadata changes and record history for text changes before merging.
+    changes = dict()
+    with timings.timed('db_lookup'):
+      staged = list(staged_changes(cursor))
+    to_diff = [change for change in staged if change.text_is_changed]
+    with timings.timed('diff'):
+      diffs = list(map_fn(budgeted_diff_texts(), [(change.prev_text or '', change.requirement_text)
+                                                  for change in to_diff]))
+    for change, (changes_str, diff_lines) in zip(to_diff, diffs):
+      changes[(change.institution, change.requirement_id)] = changes_str
+      write_history(change.institution, change.requirement_id,
+                    change.parse_date, change.prev_parse_date, diff_lines, changes_str)
+
+    for change in staged:
+      for item in metadata_fields:
+        old_value = getattr(change, f'prev_{item}')
+        new_value = getattr(change, item)
+        if old_value != new_value:
+          print(f'{change.institution} {change.requirement_id} {item}: {old_value} ==> '
+                f'{new_value}', file=log_file)
+
+    with timings.timed('db_write'):
+      merged = merge_staged(cursor)
+    for row in merged:
+      if row.inserted:
+        print(f'Inserted  {row.institution} {row.requirement_id} {row.block_type} '
+              f'{row.block_value} {row.period_stop}.', file=log_file)
+        num_inserted += 1
       else:
-        try:
-          # Trim trailing whitespace from lines in the Scribe text; they were messing up checking
-          # for changes to the blocks at one point.
-          row = Row._make(line)._asdict()
-          requirement_text = row['requirement_text']
-          row['requirement_text'] = '\n'.join([scribe_line.rstrip()
-                                               for scribe_line in requirement_text.split('\n')])
-          row = Row._make(row.values())
-          yield row
-        except TypeError as type_error:
-          sys.exit(f'{type_error}: |{line}|')
+        changes_str = changes.get((row.institution, row.requirement_id), '')
+        print(f'Updated   {row.institution} {row.requirement_id} {changes_str}.', file=log_file)
+        num_updated += 1
+
+  return num_inserted, num_updated, num_failed
 
 
 # __main__()
@@ -161,11 +769,53 @@ if __name__ == '__main__':
   parser.add_argument('-p', '--progress', action='store_true')
   parser.add_argument('--log_unchanged', action='store_true')
   parser.add_argument('--testing', action='store_true')
-  parser.add_argument('--timing', action='store_true')
+  parser.add_argument('--timing', action='store_true',
+                      help='print where the time went (it’s also written to Logs/ as JSON)')
+  parser.add_argument('--bulk', action='store_true',
+                      help='set-based ingestion through a COPY-loaded staging table')
+  parser.add_argument('--batch_rows', type=int, default=500,
+                      help='commit after this many inserted/updated blocks')
+  parser.add_argument('--batch_bytes', type=int, default=16 * 1024 * 1024,
+                      help='commit after this many bytes of inserted/updated block text')
+  parser.add_argument('--shards', type=int, default=0,
+                      help='ingest this many institutions concurrently, each on its own connection')
+  parser.add_argument('--pipeline', action='store_true',
+                      help='overlap reading, transforming, and writing in an asyncio pipeline')
+  parser.add_argument('--queue_size', type=int, default=4,
+                      help='chunks of rows that can wait between pipeline stages')
+  parser.add_argument('--keep_archives', type=int, default=7,
+                      help='keep only this many plain copies of each extract in archives/ once '
+                           'they are in the store (default: 7)')
+  parser.add_argument('--keep_all_archives', action='store_true',
+                      help='keep every plain copy in archives/ (no pruning)')
+  parser.add_argument('--store_backfill', type=int, default=4,
+                      help='add at most this many archived extracts to the store per run, newest '
+                           'first (default: 4)')
+  parser.add_argument('--delta', action='store_true',
+                      help='ingest only blocks that differ from the last fully-ingested extract')
+  parser.add_argument('--resume', action='store_true',
+                      help='continue an interrupted run from its checkpoint')
+  parser.add_argument('--workers', type=int, default=0,
+                      help='number of worker processes for normalizing, rendering, and diffing')
+  parser.add_argument('--diff_edits', type=int, default=500,
+                      help='history diffs needing more line edits than this are summarized')
+  parser.add_argument('--diff_seconds', type=float, default=1.0,
+                      help='history diffs taking longer than this are summarized')
+  parser.add_argument('--ingest_only', action='store_true',
+                      help='stop after updating requirement_blocks: no mk_html, term_info, report, '
+                           'or email')
   parser.add_argument('--delimiter', default=',')
   parser.add_argument('--quotechar', default='"')
+  add_database_arguments(parser)
+  add_profile_arguments(parser)
   parser.set_defaults(parse=True)
   args = parser.parse_args()
+  if args.resume and (args.bulk or args.shards > 1):
+    parser.error('--resume does not work with --bulk or --shards')
+
+  timings.profiler = profiler_from_args(args)
+  if timings.profiler and args.progress:
+    print(f'Profiling into {timings.profiler.output_dir}')
 
   hostname = os.uname().nodename
 
@@ -180,6 +830,7 @@ if __name__ == '__main__':
   archives_dir = Path(home_dir, 'Projects/ingest_requirement_blocks/archives')
   latest_dir = Path(home_dir, 'Projects/ingest_requirement_blocks/latest_queries')
   assert downloads_dir.is_dir() and archives_dir.is_dir() and latest_dir.is_dir()
+  archive_store = ArchiveStore(Path(archives_dir, 'store'))
 
   # What, where, and when
   www = f'This is {Path(sys.argv[0]).name} at {hostname} on {datetime.date.today()}'
@@ -238,31 +889,44 @@ if __name__ == '__main__':
         file.unlink()
 
   # Continue?
-  if not (download_dapreq and download_active):
+  if not (download_dapreq and download_active or args.resume):
     if args.progress:
       print('Empty downloads directory. Nothing to do.')
     front_matter += '<p>Empty downloads directory. Nothing to do.</p>'
     send_email(sender, sysop, subject, front_matter, html2text(front_matter))
     exit()
 
-  # Delete whatever is currently in latest/
-  for cruft_file in latest_dir.glob('*'):
-    cruft_file.unlink()
-
-  # Copy the new downloads to latest_queries/
-  shutil.copy2(download_dapreq, latest_dir)
-  shutil.copy2(download_active, latest_dir)
-
-  # Date-stamp downloaded files and move from downloads/ to archives/
-  for file in [download_dapreq, download_active]:
-    # Get the file's creation (download) date for archival purposes.
-    creation_datetime = datetime.datetime.fromtimestamp(file.stat().st_ctime)
-    creation_date = creation_datetime.strftime('%Y-%m-%d')
-    archives_name = f'{file.stem.lower()}_{creation_date}.csv'
-    shutil.move(str(file), archives_dir / archives_name)
-    if args.progress:
-      print(f'Moved, downloads/{file.name} to archives/')
-    front_matter += f'<p>Moved, downloads/{file.name} to archives/</p>'
+  # The connections are made in the background while the extracts are archived. A sharded run
+  # holds one for each shard, plus the one the shards are started from.
+  database = database_from_args(args, min_pool_size=args.shards + 1)
+  database.open()
+
+  with timings.stage('archive'):
+    if download_dapreq and download_active:
+      # Delete whatever is currently in latest/
+      for cruft_file in latest_dir.glob('*'):
+        cruft_file.unlink()
+
+      # Copy the new downloads to latest_queries/
+      shutil.copy2(download_dapreq, latest_dir)
+      shutil.copy2(download_active, latest_dir)
+
+      # Date-stamp downloaded files and move from downloads/ to archives/
+      for file in [download_dapreq, download_active]:
+        # Get the file's creation (download) date for archival purposes.
+        creation_datetime = datetime.datetime.fromtimestamp(file.stat().st_ctime)
+        creation_date = creation_datetime.strftime('%Y-%m-%d')
+        archives_name = f'{file.stem.lower()}_{creation_date}.csv'
+        shutil.move(str(file), archives_dir / archives_name)
+        if args.progress:
+          print(f'Moved, downloads/{file.name} to archives/')
+        front_matter += f'<p>Moved, downloads/{file.name} to archives/</p>'
+
+    else:
+      # The interrupted run already moved the downloads: resume with what’s in latest_queries/
+      if args.progress:
+        print('Empty downloads directory. Resuming with latest_queries.')
+      front_matter += '<p>Empty downloads directory. Resuming with latest_queries.</p>'
 
   # Sanity Checks
   requirement_block = Path(latest_dir, 'dgw_dap_req_block.csv')
@@ -272,218 +936,112 @@ if __name__ == '__main__':
 
   # Now update the requirement_blocks table from the latest requirements block
 
-  # These are dap_req_block columns with OAREDA additions, plus requirement_html that gets added
-  # here, but not dgw_parse_tree and dgw_seconds, which will be set by the parser.
-  db_cols = ['institution', 'requirement_id', 'block_type', 'block_value', 'title', 'period_start',
-             'period_stop', 'school', 'degree', 'college', 'major1', 'major2', 'concentration',
-             'minor', 'liberal_learning', 'specialization', 'program', 'parse_status', 'parse_date',
-             'parse_who', 'parse_what', 'lock_version', 'requirement_text', 'requirement_html',
-             'irdw_load_date']
-  vals = '%s, ' * len(db_cols)
-  vals = '(' + vals.strip(', ') + ')'
-
-  DB_Record = namedtuple('DB_Record', db_cols)
-
   # There used to be an XML generator, but it’s no longer used.
   generator = csv_generator
 
   start_time = int(time.time())
+  ingest_stage = timings.start_stage('ingest')
 
-  empty_parse_tree = json.dumps({})
   file_datetime = datetime.datetime.fromtimestamp(requirement_block.stat().st_ctime)
   file_date = file_datetime.strftime('%Y-%m-%d')
-  irdw_load_date = None
-  num_rows = num_inserted = num_updated = num_parsed = 0
-
-  for row in generator(requirement_block):
-    num_rows += 1
 
   # Here begins the actual update process
   # -----------------------------------------------------------------------------------------------
 
-  # Process the dgw_dap_req_block file
-  with psycopg.connect('dbname=cuny_curriculum') as conn:
-    with conn.cursor(row_factory=namedtuple_row) as cursor:
-      row_num = 0
-      for new_row in generator(requirement_block):
-
-        # Integrity check: all rows must have the same irdw load date.
-        # Desired date format: YYYY-MM-DD
-        load_date = new_row.irdw_load_date[0:10]
-        if re.match(r'^\d{4}-\d{2}-\d{2}$', load_date):
-          load_date = datetime.date.fromisoformat(load_date)
-        # Alternate format: DD-MMM-YY
-        elif re.match(r'\d{2}-[a-z]{3}-\d{2}', load_date, re.I):
-          dt = datetime.strptime(load_date, '%d-%b-%y').strftime('%Y-%m-%d')
-          load_date = datetime.date(dt.year, dt.month, dt.day)
-        else:
-          sys.exit(f'Unrecognized load date format: {load_date}')
-        if irdw_load_date is None:
-          irdw_load_date = load_date
-          log_file = open(f'./Logs/update_requirement_blocks_{irdw_load_date}.log', 'w')
-          print(f'Using {requirement_block.name} with irdw_load_date {irdw_load_date}')
-
-        if irdw_load_date != load_date:
-          sys.exit(f'dap_req_block irdw_load_date ({load_date}) is not “{irdw_load_date}”'
-                   f'for {row.institution} {row.requirement_id}')
-
-        row_num += 1
-        if args.progress:
-          print(f'\r{row_num:,}/{num_rows:,}', end='')
-
-        """ Determine the action to take.
-              If this is a new block, do insert
-              If this is an existing block and it has changed, do update (Check both
-              requirement_text and key metadata for changes)
-        """
-        action = Action()
-
-        requirement_text = decruft(new_row.requirement_text)
-        requirement_html = to_html(row.institution, row.requirement_id, requirement_text)
-        text_is_changed = False  # Don’t know yet
-        current_parse_tree = None
-
-        # When did the institution last parse the block?
-        parse_date = datetime.date.fromisoformat(new_row.parse_date)
-
-        # Check for changes in the data and metadata items that we use.
-        changes_str = ''
-        cursor.execute(f"""
-        select block_type, block_value, period_start, period_stop, major1,
-               parse_date, requirement_text, requirement_html, dgw_parse_tree, dgw_seconds
-          from requirement_blocks
-         where institution = '{new_row.institution}'
-           and requirement_id = '{new_row.requirement_id}'
-        """)
-        if cursor.rowcount == 0:
-          action.do_insert = True
-
-        else:
-          assert cursor.rowcount == 1, (f'Error: {cursor.rowcount} rows for {new_row.institution} '
-                                        f'{new_row.requirement_id}')
-          db_row = cursor.fetchone()
-          current_dgw_parse_tree = db_row.dgw_parse_tree  # Re-use these if text hasn’t changed
-          current_dgw_parse_date = db_row.parse_date
-          current_dgw_parse_secs = db_row.dgw_seconds
-          current_dgw_html = db_row.requirement_html
-          if current_dgw_parse_tree == 'null':  # Quirk
-            current_dgw_parse_tree = None
-            current_dgw_parse_date = None
-            currend_dgw_seconds = None
-
-          # Record history of changes to the Scribe block itself
-          days_ago = f'{(parse_date - db_row.parse_date).days}'.zfill(3)
-          s = '' if days_ago == 1 else 's'
-          diff_msg = f'{days_ago} day{s} since previous parse date'
-
-          if text_is_changed := db_row.requirement_text != requirement_text:
-            current_dgw_parse_tree = None
-            current_dgw_parse_date = None
-            current_dgw_parse_secs = None
-            current_dgw_html = None
-            db_lines = db_row.requirement_text.split('\n')
-            new_lines = requirement_text.split('\n')
-            prev_len = len(db_lines)
-            new_len = len(new_lines)
-            if prev_len < new_len:
-              changes_str = f'{new_len - prev_len} lines longer.'
-            elif (new_len < prev_len):
-              changes_str = f'{prev_len - new_len} lines shorter.'
-            else:
-              changes_str = f'{prev_len:,} lines.'
-            action.do_update = True
-            with open(f'history/{new_row.institution}_{new_row.requirement_id}_{parse_date}_'
-                      f'{days_ago}', 'w') as _diff_file:
-              diff_lines = difflib.context_diff([f'{line}\n' for line in db_lines],
-                                                [f'{line}\n' for line in new_lines],
-                                                fromfile='previous', tofile='changed', n=0)
-              _diff_file.writelines(diff_lines)
-
-          # Check for changes to key metadata fields: log any changes and trigger block update
-          for item in ['block_type', 'block_value',
-                       'major1', 'period_start', 'period_stop']:
-            old_value = getattr(db_row, item)
-            new_value = getattr(new_row, item)
-            if old_value != new_value:
-              action.do_update = True
-              print(f'{new_row.institution} {new_row.requirement_id} {item}: {old_value} ==> '
-                    f'{new_value}', file=log_file)
-
-        # Insert or update the requirement_block as the case may be
-        if action.do_insert:
-          db_record = DB_Record._make([new_row.institution,
-                                       new_row.requirement_id,
-                                       new_row.block_type,
-                                       new_row.block_value,
-                                       decruft(new_row.title),
-                                       new_row.period_start,
-                                       new_row.period_stop,
-                                       new_row.school,
-                                       new_row.degree,
-                                       new_row.college,
-                                       new_row.major1,
-                                       new_row.major2,
-                                       new_row.concentration,
-                                       new_row.minor,
-                                       new_row.liberal_learning,
-                                       new_row.specialization,
-                                       new_row.program,
-                                       new_row.parse_status,
-                                       parse_date,
-                                       new_row.parse_who,
-                                       new_row.parse_what,
-                                       new_row.lock_version,
-                                       requirement_text,
-                                       requirement_html,
-                                       irdw_load_date
-                                       ])
-
-          vals = ', '.join([f"'{val}'" for val in db_record])
-          cursor.execute(f'insert into requirement_blocks ({",".join(db_cols)}) values ({vals})')
-          assert cursor.rowcount == 1, (f'Inserted {cursor.rowcount} rows\n{cursor.query}')
-          print(f'Inserted  {new_row.institution} {new_row.requirement_id} {new_row.block_type} '
-                f'{new_row.block_value} {new_row.period_stop}.', file=log_file)
-          conn.commit()
-          num_inserted += 1
-
-        elif action.do_update:
-          # Things that might have changed
-          update_dict = {'block_type': new_row.block_type,
-                         'block_value': new_row.block_value,
-                         'title': decruft(new_row.title),
-                         'period_start': new_row.period_start,
-                         'period_stop': new_row.period_stop,
-                         'parse_status': new_row.parse_status,
-                         'parse_date': parse_date,
-                         'parse_who': new_row.parse_who,
-                         'parse_what': new_row.parse_what,
-                         'lock_version': new_row.lock_version,
-                         'requirement_text': requirement_text,
-                         'requirement_html': requirement_html,
-                         'dgw_parse_tree': Json(current_dgw_parse_tree),
-                         'dgw_parse_date': current_dgw_parse_date,
-                         'dgw_seconds': current_dgw_parse_secs,
-                         'irdw_load_date': irdw_load_date,
-                         }
-          set_args = ','.join([f'{key}=%s' for key in update_dict.keys()])
-          cursor.execute(f"""
-          update requirement_blocks set {set_args}
-           where institution = %s and requirement_id = %s
-          """, ([v for v in update_dict.values()] + [new_row.institution, new_row.requirement_id]))
-          assert cursor.rowcount == 1, (f'Updated {cursor.rowcount} rows\n{cursor.query}')
-          print(f'Updated   {new_row.institution} {new_row.requirement_id} {changes_str}.',
-                file=log_file)
-          conn.commit()
-          num_updated += 1
-
-        else:
-          if args.log_unchanged:
-            print(f'No change {new_row.institution} {new_row.requirement_id} {new_row.block_type} '
-                  f'{new_row.block_value}.', file=log_file)
+  # The checkpoint records how far ingestion of this extract has gotten. With --resume, an earlier
+  # run’s checkpoint for the same extract says where to pick up.
+  checkpoint = Checkpoint(requirement_block)
+  baseline_digest = None
+  with database.connection() as conn:
+    if args.resume and checkpoint.restore(conn):
+      state = 'already ingested' if checkpoint.completed else f'at byte {checkpoint.position:,}'
+      print(f'Resuming {requirement_block.name} {state}')
+      front_matter += f'<p>Resuming {requirement_block.name} {state}</p>'
+    else:
+      with conn.cursor() as cursor:
+        create_checkpoint_table(cursor)
+        baseline_digest = completed_digest(cursor, requirement_block.name)
+
+  # With --delta, only blocks that were added or changed since the last extract to be ingested in
+  # full go to the database. That extract has to be found in the archives for this to work.
+  delta = None
+  if args.delta:
+    if baseline_digest and (baseline := find_baseline(archives_dir, baseline_digest)):
+      delta = extract_delta(baseline, requirement_block, args.delimiter, args.quotechar)
+      msg = (f'Delta from {baseline.name}: {len(delta.added):,} added, {len(delta.changed):,} '
+             f'changed, {len(delta.removed):,} removed')
+    else:
+      msg = 'No fully-ingested previous extract in archives: ingesting all blocks'
+    print(msg)
+    front_matter += f'<p>{msg}</p>'
 
-      cursor.execute(f"""update updates
-                            set update_date = '{load_date}', file_name = '{requirement_block.name}'
-                          where table_name = 'requirement_blocks'""")
+  # All rows must have the same irdw load date as the first one, which also names the log file.
+  rows = generator(requirement_block, progress=args.progress, start=checkpoint.position)
+  first_row = next(rows, None)
+  if first_row is not None:
+    irdw_load_date = parse_load_date(first_row.irdw_load_date)
+    rows = check_load_dates(chain([first_row], rows), irdw_load_date)
+  elif checkpoint.irdw_load_date is not None:
+    # Nothing left to ingest
+    irdw_load_date = checkpoint.irdw_load_date
+  else:
+    sys.exit(f'No rows in {requirement_block.name}')
+  if checkpoint.irdw_load_date not in (None, irdw_load_date):
+    sys.exit(f'dap_req_block irdw_load_date ({irdw_load_date}) is not the checkpoint’s '
+             f'“{checkpoint.irdw_load_date}”')
+  checkpoint.irdw_load_date = irdw_load_date
+  # A resumed run adds to the log of the interrupted one.
+  log_file = open(f'./Logs/update_requirement_blocks_{irdw_load_date}.log',
+                  'a' if checkpoint.position else 'w')
+  # Where the time went goes next to the log.
+  timing_path = Path(f'./Logs/update_requirement_blocks_{irdw_load_date}.timing.json')
+  print(f'Using {requirement_block.name} with irdw_load_date {irdw_load_date}')
+
+  if delta is not None:
+    # The load date check still sees every row; the database sees only the delta.
+    delta_keys = delta.added | delta.changed
+    rows = (row for row in rows if (row.institution, row.requirement_id) in delta_keys)
+    for institution, requirement_id in sorted(delta.removed):
+      print(f'Removed   {institution} {requirement_id} (not in extract)', file=log_file)
+  rows = timings.timed_iter('csv_parse', rows)
+
+  # Process the dgw_dap_req_block file. History is written until the end, even if a run fails.
+  with (ProcessPoolExecutor(args.workers) if args.workers > 0 else nullcontext() as executor,
+        HistoryWriter() as history_writer):
+    with database.connection() as conn:
+      shard_counts = dict()
+      if first_row is None:
+        counts = (0, 0, 0)
+      elif args.bulk:
+        counts = ingest_bulk(conn, rows, irdw_load_date, log_file, executor)
+      elif args.pipeline:
+        counts = asyncio.run(ingest_async(conn, rows, irdw_load_date, log_file, executor,
+                                          checkpoint))
+      elif args.shards > 1:
+        counts = ingest_sharded(database.pool, rows, irdw_load_date, log_file, executor,
+                                shard_counts)
+      else:
+        counts = ingest_serial(conn, rows, irdw_load_date, log_file, executor,
+                               checkpoint=checkpoint)
+
+      # Counts include those of the interrupted run(s), if resuming. If any block failed, the
+      # extract isn’t marked completed, so --delta won’t take it for one the database reflects.
+      checkpoint.complete(conn, requirement_block.stat().st_size, *counts)
+      num_inserted, num_updated = checkpoint.num_inserted, checkpoint.num_updated
+      if checkpoint.num_failed:
+        s = '' if checkpoint.num_failed == 1 else 's'
+        msg = (f'{checkpoint.num_failed:,} block{s} failed: {requirement_block.name} will not be '
+               f'a --delta baseline')
+        print(msg)
+        front_matter += f'<p><strong>{msg}</strong></p>'
+
+      with conn.cursor() as cursor:
+        cursor.execute(f"""update updates
+                              set update_date = '{irdw_load_date}',
+                                  file_name = '{requirement_block.name}'
+                            where table_name = 'requirement_blocks'""")
+  log_file.close()
+  timings.end_stage(ingest_stage)
 
   # Summarize DAP_REQ_BLOCK processing.
   front_matter += f"""
@@ -509,143 +1067,212 @@ if __name__ == '__main__':
     print(msg)
     front_matter += f'<p>{msg}</p>'
 
-  if args.timing:
-    m, s = divmod(int(round(time.time())) - start_time, 60)
-    h, m = divmod(m, 60)
-    print(f'  {int(h):02}:{int(m):02}:{round(s):02}')
-
-  # (Re-)generate the requirement_html column of requirement_blocks table if there were any changes
-  if not none_changed:
-    print('Generate new/changed requirement_blocks.requirement_html')
-    substep_start = time.time()
-    run_regen = ['./mk_html.py']
-    if args.progress:
-      run_regen.append('--progress')
-    run(run_regen, stdout=sys.stdout, stderr=sys.stdout)
+    if shard_counts:
+      # Per-institution breakdown from a sharded run
+      front_matter += '<table><tr><th>Institution</th><th>Inserted</th><th>Updated</th></tr>'
+      for institution, (shard_inserted, shard_updated) in sorted(shard_counts.items()):
+        if shard_inserted + shard_updated == 0:
+          continue
+        print(f'  {institution}: {shard_inserted:6,} inserted {shard_updated:6,} updated')
+        front_matter += (f'<tr><td>{institution}</td><td>{shard_inserted:,}</td>'
+                         f'<td>{shard_updated:,}</td></tr>')
+      front_matter += '</table>'
+
+  if args.ingest_only:
+    database.close()
+    timings.write(timing_path)
     if args.timing:
-      m, s = divmod(int(round(time.time() - substep_start)), 60)
-      h, m = divmod(m, 60)
-      print(f'  {int(h):02}:{int(m):02}:{round(s):02}')
-
-  print('Populate requirement_blocks.term_info')
+      print(timings.summary())
+    exit()
 
-  # Start report
-  parse_report = """
-  <style>
-  * {
-    font-family: sans-serif;
-    }
-  .label {
-    display: inline-block;
-    width: 20em;
-    font-weight: bold;
-  }
-  table {
-    border-collapse: collapse;
-  }
-  td, th {
-    border: 1px solid;
-    padding: 0.5em;
-  }
-  th {
-    background-color: #eee;
-  }
-  td:nth-child(2) {
-    text-align: right;
-  }
-  .warning {
-    font-weight: bold;
-    background-color: #600;
-    color: #fff;
-  }
-  .warning p {
-    padding-left: 1em;
-  }
-  .hr {
-    border-top: 2px solid black;
-    padding-top: 0.5em;
-    max-width: 45em;
-  }
-  .mono {
-    white-space: pre;
-    font-family: monospace;
-  }
-  </style>
-  """ + front_matter
-
-  # mk_term_info ingests OAREDA’s dgw_ir_active_requirements.csv files
-  result = run(['./mk_term_info.py'], capture_output=True)
-  if result.returncode != 0:
-    print('\nmk_term_info FAILED!')
-    parse_report += f"""
-    <div class="warning">
-      <p>mk_term_info.py FAILED!</p>
-      <p>{result.stderr}</p>
-    </div>
-    <p><strong>No Term_Info Report</strong></p>
-    """
-  else:
-    paragraphs = result.stdout.split(b'\n')
-    term_report = []
-    for paragraph in paragraphs:
-      if paragraph := str(paragraph, encoding='utf-8'):
+  # The rest of the run shares one connection: requirement_html, term_info, and the report. It’s
+  # committed when the report has been sent.
+  with database.connection() as conn:
+    # (Re-)generate the requirement_html column of requirement_blocks table if there were any
+    # changes
+    if not none_changed:
+      print('Generate new/changed requirement_blocks.requirement_html')
+      with timings.stage('mk_html'):
         try:
-          name, date = paragraph.split(':')
-          term_report.append(f'<p><span class="label">{name.strip()}</span>{date.strip()}</p> ')
-        except ValueError:
-          # No filename:date -- just give the other info
-          term_report.append(f'<p class="mono">{paragraph}</p>')
-
-    term_report = '\n'.join(term_report)
-    parse_report += f'<div class="hr"><p class="label">MK_TERM_INFO</p>{term_report}</div>'
-
-    # Generate table of un-parsed current blocks, giving most-recent active term.
-    # Alert (bool) currently-active un-parsed blocks
-    today = datetime.date.today()
-    reports_dir = Path('./ingestion_reports')
-    if not reports_dir.is_dir():
-      reports_dir.mkdir()
-    report_file = Path(reports_dir, f'{today}.csv').open('w')
-    writer = csv.writer(report_file)
-    writer.writerow(['Institution', 'Requirement ID', 'Latest Term', 'This Year'])
-    with psycopg.connect('dbname=cuny_curriculum') as conn:
-      with conn.cursor(row_factory=namedtuple_row) as cursor:
-        cursor.execute("""
-        select institution, requirement_id, term_info
-          from requirement_blocks
-         where dgw_parse_tree is null
-           and term_info is not null
-           and period_stop ~* '^9'
-        order by institution, requirement_id
+          html_result = generate_html(conn, workers=args.workers, progress=args.progress)
+        except Exception as err:
+          # The blocks are left with Null requirement_html, for the next run (or mk_html.py).
+          conn.rollback()
+          html_result = None
+          html_error = f'{type(err).__name__}: {err}'
+      if html_result is None:
+        print('\nmk_html FAILED!')
+        front_matter += f"""
+        <div class="warning">
+          <p>mk_html FAILED!</p>
+          <p>{html_error}</p>
+        </div>
+        """
+      else:
+        s = '' if html_result.num_blocks == 1 else 's'
+        print(f'Generated missing html text for {html_result.num_updated} of '
+              f'{html_result.num_blocks} requirement block{s}')
+
+    print('Populate requirement_blocks.term_info')
+
+    # Start report
+    parse_report = """
+    <style>
+    * {
+      font-family: sans-serif;
+      }
+    .label {
+      display: inline-block;
+      width: 20em;
+      font-weight: bold;
+    }
+    table {
+      border-collapse: collapse;
+    }
+    td, th {
+      border: 1px solid;
+      padding: 0.5em;
+    }
+    th {
+      background-color: #eee;
+    }
+    td:nth-child(2) {
+      text-align: right;
+    }
+    .warning {
+      font-weight: bold;
+      background-color: #600;
+      color: #fff;
+    }
+    .warning p {
+      padding-left: 1em;
+    }
+    .hr {
+      border-top: 2px solid black;
+      padding-top: 0.5em;
+      max-width: 45em;
+    }
+    .mono {
+      white-space: pre;
+      font-family: monospace;
+    }
+    </style>
+    """ + front_matter
+
+    # mk_term_info ingests OAREDA’s dgw_ir_active_requirements.csv files
+    term_info_log = Path(f'./Logs/mk_term_info_{datetime.date.today()}.log')
+    with timings.stage('mk_term_info'):
+      try:
+        active_load_date, active_blocks = active_term_info(actives_block)
+        with term_info_log.open('w') as term_info_log_file:
+          term_info = update_term_info(conn, active_blocks, term_info_log_file)
+      except Exception as err:
+        conn.rollback()
+        term_info = None
+        term_info_error = f'{type(err).__name__}: {err}'
+    report_stage = timings.start_stage('report')
+    if term_info is None:
+      print('\nmk_term_info FAILED!')
+      parse_report += f"""
+      <div class="warning">
+        <p>mk_term_info FAILED!</p>
+        <p>{term_info_error}</p>
+      </div>
+      <p><strong>No Term_Info Report</strong></p>
+      """
+    else:
+      term_report = [f'<p><span class="label">DGW_IR_ACTIVE_REQUIREMENTS</span>'
+                     f'{actives_block.name}</p>',
+                     f'<p><span class="label">IRDW_LOAD_DATE</span>{active_load_date}</p>',
+                     f'<p class="mono">{term_info.num_active:9,} active blocks</p>',
+                     f'<p class="mono">{term_info.num_set:9,} matching blocks found</p>',
+                     f'<p class="mono">{term_info.num_changed:9,} blocks with changed term '
+                     f'info</p>',
+                     f'<p class="mono">{term_info.num_cleared:9,} blocks no longer active</p>']
+      if term_info.num_missing:
+        term_report.append(f'<p class="mono">{term_info.num_missing:9,} missing blocks logged to '
+                           f'Logs/{term_info_log.name}</p>')
+
+      term_report = '\n'.join(term_report)
+      parse_report += f'<div class="hr"><p class="label">MK_TERM_INFO</p>{term_report}</div>'
+
+      # Generate table of un-parsed current blocks, giving most-recent active term.
+      # Alert (bool) currently-active un-parsed blocks
+      # The latest term of each block is found by the server, and the table is streamed straight to
+      # the report file.
+      today = datetime.date.today()
+      this_year = (today.year - 1900) * 10  # PeopleSoft term code for month “zero”
+      reports_dir = Path('./ingestion_reports')
+      if not reports_dir.is_dir():
+        reports_dir.mkdir()
+      unparsed_blocks = """
+      select institution, requirement_id,
+             (select max((term ->> 'active_term')::integer)
+                from jsonb_array_elements(term_info) term) as latest_term
+        from requirement_blocks
+       where dgw_parse_tree is null
+         and term_info is not null
+         and period_stop ~* '^9'
+      """
+      with conn.cursor() as cursor:
+        cursor.execute(f"""
+        select count(*), count(*) filter (where latest_term >= {this_year})
+          from ({unparsed_blocks}) unparsed
         """)
-        this_year = (today.year - 1900) * 10  # PeopleSoft term code for month “zero”
-        num_warnings = 0
-        num_rows = cursor.rowcount
-        table_body = ''
-        for row in cursor:
-          value = row.term_info
-          value = sorted(value, key=lambda d: d['active_term'])
-          latest_term = value[-1]['active_term']
-          class_attribute = ''
-          alert = latest_term >= this_year
-          if alert:
-            num_warnings += 1
-          writer.writerow([row.institution, row.requirement_id, latest_term, alert])
-    report_file.close()
-
-    s = '' if num_warnings == 1 else 's'
-    parse_report += (f'<p class="hr"><strong>{num_rows} Unparsed-block IDs written to '
-                     f'{report_file.name}</strong></p>')
-    if num_warnings:
-      parse_report += f'<div class="warning"><p>{num_warnings} “this year” Alert{s}</p></div>'
-
-  print('Email mapping files status report')
-  send_email(sender, sysop, subject, parse_report, html2text(parse_report))
+        num_rows, num_warnings = cursor.fetchone()
+
+        with Path(reports_dir, f'{today}.csv').open('wb') as report_file:
+          with cursor.copy(f"""
+          copy (select institution as "Institution",
+                       requirement_id as "Requirement ID",
+                       latest_term as "Latest Term",
+                       case when latest_term >= {this_year} then 'True' else 'False' end
+                         as "This Year"
+                  from ({unparsed_blocks}) unparsed
+                 order by institution, requirement_id)
+            to stdout with (format csv, header)
+          """) as copy:
+            for data in copy:
+              report_file.write(data)
+
+      s = '' if num_warnings == 1 else 's'
+      parse_report += (f'<p class="hr"><strong>{num_rows} Unparsed-block IDs written to '
+                       f'{report_file.name}</strong></p>')
+      if num_warnings:
+        parse_report += f'<div class="warning"><p>{num_warnings} “this year” Alert{s}</p></div>'
+
+    print('Email mapping files status report')
+    send_email(sender, sysop, subject, parse_report, html2text(parse_report))
+  database.close()
+  timings.end_stage(report_stage)
+
+  # Add the archived extracts that aren’t in the store yet. The plain copies of older extracts can
+  # then be restored from the store if need be.
+  with timings.stage('archive_store'):
+    unstored = [archive for archive in archives_dir.glob('*.csv')
+                if archive.name not in archive_store]
+    # Newest first, by the date in the name, so this run’s extracts don’t wait on a backlog.
+    unstored.sort(key=lambda archive: archive.stem.rsplit('_', 1)[-1], reverse=True)
+    for archive in unstored[:args.store_backfill]:
+      try:
+        archive_store.add(archive)
+      except ValueError as err:
+        # It stays out of the store, so its plain copy doesn’t get pruned.
+        print(f'Unable to store archives/{archive.name}: {err}')
+        continue
+      if args.progress:
+        print(f'Stored archives/{archive.name}')
+    if len(unstored) > args.store_backfill and args.progress:
+      print(f'{len(unstored) - args.store_backfill:,} archived extracts left for later runs to '
+            f'store')
+    if not args.keep_all_archives:
+      for archive in prune_archives(archive_store, archives_dir, args.keep_archives):
+        if args.progress:
+          print(f'Pruned archives/{archive.name}')
 
+  timings.write(timing_path)
   if args.timing:
-    m, s = divmod(int(round(time.time() - substep_start)), 60)
-    h, m = divmod(m, 60)
-    print(f'  {int(h):02}:{int(m):02}:{round(s):02}')
+    print(timings.summary())
 
   m, s = divmod(time.time() - start_time, 60)
   h, m = divmod(m, 60)
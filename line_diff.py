@@ -0,0 +1,277 @@
+"""A line diff with bounded cost, for the history of changes to Scribe blocks.
+
+difflib’s SequenceMatcher can go quadratic on long blocks with many similar lines, which Scribe
+blocks have plenty of. Here, the lines are reduced to small ints, and the texts are split at
+anchors, lines that occur just once in each, as patience diff does. Stretches without anchors are
+diffed by the Myers O((N+M)D) algorithm. The cost is bounded by giving up once the edits D found by
+Myers pass max_edits or the time passes max_seconds; the caller then falls back to treating the
+whole middle part of the block as replaced.
+
+The output is formatted exactly as difflib.context_diff() formats it, so the history format is
+unchanged.
+"""
+
+import bisect
+import time
+
+
+# matching_blocks()
+# -------------------------------------------------------------------------------------------------
+def matching_blocks(a: list, b: list, max_edits: int = None, max_seconds: float = None) -> list:
+  """Return the (i, j, size) runs of lines that match in a and b, or None if over budget.
+
+  As for SequenceMatcher.get_matching_blocks(), the list ends with (len(a), len(b), 0).
+  """
+  # Reduce the lines to ints, so comparing them is cheap.
+  line_ids = dict()
+  a_ids = [line_ids.setdefault(line, len(line_ids)) for line in a]
+  b_ids = [line_ids.setdefault(line, len(line_ids)) for line in b]
+  budget = _Budget(max_edits, max_seconds)
+
+  # Split the problem at anchors: lines that occur just once in each text (as patience diff does).
+  # Only the stretches between anchors that have no anchors of their own go to Myers.
+  matches = []
+  ranges = [(0, len(a_ids), 0, len(b_ids))]
+  while ranges:
+    a_lo, a_hi, b_lo, b_hi = ranges.pop()
+    prefix, suffix = _common_ends(a_ids[a_lo:a_hi], b_ids[b_lo:b_hi])
+    if prefix:
+      matches.append((a_lo, b_lo, prefix))
+    if suffix:
+      matches.append((a_hi - suffix, b_hi - suffix, suffix))
+    a_lo, a_hi, b_lo, b_hi = a_lo + prefix, a_hi - suffix, b_lo + prefix, b_hi - suffix
+    if a_lo == a_hi or b_lo == b_hi:
+      continue
+
+    if anchors := _unique_anchors(a_ids, a_lo, a_hi, b_ids, b_lo, b_hi):
+      for i, j in anchors:
+        matches.append((i, j, 1))
+        ranges.append((a_lo, i, b_lo, j))
+        a_lo, b_lo = i + 1, j + 1
+      ranges.append((a_lo, a_hi, b_lo, b_hi))
+    elif (runs := _myers(a_ids, a_lo, a_hi, b_ids, b_lo, b_hi, budget)) is None:
+      return None
+    else:
+      matches += runs
+
+  # Merge adjacent runs.
+  blocks = []
+  for i, j, size in sorted(matches):
+    if blocks and blocks[-1][0] + blocks[-1][2] == i and blocks[-1][1] + blocks[-1][2] == j:
+      blocks[-1] = (blocks[-1][0], blocks[-1][1], blocks[-1][2] + size)
+    else:
+      blocks.append((i, j, size))
+  blocks.append((len(a), len(b), 0))
+  return blocks
+
+
+# replaced_middle()
+# -------------------------------------------------------------------------------------------------
+def replaced_middle(a: list, b: list) -> list:
+  """The fallback for matching_blocks(): only the lines a and b start and end with match.
+
+  Everything in between counts as replaced.
+  """
+  prefix, suffix = _common_ends(a, b)
+  return [(0, 0, prefix), (len(a) - suffix, len(b) - suffix, suffix), (len(a), len(b), 0)]
+
+
+def _common_ends(a: list, b: list) -> tuple:
+  """Return the numbers of lines a and b have in common at the start and (after that) the end."""
+  prefix = 0
+  while prefix < len(a) and prefix < len(b) and a[prefix] == b[prefix]:
+    prefix += 1
+  suffix = 0
+  while (suffix < len(a) - prefix and suffix < len(b) - prefix
+         and a[-1 - suffix] == b[-1 - suffix]):
+    suffix += 1
+  return prefix, suffix
+
+
+class _Budget:
+  """What’s left of the edits and time allowed for one diff."""
+
+  def __init__(self, max_edits: int, max_seconds: float):
+    """None means no limit."""
+    self.edits = max_edits
+    self.deadline = None if max_seconds is None else time.perf_counter() + max_seconds
+
+  def out_of_time(self) -> bool:
+    """Is it past the deadline?"""
+    return self.deadline is not None and time.perf_counter() > self.deadline
+
+
+def _unique_anchors(a: list, a_lo: int, a_hi: int, b: list, b_lo: int, b_hi: int) -> list:
+  """Return the longest in-order sequence of (i, j) pairs of lines unique in both ranges."""
+  a_count = dict()
+  for i in range(a_lo, a_hi):
+    a_count[a[i]] = a_count.get(a[i], 0) + 1
+  b_count = dict()
+  b_index = dict()
+  for j in range(b_lo, b_hi):
+    b_count[b[j]] = b_count.get(b[j], 0) + 1
+    b_index[b[j]] = j
+  pairs = [(i, b_index[a[i]]) for i in range(a_lo, a_hi)
+           if a_count[a[i]] == 1 and b_count.get(a[i]) == 1]
+
+  # Longest increasing subsequence of the j’s, by patience sorting.
+  pile_tops = []
+  top_js = []
+  back = []
+  for index, (_, j) in enumerate(pairs):
+    pile = bisect.bisect_left(top_js, j)
+    back.append(pile_tops[pile - 1] if pile else None)
+    if pile == len(pile_tops):
+      pile_tops.append(index)
+      top_js.append(j)
+    else:
+      pile_tops[pile] = index
+      top_js[pile] = j
+  anchors = []
+  index = pile_tops[-1] if pile_tops else None
+  while index is not None:
+    anchors.append(pairs[index])
+    index = back[index]
+  anchors.reverse()
+  return anchors
+
+
+def _myers(a: list, a_lo: int, a_hi: int, b: list, b_lo: int, b_hi: int, budget: _Budget) -> list:
+  """The matching (i, j, size) runs of a shortest edit script for the ranges; None if over budget.
+
+  This is the greedy forward Myers algorithm, keeping the furthest-reaching x for each diagonal k
+  after each number of edits d, so that the path can be traced back from the end.
+  """
+  n, m = a_hi - a_lo, b_hi - b_lo
+  max_d = n + m if budget.edits is None else min(n + m, budget.edits)
+  offset = max_d + 1
+  furthest = [0] * (2 * max_d + 3)
+  trace = []
+  for d in range(max_d + 1):
+    if budget.out_of_time():
+      return None
+    # Diagonals -d - 1 through d + 1 are all the next round can look at.
+    trace.append(furthest[offset - d - 1:offset + d + 2])
+    for k in range(-d, d + 1, 2):
+      if k == -d or (k != d and furthest[offset + k - 1] < furthest[offset + k + 1]):
+        x = furthest[offset + k + 1]
+      else:
+        x = furthest[offset + k - 1] + 1
+      y = x - k
+      while x < n and y < m and a[a_lo + x] == b[b_lo + y]:
+        x += 1
+        y += 1
+      furthest[offset + k] = x
+      if x >= n and y >= m:
+        if budget.edits is not None:
+          budget.edits -= d
+        return [(a_lo + i, b_lo + j, size) for i, j, size in _trace_back(trace, n, m)]
+  return None
+
+
+def _trace_back(trace: list, x: int, y: int) -> list:
+  """Follow the edit path back from (x, y), collecting its diagonal runs."""
+  runs = []
+  for d in range(len(trace) - 1, -1, -1):
+    # trace[d] holds diagonals -d - 1 through d + 1.
+    furthest = trace[d]
+    k = x - y
+    if d == 0:
+      prev_x = prev_y = 0
+    else:
+      if k == -d or (k != d and furthest[k + d] < furthest[k + d + 2]):
+        prev_k = k + 1
+      else:
+        prev_k = k - 1
+      prev_x = furthest[prev_k + d + 1]
+      prev_y = prev_x - prev_k
+    # The diagonal run from the end of the previous edit to (x, y)
+    size = min(x - prev_x, y - prev_y) if d else x
+    if size > 0:
+      runs.append((x - size, y - size, size))
+    x, y = prev_x, prev_y
+  runs.reverse()
+  return runs
+
+
+# opcodes()
+# -------------------------------------------------------------------------------------------------
+def opcodes(blocks: list) -> list:
+  """Convert matching blocks to (tag, i1, i2, j1, j2) opcodes, as SequenceMatcher does."""
+  codes = []
+  i = j = 0
+  for ai, bj, size in blocks:
+    if i < ai and j < bj:
+      codes.append(('replace', i, ai, j, bj))
+    elif i < ai:
+      codes.append(('delete', i, ai, j, bj))
+    elif j < bj:
+      codes.append(('insert', i, ai, j, bj))
+    i, j = ai + size, bj + size
+    if size:
+      codes.append(('equal', ai, i, bj, j))
+  return codes
+
+
+def _grouped_opcodes(codes: list, n: int) -> list:
+  """Group opcodes into hunks with up to n lines of context, as SequenceMatcher does."""
+  codes = list(codes) or [('equal', 0, 1, 0, 1)]
+  if codes[0][0] == 'equal':
+    tag, i1, i2, j1, j2 = codes[0]
+    codes[0] = tag, max(i1, i2 - n), i2, max(j1, j2 - n), j2
+  if codes[-1][0] == 'equal':
+    tag, i1, i2, j1, j2 = codes[-1]
+    codes[-1] = tag, i1, min(i2, i1 + n), j1, min(j2, j1 + n)
+
+  groups = []
+  group = []
+  for tag, i1, i2, j1, j2 in codes:
+    # A long enough run without changes ends the hunk.
+    if tag == 'equal' and i2 - i1 > n + n:
+      group.append((tag, i1, min(i2, i1 + n), j1, min(j2, j1 + n)))
+      groups.append(group)
+      group = []
+      i1, i2, j1, j2 = max(i1, i2 - n), i2, max(j1, j2 - n), j2
+    group.append((tag, i1, i2, j1, j2))
+  if group and not (len(group) == 1 and group[0][0] == 'equal'):
+    groups.append(group)
+  return groups
+
+
+def _format_range(start: int, stop: int) -> str:
+  """Line range in context diff format."""
+  beginning = start + 1
+  length = stop - start
+  if not length:
+    beginning -= 1
+  if length <= 1:
+    return f'{beginning}'
+  return f'{beginning},{beginning + length - 1}'
+
+
+# context_diff()
+# -------------------------------------------------------------------------------------------------
+def context_diff(a: list, b: list, codes: list, fromfile: str = '', tofile: str = '',
+                 n: int = 3) -> list:
+  """Format opcodes for lines a and b (ending in newlines) the way difflib.context_diff() does."""
+  prefix = dict(insert='+ ', delete='- ', replace='! ', equal='  ')
+  lines = []
+  for group in _grouped_opcodes(codes, n):
+    if not lines:
+      lines += [f'*** {fromfile}\n', f'--- {tofile}\n']
+    first, last = group[0], group[-1]
+    lines.append('***************\n')
+
+    lines.append(f'*** {_format_range(first[1], last[2])} ****\n')
+    if any(tag in {'replace', 'delete'} for tag, _, _, _, _ in group):
+      for tag, i1, i2, _, _ in group:
+        if tag != 'insert':
+          lines += [prefix[tag] + line for line in a[i1:i2]]
+
+    lines.append(f'--- {_format_range(first[3], last[4])} ----\n')
+    if any(tag in {'replace', 'insert'} for tag, _, _, _, _ in group):
+      for tag, _, _, j1, j2 in group:
+        if tag != 'delete':
+          lines += [prefix[tag] + line for line in b[j1:j2]]
+
+  return lines
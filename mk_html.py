@@ -1,13 +1,112 @@
 #! /usr/local/bin/python3
-"""Replace null requirement_html fields in the requirement_blocks table."""
+"""Replace null requirement_html fields in the requirement_blocks table.
+
+Blocks are fetched in batches through a server-side cursor. Each batch is rendered, in worker
+processes if --workers is given, and written back with a COPY into a temporary table followed by a
+single UPDATE ... FROM. The --institution and --limit options allow the work to be split across
+runs or hosts. With --profile, the run is profiled (see profiling.py).
+
+The ingester doesn’t run this as a script, but calls generate_html() on its own connection.
+"""
 
-import psycopg
 import time
 
 from argparse import ArgumentParser
-from psycopg.rows import namedtuple_row
+from collections import namedtuple
+from concurrent.futures import ProcessPoolExecutor
+from contextlib import nullcontext
+
+from block_transforms import chunk_map
+from db_pool import add_database_arguments, database_from_args
+from profiling import add_profile_arguments, profiler_from_args
+from scribe_to_html import cached_to_html
+
+HtmlResult = namedtuple('HtmlResult', 'num_blocks num_updated')
+
+
+# render_blocks()
+# -------------------------------------------------------------------------------------------------
+def render_blocks(blocks: list) -> list:
+  """Render a batch of (institution, requirement_id, requirement_text, text_digest) tuples.
+
+  Returns a list of (institution, requirement_id, requirement_html) tuples.
+  """
+  return [(institution, requirement_id,
+           cached_to_html(institution, requirement_id, requirement_text, text_digest))
+          for institution, requirement_id, requirement_text, text_digest in blocks]
+
+
+# write_html()
+# -------------------------------------------------------------------------------------------------
+def write_html(cursor, rendered: list) -> int:
+  """Write a batch of rendered blocks back to requirement_blocks; return the number updated."""
+  cursor.execute('truncate html_updates')
+  with cursor.copy('copy html_updates (institution, requirement_id, requirement_html) '
+                   'from stdin') as copy:
+    for row in rendered:
+      copy.write_row(row)
+  cursor.execute("""
+  update requirement_blocks r
+     set requirement_html = h.requirement_html
+    from html_updates h
+   where r.institution = h.institution
+     and r.requirement_id = h.requirement_id
+  """)
+  return cursor.rowcount
+
+
+# generate_html()
+# -------------------------------------------------------------------------------------------------
+def generate_html(conn, institutions: list = (), limit: int = None, workers: int = 0,
+                  batch_size: int = 500, progress: bool = False) -> HtmlResult:
+  """Generate requirement_html for the blocks that don’t have it, and commit.
+
+  Only the blocks of the given institutions, if any, and at most limit of them, if given. Returns
+  the number of blocks found without requirement_html and the number updated.
+  """
+  conditions = ['requirement_html is null']
+  params = []
+  if institutions:
+    conditions.append('institution = any(%s)')
+    params.append([f'{institution.upper()[0:3]}01' for institution in institutions])
+  where_clause = ' and '.join(conditions)
+  limit_clause = '' if limit is None else f'limit {int(limit)}'
+
+  with conn.cursor() as cursor:
+    cursor.execute(f"""
+    select count(*) from (select 1 from requirement_blocks where {where_clause} {limit_clause}) b
+    """, params)
+    num_blocks, = cursor.fetchone()
+
+    cursor.execute("""
+    create temporary table if not exists html_updates (institution text,
+                                                       requirement_id text,
+                                                       requirement_html text)
+    """)
+
+    with conn.cursor(name='missing_html') as fetch_cursor:
+      fetch_cursor.execute(f"""
+      select institution, requirement_id, requirement_text,
+             coalesce(text_digest, md5(requirement_text))
+        from requirement_blocks
+       where {where_clause}
+       order by institution, requirement_id
+       {limit_clause}
+      """, params)
+      batches = iter(lambda: fetch_cursor.fetchmany(batch_size), [])
+
+      counter = 0
+      with (ProcessPoolExecutor(workers) if workers > 0 else nullcontext()) as executor:
+        for _, rendered in chunk_map(render_blocks, batches, executor, window=2 * max(workers, 1)):
+          counter += write_html(cursor, rendered)
+          if progress:
+            print(f'\r{counter:,}/{num_blocks:,}', end='')
+
+  conn.commit()
+  if progress:
+    print()
+  return HtmlResult(num_blocks, counter)
 
-from scribe_to_html import to_html
 
 if __name__ == '__main__':
   """Generate requirement_html for all requirement_blocks where it’s missing."""
@@ -15,28 +114,28 @@ if __name__ == '__main__':
   argparser = ArgumentParser('Generate missing requirement_html for requirement_blocks')
   argparser.add_argument('-p', '--progress', action='store_true',
                          help='enable progress messages')
+  argparser.add_argument('-i', '--institution', nargs='*', default=[],
+                         help='only blocks for these institution(s)')
+  argparser.add_argument('-l', '--limit', type=int,
+                         help='at most this many blocks')
+  argparser.add_argument('-w', '--workers', type=int, default=0,
+                         help='number of worker processes for rendering')
+  argparser.add_argument('--batch_size', type=int, default=500,
+                         help='number of blocks to render and write at a time')
+  add_database_arguments(argparser, pool_size=1)
+  add_profile_arguments(argparser)
   args = argparser.parse_args()
+  profiler = profiler_from_args(args)
 
-  with psycopg.connect('dbname=cuny_curriculum') as conn:
-    with conn.cursor(row_factory=namedtuple_row) as fetch_cursor:
-      with conn.cursor() as update_cursor:
-        fetch_cursor.execute("""select institution, requirement_id, requirement_text
-                                  from requirement_blocks
-                                  where requirement_html is null
-                             """)
-        num_blocks = fetch_cursor.rowcount
-        s = '' if num_blocks == 1 else 's'
-        print(f'Generate missing html text for {num_blocks} requirement block{s}')
-        counter = 0
-        for row in fetch_cursor:
-          counter += 1
-          if args.progress:
-            print(f'\r{counter:,}/{num_blocks:,}', end='')
-          requirement_html = to_html(row.institution, row. requirement_id, row.requirement_text)
-          update_cursor.execute("""update requirement_blocks set requirement_html = %s
-                                    where institution = %s and requirement_id = %s
-                                """, (requirement_html, row.institution, row.requirement_id))
+  with (profiler.stage('mk_html') if profiler else nullcontext(),
+        database_from_args(args) as database,
+        database.connection() as conn):
+    result = generate_html(conn, args.institution, args.limit, args.workers, args.batch_size,
+                           args.progress)
 
+  s = '' if result.num_blocks == 1 else 's'
+  print(f'Generated missing html text for {result.num_updated} of {result.num_blocks} '
+        f'requirement block{s}')
   elapsed = round(time.time() - start)
   s = '' if elapsed == 1 else 's'
   print(f'That took {elapsed} second{s}')
@@ -1,39 +1,39 @@
 #! /usr/local/bin/python3
-"""Fill requirement_blocks.term_info column using latest dgw_ir_active_requirements.csv."""
+"""Fill requirement_blocks.term_info column using latest dgw_ir_active_requirements.csv.
+
+With --profile, the run is profiled (see profiling.py).
+
+The ingester doesn’t run this as a script: it calls active_term_info() on the file it already has
+and update_term_info() on its own connection.
+"""
 
 import csv
 import json
-import psycopg
 import re
 
+from argparse import ArgumentParser
 from collections import defaultdict, namedtuple
 from datetime import date
 from pathlib import Path
 
-# __main__
-# -------------------------------------------------------------------------------------------------
-if __name__ == '__main__':
+from db_pool import add_database_arguments, database_from_args
+from profiling import add_profile_arguments, profiler_from_args
 
-  # Verify directory locations
-  home_dir = Path.home()
-  latest_dir = Path(home_dir, 'Projects/ingest_requirement_blocks/latest_queries/')
-  logs_dir = Path(home_dir, 'Projects/ingest_requirement_blocks/Logs/')
-  assert home_dir.is_dir(), 'Home dir not recognized'
-  assert latest_dir.is_dir(), 'Latest queries dir not found'
-  assert logs_dir.is_dir(), 'Logs dir not found'
+TermInfoResult = namedtuple('TermInfoResult', 'num_active num_set num_changed num_cleared '
+                                              'num_missing')
 
-  # Get the current query from the latest_queries dir
-  latest_query = next(iter(latest_dir.glob('dgw_ir_*')))
-  if not (latest_query and latest_query.is_file()):
-    # Fatal
-    exit('No dgw_ir_active_requirements file available.')
 
-  print(f'DGW_IR_ACTIVE_REQUIREMENTS: {latest_query.name}')
-  csv_reader = csv.reader(latest_query.open('r', newline=''), delimiter='|')
+# active_term_info()
+# -------------------------------------------------------------------------------------------------
+def active_term_info(active_requirements: Path) -> tuple:
+  """Return the irdw_load_date and the term_info lists of the blocks in an active requirements file.
 
-  # The OAREDA list includes the enrollment for each requirement block for each active term,
-  # where an active term is one in which current student(s) at the institution are actually
-  # enrolled in a program. Here, that is converted into a timeline of term-enrollment pairs.
+  The OAREDA list includes the enrollment for each requirement block for each active term, where an
+  active term is one in which current student(s) at the institution are actually enrolled in a
+  program. Here, that is converted into a timeline of term-enrollment pairs for each block, sorted
+  by active_term so the most-recent is the last term in the list.
+  """
+  csv_reader = csv.reader(active_requirements.open('r', newline=''), delimiter='|')
   active_blocks = defaultdict(list)
   irdw_load_date = None
   for line in csv_reader:
@@ -43,7 +43,6 @@ if __name__ == '__main__':
       row = Row._make(line)
       if irdw_load_date is None:
         irdw_load_date = row.irdw_load_date
-        print(f'IRDW_LOAD_DATE: {irdw_load_date}')
       else:
         assert irdw_load_date == irdw_load_date
 
@@ -52,34 +51,117 @@ if __name__ == '__main__':
                      'distinct_students': int(row.distinct_students)}
         active_blocks[(row.institution, row.dap_req_id)].append(term_info)
 
+  for value in active_blocks.values():
+    value.sort(key=lambda d: d['active_term'])
+  return irdw_load_date, active_blocks
+
+
+# update_term_info()
+# -------------------------------------------------------------------------------------------------
+def update_term_info(conn, active_blocks: dict, log_file) -> TermInfoResult:
+  """Replace the term_info of the blocks in requirement_blocks, and commit.
+
+  The active_blocks are as returned by active_term_info(). Blocks that aren’t active any more get
+  Null term_info. Active blocks that aren’t in requirement_blocks are logged, with the last term
+  each was active.
+  """
+  with conn.cursor() as cursor:
+    # Load the term_info list for each active block into a temporary table, so the changes can be
+    # applied set-wise rather than a row at a time.
+    cursor.execute("""
+    create temporary table term_info_updates (
+      institution text,
+      requirement_id text,
+      term_info jsonb,
+      primary key (institution, requirement_id)) on commit drop
+    """)
+    with cursor.copy('copy term_info_updates (institution, requirement_id, term_info) '
+                     'from stdin') as copy:
+      for (institution, requirement_id), value in active_blocks.items():
+        copy.write_row((institution, requirement_id, json.dumps(value)))
+    cursor.execute('analyze term_info_updates')
+
+    # Update just the blocks whose term_info changed.
+    cursor.execute("""
+    update requirement_blocks r
+       set term_info = t.term_info
+      from term_info_updates t
+     where r.institution = t.institution
+       and r.requirement_id = t.requirement_id
+       and r.term_info is distinct from t.term_info
+    """)
+    num_changed = cursor.rowcount
+
+    # Clear the term_info of blocks that are no longer active.
+    cursor.execute("""
+    update requirement_blocks r
+       set term_info = Null
+     where r.term_info is not null
+       and not exists (select 1
+                         from term_info_updates t
+                        where t.institution = r.institution
+                          and t.requirement_id = r.requirement_id)
+    """)
+    num_cleared = cursor.rowcount
+
+    # Active blocks that aren’t in requirement_blocks: log the last active term for each.
+    cursor.execute("""
+    select t.institution, t.requirement_id, t.term_info -> -1 ->> 'active_term'
+      from term_info_updates t
+     where not exists (select 1
+                         from requirement_blocks r
+                        where r.institution = t.institution
+                          and r.requirement_id = t.requirement_id)
+     order by t.institution, t.requirement_id
+    """)
+    num_missing = cursor.rowcount
+    for institution, requirement_id, active_term in cursor:
+      print(f'{institution} {requirement_id} {active_term}', file=log_file)
+
+  conn.commit()
+  return TermInfoResult(len(active_blocks), len(active_blocks) - num_missing, num_changed,
+                        num_cleared, num_missing)
+
+
+# __main__
+# -------------------------------------------------------------------------------------------------
+if __name__ == '__main__':
+  argparser = ArgumentParser('Fill requirement_blocks.term_info')
+  add_database_arguments(argparser, pool_size=1)
+  add_profile_arguments(argparser)
+  args = argparser.parse_args()
+  if profiler := profiler_from_args(args):
+    profiler.start('mk_term_info')
+
+  # Verify directory locations
+  home_dir = Path.home()
+  latest_dir = Path(home_dir, 'Projects/ingest_requirement_blocks/latest_queries/')
+  logs_dir = Path(home_dir, 'Projects/ingest_requirement_blocks/Logs/')
+  assert home_dir.is_dir(), 'Home dir not recognized'
+  assert latest_dir.is_dir(), 'Latest queries dir not found'
+  assert logs_dir.is_dir(), 'Logs dir not found'
+
+  # Get the current query from the latest_queries dir
+  latest_query = next(iter(latest_dir.glob('dgw_ir_*')))
+  if not (latest_query and latest_query.is_file()):
+    # Fatal
+    exit('No dgw_ir_active_requirements file available.')
+
+  print(f'DGW_IR_ACTIVE_REQUIREMENTS: {latest_query.name}')
+  irdw_load_date, active_blocks = active_term_info(latest_query)
+  print(f'IRDW_LOAD_DATE: {irdw_load_date}')
+
   log_pathname = Path(logs_dir, f'mk_term_info_{date.today()}.log')
   with log_pathname.open('w') as log_file:
-    with psycopg.connect('dbname=cuny_curriculum') as conn:
-      with conn.cursor() as cursor:
-        # Clear all values from the term_info column of the requirement_blocks table.
-        cursor.execute("""
-        update requirement_blocks set term_info = Null;
-        """)
-
-        # Add the term_info list for each active block
-        num_set = 0
-        for key, value in active_blocks.items():
-          # Sort by active_term so most-recent is last term in the list
-          value = sorted(value, key=lambda d: d['active_term'])
-          institution, requirement_id = key
-          cursor.execute("""
-          update requirement_blocks set term_info = %s
-           where institution = %s
-             and requirement_id = %s
-          """, (json.dumps(value), institution, requirement_id))
-
-          if cursor.rowcount != 1:
-            # Print the last active term for missing rows
-            print(f'{institution} {requirement_id} {value[-1]["active_term"]}', file=log_file)
-          else:
-            num_set += 1
-
-    print(f'{len(active_blocks):9,} active blocks')
-    print(f'{num_set:9,} matching blocks found')
-    if num_set < len(active_blocks):
-      print(f'{len(active_blocks) - num_set:9,} missing blocks logged to Logs/{log_pathname.name}')
+    with database_from_args(args) as database, database.connection() as conn:
+      result = update_term_info(conn, active_blocks, log_file)
+
+  print(f'{result.num_active:9,} active blocks')
+  print(f'{result.num_set:9,} matching blocks found')
+  print(f'{result.num_changed:9,} blocks with changed term info')
+  print(f'{result.num_cleared:9,} blocks no longer active')
+  if result.num_missing:
+    print(f'{result.num_missing:9,} missing blocks logged to Logs/{log_pathname.name}')
+
+  if profiler:
+    profiler.stop()
@@ -0,0 +1,92 @@
+"""Profile the stages of an ingestion run with cProfile, and optionally tracemalloc.
+
+With --profile, each stage of a run gets, in the profile directory:
+  {stage}.prof          the cProfile data, for pstats or a viewer such as snakeviz
+  {stage}.txt           the 40 functions with the most cumulative time
+  {stage}.memory.txt    with --profile_memory: peak traced memory, and the 25 lines that had the
+                        most memory allocated at the end of the stage
+
+The profile directory is profiles/{date}_{time}, unless one is given.
+
+cProfile sees only the thread that starts the stage: work done in shard threads, asyncio’s
+to_thread() threads, or worker processes isn’t in the profile, just the time spent waiting for it.
+"""
+
+import cProfile
+import datetime
+import pstats
+import tracemalloc
+
+from contextlib import contextmanager
+from pathlib import Path
+
+
+class StageProfiler:
+  """Profile stages, one at a time, writing the results to a directory."""
+
+  def __init__(self, output_dir: Path, memory: bool = False):
+    """Create the directory if need be."""
+    self.output_dir = output_dir
+    self.memory = memory
+    self.output_dir.mkdir(parents=True, exist_ok=True)
+    self._name = None
+    self._profile = None
+
+  def start(self, name: str) -> None:
+    """Start profiling a stage."""
+    self._name = name
+    if self.memory:
+      if not tracemalloc.is_tracing():
+        tracemalloc.start()
+      tracemalloc.reset_peak()
+    self._profile = cProfile.Profile()
+    self._profile.enable()
+
+  def stop(self) -> None:
+    """Stop profiling the current stage and write its results."""
+    self._profile.disable()
+    self._profile.dump_stats(Path(self.output_dir, f'{self._name}.prof'))
+    with Path(self.output_dir, f'{self._name}.txt').open('w') as report:
+      pstats.Stats(self._profile, stream=report).sort_stats('cumulative').print_stats(40)
+
+    if self.memory:
+      current, peak = tracemalloc.get_traced_memory()
+      top_lines = tracemalloc.take_snapshot().statistics('lineno')[:25]
+      with Path(self.output_dir, f'{self._name}.memory.txt').open('w') as report:
+        print(f'Peak traced memory: {peak / 1e6:,.1f} MB', file=report)
+        print(f'At end of stage:    {current / 1e6:,.1f} MB\n', file=report)
+        for stat in top_lines:
+          print(stat, file=report)
+    self._profile = None
+
+  @contextmanager
+  def stage(self, name: str):
+    """Profile the stage done in a with block."""
+    self.start(name)
+    try:
+      yield
+    finally:
+      self.stop()
+
+
+# add_profile_arguments()
+# -------------------------------------------------------------------------------------------------
+def add_profile_arguments(parser) -> None:
+  """Add the --profile options to a script’s ArgumentParser."""
+  parser.add_argument('--profile', nargs='?', const='', metavar='DIR',
+                      help='profile each stage, into DIR (default: a new profiles/{date}_{time})')
+  parser.add_argument('--profile_memory', action='store_true',
+                      help='with --profile, also record peak memory allocations')
+
+
+# profiler_from_args()
+# -------------------------------------------------------------------------------------------------
+def profiler_from_args(args) -> StageProfiler:
+  """The StageProfiler the command line asks for, if any."""
+  if args.profile is None:
+    return None
+  if args.profile:
+    output_dir = Path(args.profile)
+  else:
+    output_dir = Path('profiles', datetime.datetime.now().strftime('%Y-%m-%d_%H%M%S'))
+  return StageProfiler(output_dir, args.profile_memory)
@@ -30,7 +30,9 @@ CREATE TABLE requirement_blocks (
  dgw_seconds       real default null,
  irdw_load_date    date,
  dgw_parse_date    date default null,
- terminfo          json,
+ term_info         jsonb default null,
+ text_digest       text default null,
+ metadata_digest   text default null,
  PRIMARY KEY (institution, requirement_id));
 
 drop view if exists view_blocks;
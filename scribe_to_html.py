@@ -1,12 +1,13 @@
 #! /usr/local/bin/python3
 """Function to generate HTML details element from requirement_text."""
 
-import psycopg
-
 from argparse import ArgumentParser
+from collections import OrderedDict
 from dgw_preprocessor import dgw_filter
 from psycopg.rows import dict_row
 
+from db_pool import add_database_arguments, database_from_args
+
 
 # to_html()
 # -------------------------------------------------------------------------------------------------
@@ -25,11 +26,76 @@ def to_html(institution, requirement_id, requirement_text):
   return html.replace('\t', ' ').replace("'", '’')
 
 
+# cached_to_html()
+# -------------------------------------------------------------------------------------------------
+# The most-recently used renderings, keyed by (institution, requirement_id, text_digest): everything
+# to_html() depends on, the text being stood in for by its digest.
+_html_cache = OrderedDict()
+html_cache_size = 10000
+
+
+def _cache_get(key: tuple) -> str:
+  """The cached rendering for key, or None; a hit becomes the most recently used."""
+  if (html := _html_cache.get(key)) is not None:
+    _html_cache.move_to_end(key)
+  return html
+
+
+def _cache_put(key: tuple, html: str) -> None:
+  """Cache a rendering, dropping the least recently used one if the cache is full."""
+  _html_cache[key] = html
+  _html_cache.move_to_end(key)
+  if len(_html_cache) > html_cache_size:
+    _html_cache.popitem(last=False)
+
+
+def cached_to_html(institution, requirement_id, requirement_text, text_digest):
+  """Like to_html(), but memoized in a bounded LRU cache.
+
+  A block rendered again with the same text (a repeated row, a resumed run) is rendered just once.
+  """
+  key = (institution, requirement_id, text_digest)
+  if (html := _cache_get(key)) is None:
+    html = to_html(institution, requirement_id, requirement_text)
+    _cache_put(key, html)
+  return html
+
+
+# cached_to_html_many()
+# -------------------------------------------------------------------------------------------------
+def _to_html_star(block):
+  """Unpack the arguments for to_html(), for use with a process pool’s map()."""
+  return to_html(*block)
+
+
+def cached_to_html_many(blocks, map_fn=map):
+  """Render a list of (institution, requirement_id, requirement_text, text_digest) tuples.
+
+  Like cached_to_html(), but the distinct blocks that aren’t cached are rendered together using
+  map_fn, which can be the map() method of a process pool. Returns the list of HTML strings.
+  """
+  htmls = dict()
+  missing = dict()
+  for institution, requirement_id, requirement_text, text_digest in blocks:
+    key = (institution, requirement_id, text_digest)
+    if key not in htmls and key not in missing:
+      if (html := _cache_get(key)) is None:
+        missing[key] = (institution, requirement_id, requirement_text)
+      else:
+        htmls[key] = html
+  for key, html in zip(missing.keys(), map_fn(_to_html_star, missing.values())):
+    htmls[key] = html
+    _cache_put(key, html)
+
+  return [htmls[(block[0], block[1], block[3])] for block in blocks]
+
+
 if __name__ == '__main__':
   """For development, give an institution/requirement_id and get back the html text."""
   argument_parser = ArgumentParser('Test html generator')
   argument_parser.add_argument('-i', '--institution')
   argument_parser.add_argument('-r', '--requirement_id')
+  add_database_arguments(argument_parser, pool_size=1)
   args = argument_parser.parse_args()
   if args.institution and args.requirement_id:
     institution = f'{args.institution.upper()[0:3]}01'
@@ -38,7 +104,7 @@ if __name__ == '__main__':
     argument_parser.print_usage()
     exit()
   print(f'{institution} {requirement_id}')
-  with psycopg.connect('dbname=cuny_curriculum') as conn:
+  with database_from_args(args) as database, database.connection() as conn:
     with conn.cursor(row_factory=dict_row) as cursor:
       cursor.execute("""
       select block_type, block_value, title, period_start, period_stop, requirement_text
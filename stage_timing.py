@@ -0,0 +1,160 @@
+"""Wall and CPU time for the stages of an ingestion run, and for the hot operations within them.
+
+Stages (archiving the extracts, ingesting, mk_html, ...) are timed once each. Their CPU time
+includes that of child processes that have finished, such as the workers rendering HTML.
+
+Operations (parsing a row of the extract, diffing a chunk of blocks, writing a block, ...) happen
+many times, so for each one the count, totals, extremes, and a histogram of the wall times are
+kept. Operation times are exclusive: when one timed operation happens inside another, as parsing
+the extract does inside normalizing chunks of it, its time counts only for the inner one. The CPU
+time of an operation is that of the thread timing it, so work handed off to worker processes, or
+done by other asyncio tasks while an operation awaits something, shows up as wall time only.
+
+Everything can be written to a JSON file, for finding out afterwards where the time went:
+
+  {"stages": [{"name": ..., "wall_seconds": ..., "cpu_seconds": ...}, ...],
+   "operations": {name: {"count": ..., "wall_seconds": ..., "cpu_seconds": ...,
+                         "min_seconds": ..., "max_seconds": ..., "histogram": {...}}, ...}}
+
+The histogram counts the operations whose wall times were at most each power-of-two number of
+microseconds.
+"""
+
+import contextvars
+import json
+import os
+import threading
+import time
+
+from contextlib import contextmanager
+from pathlib import Path
+
+# The operations being timed in the current thread or asyncio task, innermost last: each is a list
+# of [wall time, CPU time] spent in operations nested inside it so far.
+_nested = contextvars.ContextVar('nested', default=())
+
+
+def _process_cpu() -> float:
+  """CPU time of this process and its finished children."""
+  times = os.times()
+  return times.user + times.system + times.children_user + times.children_system
+
+
+class OperationStats:
+  """The aggregate times of one kind of operation."""
+
+  def __init__(self):
+    """No operations yet."""
+    self.count = 0
+    self.wall = 0.0
+    self.cpu = 0.0
+    self.min = None
+    self.max = 0.0
+    self.histogram = dict()
+
+  def add(self, wall: float, cpu: float) -> None:
+    """Count one operation."""
+    self.count += 1
+    self.wall += wall
+    self.cpu += cpu
+    self.min = wall if self.min is None else min(self.min, wall)
+    self.max = max(self.max, wall)
+    bucket = 1 << max(int(wall * 1e6) - 1, 0).bit_length()
+    self.histogram[bucket] = self.histogram.get(bucket, 0) + 1
+
+  def as_dict(self) -> dict:
+    """The stats, for the JSON file."""
+    return {'count': self.count, 'wall_seconds': self.wall, 'cpu_seconds': self.cpu,
+            'min_seconds': self.min, 'max_seconds': self.max,
+            'histogram': {f'{bucket}us': self.histogram[bucket]
+                          for bucket in sorted(self.histogram)}}
+
+
+class Timings:
+  """The stages and operations timed during a run."""
+
+  def __init__(self):
+    """Nothing timed yet."""
+    self.stages = []
+    self.operations = dict()
+    self.profiler = None
+    self._lock = threading.Lock()
+
+  def start_stage(self, name: str) -> tuple:
+    """Start timing a stage; pass what this returns to end_stage().
+
+    If there is a profiler (see profiling.py), the stage is profiled too.
+    """
+    if self.profiler is not None:
+      self.profiler.start(name)
+    return name, time.perf_counter(), _process_cpu()
+
+  def end_stage(self, started: tuple) -> None:
+    """Finish timing a stage."""
+    name, wall, cpu = started
+    self.stages.append({'name': name, 'wall_seconds': time.perf_counter() - wall,
+                        'cpu_seconds': _process_cpu() - cpu})
+    if self.profiler is not None:
+      self.profiler.stop()
+
+  @contextmanager
+  def stage(self, name: str):
+    """Time the stage done in a with block."""
+    started = self.start_stage(name)
+    try:
+      yield
+    finally:
+      self.end_stage(started)
+
+  @contextmanager
+  def timed(self, name: str):
+    """Time one operation, done in a with block."""
+    inner = [0.0, 0.0]
+    token = _nested.set(_nested.get() + (inner, ))
+    wall = time.perf_counter()
+    cpu = time.thread_time()
+    try:
+      yield
+    finally:
+      wall = time.perf_counter() - wall
+      cpu = time.thread_time() - cpu
+      _nested.reset(token)
+      if outer := _nested.get():
+        outer[-1][0] += wall
+        outer[-1][1] += cpu
+      with self._lock:
+        if (stats := self.operations.get(name)) is None:
+          stats = self.operations[name] = OperationStats()
+        stats.add(wall - inner[0], cpu - inner[1])
+
+  def timed_iter(self, name: str, iterable):
+    """Pass the items of an iterable through, timing the production of each one."""
+    iterator = iter(iterable)
+    while True:
+      with self.timed(name):
+        try:
+          item = next(iterator)
+        except StopIteration:
+          return
+      yield item
+
+  def summary(self) -> str:
+    """The stages and operations, as lines of text."""
+    lines = [f'{"Stage":<14} {"Wall sec":>10} {"CPU sec":>9}']
+    for stage in self.stages:
+      lines.append(f'{stage["name"]:<14} {stage["wall_seconds"]:10.2f} {stage["cpu_seconds"]:9.2f}')
+    lines.append(f'{"Operation":<14} {"Count":>10} {"Wall sec":>10} {"CPU sec":>9} {"Max sec":>9}')
+    for name, stats in sorted(self.operations.items(), key=lambda item: -item[1].wall):
+      lines.append(f'{name:<14} {stats.count:10,} {stats.wall:10.2f} {stats.cpu:9.2f} '
+                   f'{stats.max:9.3f}')
+    return '\n'.join(lines)
+
+  def write(self, path: Path) -> None:
+    """Write the timings to a JSON file."""
+    with self._lock:
+      operations = {name: stats.as_dict() for name, stats in self.operations.items()}
+    path.write_text(json.dumps({'stages': self.stages, 'operations': operations}, indent=2))
+
+
+# The timings of this run, shared by the modules that do the timing
+timings = Timings()
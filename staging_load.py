@@ -0,0 +1,147 @@
+"""Set-based ingestion of the dap_req_block extract through an unlogged staging table.
+
+The normalized rows are streamed into the staging table with COPY, then a couple of set-based
+statements find the changed blocks (for the change log and history diffs) and insert/update
+requirement_blocks, letting Postgres hash-join the two tables on (institution, requirement_id)
+instead of making a round trip for each block.
+
+An extract that repeats a block is resolved the way ingesting it row by row would be: the last of
+the repeated rows is the one that counts, and drop_duplicates() removes the others before the
+changes are looked up.
+
+Blocks that are new or whose text changed get Null requirement_html and parse info; mk_html.py
+and the parser fill them in later.
+"""
+
+from block_index import metadata_fields, table_metadata_digest_sql
+
+staging_table = 'requirement_blocks_staging'
+
+# The columns loaded into the staging table, in the order copy_rows() expects them.
+staging_cols = ['institution', 'requirement_id', 'block_type', 'block_value', 'title',
+                'period_start', 'period_stop', 'school', 'degree', 'college', 'major1', 'major2',
+                'concentration', 'minor', 'liberal_learning', 'specialization', 'program',
+                'parse_status', 'parse_date', 'parse_who', 'parse_what', 'lock_version',
+                'requirement_text', 'irdw_load_date', 'text_digest', 'metadata_digest']
+
+
+# _text_changed()
+# -------------------------------------------------------------------------------------------------
+def _text_changed(new: str, old: str) -> str:
+  """SQL test for whether the new block’s text differs from the old one’s."""
+  return (f'{new}.text_digest is distinct from '
+          f'coalesce({old}.text_digest, md5({old}.requirement_text))')
+
+
+# _metadata_changed()
+# -------------------------------------------------------------------------------------------------
+def _metadata_changed(new: str, old: str) -> str:
+  """SQL test for whether the new block’s tracked metadata differs from the old one’s."""
+  return (f'{new}.metadata_digest is distinct from '
+          f'coalesce({old}.metadata_digest, {table_metadata_digest_sql(old)})')
+
+
+# create_staging_table()
+# -------------------------------------------------------------------------------------------------
+def create_staging_table(cursor) -> None:
+  """Create (or empty) the unlogged staging table.
+
+  Its staging_position column numbers the rows in the order they were copied in.
+  """
+  cursor.execute(f"""
+  create unlogged table if not exists {staging_table} (like requirement_blocks including defaults)
+  """)
+  cursor.execute(f"""
+  alter table {staging_table}
+    add column if not exists staging_position bigint generated always as identity
+  """)
+  cursor.execute(f'truncate {staging_table} restart identity')
+
+
+# copy_rows()
+# -------------------------------------------------------------------------------------------------
+def copy_rows(cursor, records) -> int:
+  """Stream records (sequences in staging_cols order) into the staging table; return the count."""
+  num_records = 0
+  with cursor.copy(f'copy {staging_table} ({", ".join(staging_cols)}) from stdin') as copy:
+    for record in records:
+      copy.write_row(record)
+      num_records += 1
+  cursor.execute(f'analyze {staging_table}')
+
+  return num_records
+
+
+# drop_duplicates()
+# -------------------------------------------------------------------------------------------------
+def drop_duplicates(cursor) -> list:
+  """Delete all but the last-copied staging row for each block.
+
+  Returns (institution, requirement_id, staging_position) for each row deleted, in the order they
+  were copied.
+  """
+  cursor.execute(f"""
+  delete from {staging_table} s
+   using {staging_table} later
+   where later.institution = s.institution
+     and later.requirement_id = s.requirement_id
+     and later.staging_position > s.staging_position
+  returning s.institution, s.requirement_id, s.staging_position
+  """)
+  return sorted(cursor.fetchall(), key=lambda row: row[2])
+
+
+# staged_changes()
+# -------------------------------------------------------------------------------------------------
+def staged_changes(cursor):
+  """Yield the staged blocks that differ from existing ones, with their previous values.
+
+  Each row has the institution, requirement_id, parse_date, and metadata fields of the staged
+  block; prev_parse_date and a prev_ column for each metadata field; and text_is_changed. The
+  previous and new requirement_text are included (not Null) only for blocks whose text changed.
+  """
+  text_changed = _text_changed('s', 'r')
+  new_metadata = ', '.join(f's.{field}' for field in metadata_fields)
+  prev_metadata = ', '.join(f'r.{field} as prev_{field}' for field in metadata_fields)
+  cursor.execute(f"""
+  select s.institution, s.requirement_id, s.parse_date, r.parse_date as prev_parse_date,
+         {new_metadata}, {prev_metadata},
+         {text_changed} as text_is_changed,
+         case when {text_changed} then r.requirement_text end as prev_text,
+         case when {text_changed} then s.requirement_text end as requirement_text
+    from {staging_table} s join requirement_blocks r using (institution, requirement_id)
+   where {text_changed}
+      or {_metadata_changed('s', 'r')}
+  order by s.institution, s.requirement_id
+  """)
+  yield from cursor
+
+
+# merge_staged()
+# -------------------------------------------------------------------------------------------------
+def merge_staged(cursor) -> list:
+  """Insert new blocks and update changed ones from the staging table.
+
+  Returns a list of (institution, requirement_id, block_type, block_value, period_stop, inserted)
+  rows, one for each block inserted or updated.
+  """
+  key_cols = ['institution', 'requirement_id']
+  update_cols = [col for col in staging_cols if col not in key_cols]
+  text_changed = _text_changed('excluded', 'r')
+  metadata_changed = _metadata_changed('excluded', 'r')
+  set_args = ',\n         '.join([f'{col} = excluded.{col}' for col in update_cols]
+                                + [f'{col} = case when {text_changed} then null else r.{col} end'
+                                   for col in ['requirement_html', 'dgw_parse_tree',
+                                               'dgw_parse_date', 'dgw_seconds']])
+  cursor.execute(f"""
+  insert into requirement_blocks as r ({', '.join(staging_cols)})
+  select {', '.join(staging_cols)}
+    from {staging_table}
+  on conflict (institution, requirement_id) do update
+     set {set_args}
+   where {text_changed}
+      or {metadata_changed}
+  returning r.institution, r.requirement_id, r.block_type, r.block_value, r.period_stop,
+            (r.xmax = 0) as inserted
+  """)
+  return cursor.fetchall()